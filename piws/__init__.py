@@ -7,7 +7,12 @@
 ##########################################################################
 
 # System import
+import types
+import threading
 from packaging import version
+from twisted.internet import reactor
+from twisted.internet import threads
+from twisted.python import threadable
 
 # Cubicweb import
 import cubicweb
@@ -65,15 +70,86 @@ if cw_version >= version.parse("3.21.0"):
         return result
 
 
+class StreamProducer(object):
+    """ A push producer that blocks the thread generating a streamed
+    response while the twisted transport buffer is full.
+
+    The 'pauseProducing', 'resumeProducing' and 'stopProducing' methods are
+    called by twisted from the reactor thread, the 'wait' method is called
+    from the thread that generates the response.
+    """
+    def __init__(self):
+        """ Initialize the StreamProducer class.
+        """
+        self._writable = threading.Event()
+        self._writable.set()
+        self.stopped = False
+
+    def pauseProducing(self):
+        self._writable.clear()
+
+    def resumeProducing(self):
+        self._writable.set()
+
+    def stopProducing(self):
+        self.stopped = True
+        self._writable.set()
+
+    def wait(self):
+        """ Block until the transport accepts more data.
+
+        Returns
+        -------
+        writable: bool
+            False if the connection is lost.
+        """
+        self._writable.wait()
+        return not self.stopped
+
+
+def _write_stream(twreq, stream):
+    """ Write a generator stream chunk by chunk from a worker thread: the
+    writes are made from the reactor thread and the worker thread waits
+    while the transport buffer is full, so that the memory stays flat.
+    """
+    producer = StreamProducer()
+    threads.blockingCallFromThread(
+        reactor, twreq.registerProducer, producer, True)
+    try:
+        for chunk in stream:
+            if not producer.wait() or twreq._disconnected:
+                stream.close()
+                break
+            threads.blockingCallFromThread(reactor, twreq.write, chunk)
+    finally:
+        threads.blockingCallFromThread(reactor, twreq.unregisterProducer)
+
+
 @monkeypatch(HTTPResponse)
 def _finalize(self):
     """ If the request.write failed or the connection is lost, the request
     will have already been finished.
+
+    A generator stream is written chunk by chunk (see
+    'cubes.piws.views.streaming'): from a worker thread, the chunks are
+    written from the reactor thread with backpressure (see
+    '_write_stream').
     """
     if self._code is not None:
         self._twreq.setResponseCode(self._code)
-    if self._stream is not None:
+    if isinstance(self._stream, types.GeneratorType):
+        if threadable.isInIOThread():
+            for chunk in self._stream:
+                if self._twreq._disconnected:
+                    self._stream.close()
+                    break
+                self._twreq.write(chunk)
+        else:
+            _write_stream(self._twreq, self._stream)
+            if not self._twreq._disconnected and not self._twreq.finished:
+                threads.blockingCallFromThread(reactor, self._twreq.finish)
+            return
+    elif self._stream is not None:
         self._twreq.write(str(self._stream))
     if not self._twreq._disconnected and not self._twreq.finished:
         self._twreq.finish()
-
@@ -0,0 +1,274 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2017
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# System import
+import os
+import json
+import errno
+import hashlib
+import tempfile
+import threading
+
+
+# Module level registry of the caches created by 'get_disk_cache'
+_DISK_CACHES = {}
+_DISK_CACHES_LOCK = threading.Lock()
+
+
+class DiskLRUCache(object):
+    """ A bounded on-disk cache: each entry is stored in its own file,
+    the least recently used entries are evicted when the cache folder
+    exceeds its byte budget.
+
+    The entry files are written atomically (temporary file + rename) and
+    their modification time is updated on each hit, so that the cache can
+    be shared by several processes. The entries are sharded in sub folders
+    named after the first characters of their keys.
+
+    The cache size is tracked incrementally: the folder is only scanned on
+    the first write and when the byte budget is exceeded, then the least
+    recently used entries are evicted in batch until the cache fits in
+    'evict_ratio' of its budget.
+    """
+    suffix = ".cache"
+    shard_length = 2
+    evict_ratio = 0.9
+
+    def __init__(self, folder, max_bytes):
+        """ Initialize the DiskLRUCache class.
+
+        Parameters
+        ----------
+        folder: str
+            the folder where the entries are stored, created if needed.
+        max_bytes: int
+            the cache byte budget, 0 to disable the cache.
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._total_bytes = None
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    @staticmethod
+    def make_key(*parts):
+        """ Build a cache key from JSON serializable parts.
+
+        Parameters
+        ----------
+        parts: list
+            the items that identify the cached entry.
+
+        Returns
+        -------
+        key: str
+            the cache key.
+        """
+        return hashlib.sha1(
+            json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def file_identity(path):
+        """ Identify a file by its path, size and modification time: the
+        identity changes whenever the file is modified.
+
+        Parameters
+        ----------
+        path: str
+            a file path.
+
+        Returns
+        -------
+        identity: list
+            the file absolute path, size and modification time.
+        """
+        stat = os.stat(path)
+        return [os.path.abspath(path), stat.st_size, stat.st_mtime]
+
+    def path(self, key):
+        """ Get the path of an entry file.
+        """
+        return os.path.join(self.folder, key[:self.shard_length],
+                            key + self.suffix)
+
+    def __contains__(self, key):
+        return os.path.isfile(self.path(key))
+
+    def get(self, key):
+        """ Get a cached entry.
+
+        Parameters
+        ----------
+        key: str
+            the cache key.
+
+        Returns
+        -------
+        data: str
+            the cached data, None if the entry is not cached.
+        """
+        path = self.path(key)
+        try:
+            with open(path, "rb") as open_file:
+                data = open_file.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def set(self, key, data):
+        """ Cache an entry and evict the least recently used entries if the
+        byte budget is exceeded.
+
+        Parameters
+        ----------
+        key: str
+            the cache key.
+        data: str
+            the data to be cached.
+        """
+        if len(data) > self.max_bytes:
+            return
+        path = self.path(key)
+        shard = os.path.dirname(path)
+        if not os.path.isdir(shard):
+            try:
+                os.makedirs(shard)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        fd, tmp_path = tempfile.mkstemp(dir=shard, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as open_file:
+                open_file.write(data)
+            previous_size = self._size(path)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(
+                    [size for _, size, _ in self.entries()])
+            else:
+                self._total_bytes += len(data) - previous_size
+            over_budget = self._total_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    @staticmethod
+    def _size(path):
+        """ Get the size of an entry file, 0 if the entry is not cached.
+        """
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def delete(self, key):
+        """ Remove a cached entry.
+        """
+        path = self.path(key)
+        size = self._size(path)
+        try:
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes -= size
+
+    def entries(self):
+        """ List the cached entries.
+
+        Returns
+        -------
+        entries: list of 3-uplet
+            the entries last access time, size and path.
+        """
+        entries = []
+        for dirpath, _, filenames in os.walk(self.folder):
+            for name in filenames:
+                if not name.endswith(self.suffix):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache fits in
+        'evict_ratio' of its byte budget: the folder is scanned once per
+        batch of evicted entries.
+        """
+        with self._lock:
+            entries = sorted(self.entries())
+            total_bytes = sum([size for _, size, _ in entries])
+            if total_bytes > self.max_bytes:
+                target_bytes = self.max_bytes * self.evict_ratio
+                for _, size, path in entries:
+                    if total_bytes <= target_bytes:
+                        break
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        continue
+                    total_bytes -= size
+            self._total_bytes = total_bytes
+
+    def clear(self):
+        """ Remove all the cached entries.
+        """
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._total_bytes = 0
+
+
+def get_disk_cache(config, namespace, size_option):
+    """ Get the disk cache of a feature: the caches are stored in the
+    'cache-folder' instance folder, one sub folder per namespace.
+
+    Parameters
+    ----------
+    config: CubicWebConfiguration
+        the instance configuration.
+    namespace: str
+        the cache name, used as sub folder name.
+    size_option: str
+        the configuration option that defines the cache byte budget in MB.
+
+    Returns
+    -------
+    cache: DiskLRUCache or None
+        the shared cache, None if the cache is disabled.
+    """
+    max_bytes = int(config[size_option]) * 1024 * 1024
+    if max_bytes <= 0:
+        return None
+    cache_folder = config["cache-folder"] or os.path.join(
+        config.appdatahome, "piws-cache")
+    folder = os.path.join(cache_folder, namespace)
+    with _DISK_CACHES_LOCK:
+        cache = _DISK_CACHES.get(folder)
+        if cache is None:
+            cache = DiskLRUCache(folder, max_bytes)
+            _DISK_CACHES[folder] = cache
+    return cache
@@ -0,0 +1,180 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2017
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# System import
+import sys
+import threading
+from collections import OrderedDict
+
+
+# Module level registry of the caches created by 'get_memory_cache'
+_MEMORY_CACHES = {}
+_MEMORY_CACHES_LOCK = threading.Lock()
+
+
+def approximate_size(value):
+    """ Estimate the memory used by a value and by the containers, strings
+    and numbers it references.
+
+    Parameters
+    ----------
+    value: object
+        a value made of dict, list, tuple, set and scalar items.
+
+    Returns
+    -------
+    size: int
+        the approximate size in bytes.
+    """
+    size = 0
+    seen = set()
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+    return size
+
+
+class MemoryLRUCache(object):
+    """ A bounded in-process cache: the least recently used entries are
+    evicted when the number of entries exceeds the cache size or, if a
+    byte budget is set, when the approximate size of the entries exceeds
+    this budget.
+
+    The cache is shared by the threads of the current process only.
+    """
+    def __init__(self, max_items, max_bytes=0):
+        """ Initialize the MemoryLRUCache class.
+
+        Parameters
+        ----------
+        max_items: int
+            the maximum number of cached entries, 0 to disable the cache.
+        max_bytes: int (optional, default 0)
+            the approximate byte budget of the cached entries, 0 for no
+            byte budget.
+        """
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key, default=None):
+        """ Get a cached entry.
+
+        Parameters
+        ----------
+        key: hashable
+            the cache key.
+        default: object (optional, default None)
+            the value returned if the entry is not cached.
+
+        Returns
+        -------
+        value: object
+            the cached value.
+        """
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+        """ Cache an entry and evict the least recently used entries if the
+        cache is full.
+
+        Parameters
+        ----------
+        key: hashable
+            the cache key.
+        value: object
+            the value to be cached.
+        """
+        if self.max_items <= 0:
+            return
+        size = 0
+        if self.max_bytes > 0:
+            size = approximate_size(value)
+            if size > self.max_bytes:
+                return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._total_bytes += size
+            while (len(self._entries) > self.max_items or
+                    (self.max_bytes > 0 and
+                     self._total_bytes > self.max_bytes)):
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        """ Remove an entry, the cache lock must be held.
+        """
+        self._entries.pop(key, None)
+        self._total_bytes -= self._sizes.pop(key, 0)
+
+    def delete(self, key):
+        """ Remove a cached entry.
+        """
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        """ Remove all the cached entries.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._total_bytes = 0
+
+
+def get_memory_cache(namespace, max_items, max_bytes=0):
+    """ Get the in-process cache of a feature.
+
+    Parameters
+    ----------
+    namespace: str
+        the cache name.
+    max_items: int
+        the maximum number of cached entries, used when the cache is created.
+    max_bytes: int (optional, default 0)
+        the approximate byte budget of the cached entries, used when the
+        cache is created, 0 for no byte budget.
+
+    Returns
+    -------
+    cache: MemoryLRUCache
+        the shared cache.
+    """
+    with _MEMORY_CACHES_LOCK:
+        cache = _MEMORY_CACHES.get(namespace)
+        if cache is None:
+            cache = MemoryLRUCache(max_items, max_bytes)
+            _MEMORY_CACHES[namespace] = cache
+    return cache
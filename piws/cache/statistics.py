@@ -0,0 +1,115 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2017
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# System import
+import threading
+
+
+# Module level cache of the dashboard statistics
+_STATISTICS = {}
+_STATISTICS_LOCK = threading.Lock()
+
+# Entity types whose creation or deletion changes the statistics
+STATISTICS_ETYPES = ("Study", "Subject", "Assessment", "Scan",
+                     "QuestionnaireRun", "ProcessingRun")
+
+
+def compute_summary_statistics(cnx, categories):
+    """ Compute the database content statistics displayed in the summary
+    box: a fixed number of aggregate requests is executed whatever the
+    number of studies and timepoints.
+
+    Parameters
+    ----------
+    cnx: Connection
+        a connection to the repository.
+    categories: list of str
+        the counted entity types.
+
+    Returns
+    -------
+    statistics: dict
+        for each study, the number of subjects 'nb_subjects', the sorted
+        timepoints 'timepoints', the number of types (or labels for the
+        QuestionnaireRun entities) per category 'nb_types' and the number
+        of entities per category and timepoint 'nb_items'.
+    """
+    # Get the studies and their number of subjects
+    statistics = {}
+    for study, in cnx.execute(
+            "DISTINCT Any SN ORDERBY SN Where S is Study, S name SN"):
+        statistics[study] = {
+            "nb_subjects": 0,
+            "timepoints": [],
+            "nb_types": dict((category, 0) for category in categories),
+            "nb_items": dict((category, {}) for category in categories)}
+    for study, nb_subjects in cnx.execute(
+            "Any SN, COUNT(S) GROUPBY SN Where S is Subject, S study ST, "
+            "ST name SN"):
+        statistics[study]["nb_subjects"] = nb_subjects
+
+    # Get the timepoints of each study
+    for study, timepoint in cnx.execute(
+            "DISTINCT Any SN, T ORDERBY T Where A is Assessment, "
+            "A timepoint T, A study ST, ST name SN"):
+        statistics[study]["timepoints"].append(timepoint)
+
+    # Count the types and the entities of each category
+    for category in categories:
+
+        # Deal with questionnaire special case
+        if category == "QuestionnaireRun":
+            type_name = "label"
+        else:
+            type_name = "type"
+
+        for study, _ in cnx.execute(
+                "DISTINCT Any SN, T Where X is {0}, X {1} T, X study ST, "
+                "ST name SN".format(category, type_name)):
+            statistics[study]["nb_types"][category] += 1
+        for study, timepoint, nb_items in cnx.execute(
+                "Any SN, T, COUNT(X) GROUPBY SN, T Where X is {0}, "
+                "X study ST, ST name SN, X in_assessment A, "
+                "A timepoint T".format(category)):
+            statistics[study]["nb_items"][category][timepoint] = nb_items
+
+    return statistics
+
+
+def get_summary_statistics(repo, categories):
+    """ Get the database content statistics from the process cache, the
+    statistics are computed on first access.
+
+    Parameters
+    ----------
+    repo: Repository
+        the CubicWeb repository.
+    categories: list of str
+        the counted entity types.
+
+    Returns
+    -------
+    statistics: dict
+        see 'compute_summary_statistics'.
+    """
+    key = tuple(categories)
+    statistics = _STATISTICS.get(key)
+    if statistics is None:
+        with repo.internal_cnx() as cnx:
+            statistics = compute_summary_statistics(cnx, categories)
+        with _STATISTICS_LOCK:
+            _STATISTICS[key] = statistics
+    return statistics
+
+
+def clear_summary_statistics():
+    """ Invalidate the cached statistics: they are computed again on next
+    access.
+    """
+    with _STATISTICS_LOCK:
+        _STATISTICS.clear()
@@ -71,6 +71,10 @@
       header: header,
       intensity_min: 0,
       intensity_max: 65535,
+      // Forget the computed slices when the data buffer is filled lazily
+      clearSliceCache: function() {
+        cached_slices = {};
+      },
       slice: function(axis, slice_num, time) {
         slice_num = slice_num === undefined ? volume.position[axis] : slice_num;
         time = time === undefined ? volume.current_time : time;
@@ -0,0 +1,272 @@
+// Lazy BrainBrowser volume loader: the volume header is requested first and
+// an empty volume is created, then only the displayed slices of the three
+// planes and a prefetch window around them are requested, one encoded slice
+// at a time, and copied in the volume buffer.
+function loadLazyBrainBrowserVolume(baseurl, description, quality,
+                                    prefetch, callback) {
+    var nb_parallel = 4;
+    var spaces = ['xspace', 'yspace', 'zspace'];
+    var slice_url = baseurl + 'ajax?fname=get_brainbrowser_slice' +
+        '&imagefile=' + encodeURIComponent(description.data_file) +
+        '&quality=' + quality;
+
+    $.ajax({
+        url: baseurl + 'ajax?fname=get_brainbrowser_header',
+        type: 'GET',
+        data: {'imagefile': description.data_file},
+        dataType: 'json'
+    }).done(function(im_info) {
+        var shape = im_info.shape;
+        var nb_timepoints = shape.length == 4 ? shape[3] : 1;
+        var volume_size = shape[0] * shape[1] * shape[2];
+        var buffer = new ArrayBuffer(nb_timepoints * volume_size * 2);
+
+        // The buffer is (t, x, y, z) ordered: the strides of the two in
+        // plane axes of each slicing axis, in the slice pixel order
+        var strides = [shape[1] * shape[2], shape[2], 1];
+        var plane_axes = [[1, 2], [0, 2], [0, 1]];
+
+        BrainBrowser.parseHeader(im_info.header, function(header) {
+            BrainBrowser.createMincVolume(header, buffer, function(volume) {
+                var requested = {};
+                var queue = [];
+                var nb_running = 0;
+                var redraw_timer = null;
+                var last_position = null;
+
+                // Copy a decoded slice in the volume buffer
+                var fill = function(img, axis, index, timepoint) {
+                    var canvas = document.createElement('canvas');
+                    canvas.width = img.width;
+                    canvas.height = img.height;
+                    var ctx = canvas.getContext('2d');
+                    ctx.drawImage(img, 0, 0);
+                    var pixels = ctx.getImageData(
+                        0, 0, canvas.width, canvas.height).data;
+                    var rows = shape[plane_axes[axis][0]];
+                    var columns = shape[plane_axes[axis][1]];
+                    var row_stride = strides[plane_axes[axis][0]];
+                    var column_stride = strides[plane_axes[axis][1]];
+                    var offset = timepoint * volume_size +
+                        index * strides[axis];
+                    var j = 0;
+                    for (var r = 0; r < rows; r++) {
+                        var position = offset + r * row_stride;
+                        for (var c = 0; c < columns; c++) {
+                            volume.data[position] = pixels[j * 4] * 257;
+                            position += column_stride;
+                            j++;
+                        }
+                    }
+                    volume.clearSliceCache();
+                    if (redraw_timer === null) {
+                        redraw_timer = setTimeout(function() {
+                            redraw_timer = null;
+                            if (window.viewer) {
+                                window.viewer.redrawVolumes();
+                            }
+                        }, 100);
+                    }
+                };
+
+                // Request the queued slices, a few at a time
+                var next = function() {
+                    while (nb_running < nb_parallel && queue.length > 0) {
+                        var item = queue.shift();
+                        nb_running += 1;
+                        (function(axis, index, timepoint) {
+                            var img = new Image();
+                            img.onload = function() {
+                                nb_running -= 1;
+                                fill(img, axis, index, timepoint);
+                                next();
+                            };
+                            img.onerror = function() {
+                                nb_running -= 1;
+                                delete requested[
+                                    timepoint + '-' + axis + '-' + index];
+                                next();
+                            };
+                            img.src = slice_url + '&axis=' + axis +
+                                '&index=' + index + '&timepoint=' + timepoint;
+                        })(item[0], item[1], item[2]);
+                    }
+                };
+
+                // Queue the displayed slices of the three planes and their
+                // prefetch windows, the closest slices first
+                var update = function() {
+                    var timepoint = volume.current_time || 0;
+                    var indices = [];
+                    for (var a = 0; a < 3; a++) {
+                        var index = volume.position[spaces[a]];
+                        if (index === undefined) {
+                            index = Math.floor(shape[a] / 2);
+                        }
+                        indices.push(index);
+                    }
+                    var position = timepoint + '-' + indices.join('-');
+                    if (position === last_position) {
+                        return;
+                    }
+                    last_position = position;
+                    for (var q = 0; q < queue.length; q++) {
+                        delete requested[queue[q][2] + '-' + queue[q][0] +
+                                         '-' + queue[q][1]];
+                    }
+                    queue = [];
+                    for (var d = 0; d <= prefetch; d++) {
+                        for (var axis = 0; axis < 3; axis++) {
+                            var candidates = d == 0 ? [indices[axis]] :
+                                [indices[axis] + d, indices[axis] - d];
+                            for (var k = 0; k < candidates.length; k++) {
+                                var i = candidates[k];
+                                var key = timepoint + '-' + axis + '-' + i;
+                                if (i < 0 || i >= shape[axis] ||
+                                        requested[key]) {
+                                    continue;
+                                }
+                                requested[key] = true;
+                                queue.push([axis, i, timepoint]);
+                            }
+                        }
+                    }
+                    next();
+                };
+
+                // Follow the displayed slices
+                var attached = false;
+                var poller = setInterval(function() {
+                    if (window.viewer &&
+                            window.viewer.volumes.indexOf(volume) >= 0) {
+                        attached = true;
+                    } else if (attached) {
+                        clearInterval(poller);
+                        return;
+                    }
+                    update();
+                }, 250);
+
+                update();
+                callback(volume);
+            });
+        });
+    }).fail(function() {
+        $('#loading').hide();
+        alert('Error : Image buffering failed!');
+    });
+}
+
+
+// Request a binary BrainBrowser volume: the uint16 buffer is received in an
+// ArrayBuffer, the buffer shape in the 'X-Volume-Shape' HTTP header. The
+// volume is requested with GET so that the browser revalidates its cached
+// copy: a '304 Not Modified' answer is served from the browser cache with
+// a 200 status.
+function requestBrainBrowserVolume(baseurl, imagefile, level, done, fail) {
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', baseurl + 'ajax?fname=get_brainbrowser_volume' +
+             '&imagefile=' + encodeURIComponent(imagefile) +
+             '&dtype=uint16&gzip=1&level=' + level, true);
+    xhr.responseType = 'arraybuffer';
+    xhr.onload = function() {
+        if (xhr.status != 200) {
+            fail();
+            return;
+        }
+        done(new Uint16Array(xhr.response),
+             JSON.parse(xhr.getResponseHeader('X-Volume-Shape')));
+    };
+    xhr.onerror = fail;
+    xhr.send();
+}
+
+
+// Copy a downsampled volume in a full resolution buffer with a nearest
+// neighbour interpolation: the shapes are (t, x, y, z) ordered.
+function upsampleBrainBrowserVolume(target, full_shape, source, shape) {
+    var factors = [];
+    for (var a = 1; a < 4; a++) {
+        factors.push(Math.max(1, Math.floor(full_shape[a] / shape[a])));
+    }
+    var index_map = function(axis) {
+        var map = new Int32Array(full_shape[axis + 1]);
+        for (var i = 0; i < map.length; i++) {
+            map[i] = Math.min(Math.floor(i / factors[axis]),
+                              shape[axis + 1] - 1);
+        }
+        return map;
+    };
+    var xmap = index_map(0);
+    var ymap = index_map(1);
+    var zmap = index_map(2);
+    var offset = 0;
+    for (var t = 0; t < full_shape[0]; t++) {
+        for (var x = 0; x < full_shape[1]; x++) {
+            for (var y = 0; y < full_shape[2]; y++) {
+                var row = ((t * shape[1] + xmap[x]) * shape[2] + ymap[y]) *
+                    shape[3];
+                for (var z = 0; z < full_shape[3]; z++) {
+                    target[offset++] = source[row + zmap[z]];
+                }
+            }
+        }
+    }
+}
+
+
+// Progressive BrainBrowser volume loader: the coarsest pyramid level is
+// displayed first, then the volume is refined with the finer levels, the
+// last level being the full resolution volume (level 0).
+function loadPyramidBrainBrowserVolume(baseurl, description, levels,
+                                       callback) {
+    var fail = function() {
+        $('#loading').hide();
+        alert('Error : Image buffering failed!');
+    };
+
+    $.ajax({
+        url: baseurl + 'ajax?fname=get_brainbrowser_header',
+        type: 'GET',
+        data: {'imagefile': description.data_file},
+        dataType: 'json'
+    }).done(function(im_info) {
+        var shape = im_info.shape;
+        var full_shape = [shape.length == 4 ? shape[3] : 1,
+                          shape[0], shape[1], shape[2]];
+        var buffer = new ArrayBuffer(
+            full_shape[0] * full_shape[1] * full_shape[2] * full_shape[3] * 2);
+
+        BrainBrowser.parseHeader(im_info.header, function(header) {
+            BrainBrowser.createMincVolume(header, buffer, function(volume) {
+                var load = function(k) {
+                    if (k >= levels.length) {
+                        return;
+                    }
+                    requestBrainBrowserVolume(
+                        baseurl, description.data_file, levels[k],
+                        function(data, data_shape) {
+                            if (data_shape.length == 3) {
+                                data_shape.unshift(1);
+                            }
+                            if (levels[k] == 0) {
+                                volume.data.set(data);
+                            } else {
+                                upsampleBrainBrowserVolume(
+                                    volume.data, full_shape, data,
+                                    data_shape);
+                            }
+                            volume.clearSliceCache();
+                            if (k == 0) {
+                                callback(volume);
+                            } else if (window.viewer) {
+                                window.viewer.redrawVolumes();
+                            }
+                            load(k + 1);
+                        }, k == 0 ? fail : function() {});
+                };
+                load(0);
+            });
+        });
+    }).fail(fail);
+}
@@ -10,10 +10,16 @@
 # System import
 import os
 import re
+import logging
+import threading
+import collections
 
 # Docutils import
 from docutils.core import publish_parts
 
+# Package import
+from cubes.piws.cache.disk import DiskLRUCache
+
 
 def rst2html(rstfile, site_url):
     """ Create a html documentation from a rst description.
@@ -63,6 +69,114 @@ def create_html_doc(directory, site_url):
     return docmap
 
 
+class DocumentationMap(collections.Mapping):
+    """ A lazy mapping between the expected CW entity labels and the html
+    documentation generated from the rst files of a directory.
+
+    An entry is generated on first access and kept in memory until its rst
+    file is modified. The generated html can also be stored in an on-disk
+    cache keyed by the rst file identity, so that the documentation is
+    shared by the instance processes and survives restarts.
+    """
+    def __init__(self, directory, site_url, cache=None):
+        """ Initialize the DocumentationMap class.
+
+        Parameters
+        ----------
+        directory: str (mandatory)
+            the input documentation directory: where we are looking for rst
+            files.
+        site_url: str (mandatory)
+            the server url.
+        cache: DiskLRUCache (optional, default None)
+            the on-disk cache of the generated html documentation.
+        """
+        self.directory = directory
+        self.site_url = site_url
+        self.cache = cache
+        self._docs = {}
+        self._rstfiles = {}
+        self._directory_mtime = None
+        self._lock = threading.RLock()
+
+    def rstfiles(self):
+        """ List the rst files of the documentation directory, the listing
+        is refreshed when the directory is modified.
+
+        Returns
+        -------
+        rstfiles: dict
+            the rst file of each documentation name.
+        """
+        mtime = os.stat(self.directory).st_mtime
+        if mtime != self._directory_mtime:
+            with self._lock:
+                self._rstfiles = dict(
+                    (rstfile.split(".")[0],
+                     os.path.join(self.directory, rstfile))
+                    for rstfile in os.listdir(self.directory)
+                    if rstfile.endswith(".rst"))
+                self._directory_mtime = mtime
+        return self._rstfiles
+
+    def __getitem__(self, name):
+        """ Get the html documentation of a name, generated on first access
+        or if the rst file has been modified.
+        """
+        rstfile = self.rstfiles()[name]
+        identity = DiskLRUCache.file_identity(rstfile)
+        cached = self._docs.get(name)
+        if cached is not None and cached[0] == identity:
+            return cached[1]
+        with self._lock:
+            doc = None
+            if self.cache is not None:
+                doc_key = DiskLRUCache.make_key(identity, self.site_url)
+                data = self.cache.get(doc_key)
+                if data is not None:
+                    doc = data.decode("utf-8")
+            if doc is None:
+                doc = rst2html(rstfile, self.site_url)
+                if self.cache is not None:
+                    self.cache.set(doc_key, doc.encode("utf-8"))
+            self._docs[name] = (identity, doc)
+        return doc
+
+    def __iter__(self):
+        return iter(self.rstfiles())
+
+    def __len__(self):
+        return len(self.rstfiles())
+
+    def __contains__(self, name):
+        return name in self.rstfiles()
+
+    def prerender(self):
+        """ Generate all the documentation entries: an entry that can't be
+        generated is skipped and will fail on access.
+        """
+        for name in sorted(self.rstfiles()):
+            try:
+                self[name]
+            except Exception:
+                logging.exception(
+                    "Can't generate the '{0}' documentation.".format(name))
+
+    def start_prerender(self):
+        """ Generate all the documentation entries in a background thread.
+
+        Returns
+        -------
+        thread: Thread
+            the started daemon thread.
+        """
+        thread = threading.Thread(target=self.prerender,
+                                  name="piws-documentation")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
 def set_data_url(site_url, doc):
     """ Transform the image source.
 
@@ -16,6 +16,18 @@ from cubes.piws.config import ASSESSMENT_CONTAINER
 from cubes.rql_upload.entities import EntityUploadFile
 
 
+# The symbol of the scans of each data type
+SCAN_DATA_SYMBOLS = {
+    "DMRIData": "images/dmri.png",
+    "FMRIData": "images/fmri.png",
+    "MRIData": "images/mri.png",
+    "PETData": "images/pet.png",
+    "EEGData": "images/eeg.jpg",
+    "ETData": "images/eye-tracking.jpg",
+    "SPECTROData": "images/spectro.png"
+}
+
+
 ##############################################################################
 # Define entities properties
 ##############################################################################
@@ -89,20 +101,7 @@ class Scan(AnyEntity):
     @property
     def symbol(self):
         dtype = self.has_data[0]
-        if dtype.__class__.__name__ == "DMRIData":
-            return "images/dmri.png"
-        elif dtype.__class__.__name__ == "FMRIData":
-            return "images/fmri.png"
-        elif dtype.__class__.__name__ == "MRIData":
-            return "images/mri.png"
-        elif dtype.__class__.__name__ == "PETData":
-            return "images/pet.png"
-        elif dtype.__class__.__name__ == "EEGData":
-            return "images/eeg.jpg"
-        elif dtype.__class__.__name__ == "ETData":
-            return "images/eye-tracking.jpg"
-        elif dtype.__class__.__name__ == "SPECTROData":
-            return "images/spectro.png"
+        return SCAN_DATA_SYMBOLS.get(dtype.__class__.__name__)
 
 
 class Assessment(AnyEntity):
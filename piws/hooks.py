@@ -23,7 +23,13 @@ from logilab.common.decorators import monkeypatch
 
 # PIWS import
 _docutils_initial_cwd = os.getcwd()  # work around docutils bug
-from cubes.piws.docgen.rst2html import create_html_doc
+from cubes.piws.docgen.rst2html import DocumentationMap
+from cubes.piws.metagen.index import clear_gene_prefix_indexes
+from cubes.piws.metagen.resolvers import clear_local_metagen_identifier
+from cubes.piws.cache.memory import get_memory_cache
+from cubes.piws.cache.disk import get_disk_cache
+from cubes.piws.cache.statistics import STATISTICS_ETYPES
+from cubes.piws.cache.statistics import clear_summary_statistics
 
 
 cw_version = version.parse(cubicweb.__version__)
@@ -97,8 +103,10 @@ class CreateDocumentation(hook.Hook):
     def __call__(self):
         """ The documantation is stored in repo.vreg.docmap and thus will
         be accessible in any CW pages.
-        The docmap is a dictionary with the input rst documentation file
-        basenames as keys. The values contain the corresponding html codes.
+        The docmap is a lazy mapping with the input rst documentation file
+        basenames as keys. The values contain the corresponding html codes,
+        generated on first access and cached on disk, or in a background
+        thread if the 'doc-prerender' option is set.
         """
         # Get the data url
         with self.repo.internal_cnx() as cnx:
@@ -117,9 +125,15 @@ class CreateDocumentation(hook.Hook):
         os.chdir(_docutils_initial_cwd)
 
         # Get the documentation
-        doc_folder = self.repo.vreg.config["documentation_folder"]
+        config = self.repo.vreg.config
+        doc_folder = config["documentation_folder"]
         if doc_folder:
-            self.repo.vreg.docmap = create_html_doc(doc_folder, site_url)
+            self.repo.vreg.docmap = DocumentationMap(
+                doc_folder, site_url,
+                cache=get_disk_cache(config, "documentation",
+                                     "doc-cache-size"))
+            if config["doc-prerender"]:
+                self.repo.vreg.docmap.start_prerender()
         else:
             self.repo.vreg.docmap = {}
 
@@ -182,6 +196,251 @@ class PiwsApacheDeauthenticationHook(hook.Hook):
                     cleanup_session_interval, self.repo.apache_clean_sessions)
 
 
+class ClearMetagenIdentifierOp(hook.DataOperationMixIn, hook.Operation):
+    """ Invalidate the local Metagen reference identifier once the
+    transaction is committed, so that a concurrent request can not cache
+    the identifier of uncommitted data.
+    """
+    def postcommit_event(self):
+        clear_local_metagen_identifier()
+
+
+class InvalidateGeneIndexes(hook.Hook):
+    """ Invalidate the in-memory gene prefix indexes and the local Metagen
+    reference identifier when Gene entities are created or deleted: they
+    are rebuilt on next access.
+    """
+    __regid__ = "piws.invalidate_gene_indexes"
+    __select__ = hook.Hook.__select__ & is_instance("Gene")
+    events = ("after_add_entity", "after_delete_entity")
+
+    def __call__(self):
+        clear_gene_prefix_indexes()
+        ClearMetagenIdentifierOp.get_instance(self._cw).add_data(
+            self.entity.eid)
+
+
+class InvalidateMetagenIdentifier(hook.Hook):
+    """ Invalidate the local Metagen reference identifier when Snp entities
+    are created or deleted.
+    """
+    __regid__ = "piws.invalidate_metagen_identifier"
+    __select__ = hook.Hook.__select__ & is_instance("Snp")
+    events = ("after_add_entity", "after_delete_entity")
+
+    def __call__(self):
+        ClearMetagenIdentifierOp.get_instance(self._cw).add_data(
+            self.entity.eid)
+
+
+class ClearTableCacheOp(hook.DataOperationMixIn, hook.Operation):
+    """ Invalidate the DataTables table cache once the transaction is
+    committed, so that a concurrent request can not cache the tables of
+    uncommitted data.
+    """
+    def postcommit_event(self):
+        config = self.cnx.vreg.config
+        get_memory_cache("tables", config["table-cache-size"],
+                         config["table-cache-memory"] * 1024 * 1024).clear()
+
+
+class InvalidateTableCache(hook.Hook):
+    """ Invalidate the DataTables table cache when the tabulated data are
+    modified.
+    """
+    __regid__ = "piws.invalidate_table_cache"
+    __select__ = hook.Hook.__select__ & is_instance(
+        "QuestionnaireRun", "ScoreValue", "File", "RestrictedFile")
+    events = ("after_add_entity", "after_update_entity",
+              "after_delete_entity")
+
+    def __call__(self):
+        ClearTableCacheOp.get_instance(self._cw).add_data(self.entity.eid)
+
+
+class ClearPivotCacheOp(hook.DataOperationMixIn, hook.Operation):
+    """ Invalidate the materialized questionnaire pivot tables once the
+    transaction is committed.
+    """
+    def postcommit_event(self):
+        pivot_cache = get_disk_cache(self.cnx.vreg.config, "pivots",
+                                     "pivot-cache-size")
+        if pivot_cache is not None:
+            pivot_cache.clear()
+
+
+class InvalidatePivotCache(hook.Hook):
+    """ Invalidate the materialized questionnaire pivot tables when the
+    questionnaire runs or their files are modified.
+    """
+    __regid__ = "piws.invalidate_pivot_cache"
+    __select__ = hook.Hook.__select__ & is_instance(
+        "QuestionnaireRun", "File", "RestrictedFile")
+    events = ("after_add_entity", "after_update_entity",
+              "after_delete_entity")
+
+    def __call__(self):
+        ClearPivotCacheOp.get_instance(self._cw).add_data(self.entity.eid)
+
+
+class InvalidatePivotCacheOnRelation(hook.Hook):
+    """ Invalidate the materialized questionnaire pivot tables when a
+    questionnaire run is linked to or unlinked from its file, subject,
+    questionnaire or assessment.
+    """
+    __regid__ = "piws.invalidate_pivot_cache_on_relation"
+    __select__ = hook.Hook.__select__ & hook.match_rtype(
+        "file", "subject", "questionnaire", "in_assessment")
+    events = ("after_add_relation", "after_delete_relation")
+
+    def __call__(self):
+        etype = self._cw.entity_metas(self.eidfrom)["type"]
+        if etype == "QuestionnaireRun":
+            ClearPivotCacheOp.get_instance(self._cw).add_data(self.eidfrom)
+
+
+class ClearSummaryStatisticsOp(hook.DataOperationMixIn, hook.Operation):
+    """ Invalidate the cached database content statistics once the
+    transaction is committed, so that a concurrent rendering can not cache
+    the statistics of uncommitted data.
+    """
+    def postcommit_event(self):
+        clear_summary_statistics()
+
+
+class InvalidateSummaryStatistics(hook.Hook):
+    """ Invalidate the database content statistics displayed on the index
+    page when a counted entity is created or deleted.
+    """
+    __regid__ = "piws.invalidate_summary_statistics"
+    __select__ = hook.Hook.__select__ & is_instance(*STATISTICS_ETYPES)
+    events = ("after_add_entity", "after_delete_entity")
+
+    def __call__(self):
+        ClearSummaryStatisticsOp.get_instance(self._cw).add_data(
+            self.entity.eid)
+
+
+class InvalidateSummaryStatisticsOnUpdate(hook.Hook):
+    """ Invalidate the database content statistics when a counted attribute
+    of an entity is modified.
+    """
+    __regid__ = "piws.invalidate_summary_statistics_on_update"
+    __select__ = hook.Hook.__select__ & is_instance(*STATISTICS_ETYPES)
+    events = ("after_update_entity", )
+    attributes = ("name", "timepoint", "type", "label")
+
+    def __call__(self):
+        if any(attr in self.entity.cw_edited for attr in self.attributes):
+            ClearSummaryStatisticsOp.get_instance(self._cw).add_data(
+                self.entity.eid)
+
+
+class InvalidateSummaryStatisticsOnRelation(hook.Hook):
+    """ Invalidate the database content statistics when the entities are
+    linked to or unlinked from their study, assessment or subjects: the
+    importers set these relations after the entities creation.
+    """
+    __regid__ = "piws.invalidate_summary_statistics_on_relation"
+    __select__ = hook.Hook.__select__ & hook.match_rtype(
+        "study", "in_assessment", "subjects")
+    events = ("after_add_relation", "after_delete_relation")
+
+    def __call__(self):
+        ClearSummaryStatisticsOp.get_instance(self._cw).add_data(
+            self.eidfrom)
+
+
+class ClearNavigationCacheOp(hook.DataOperationMixIn, hook.Operation):
+    """ Invalidate the rendered navigation boxes once the transaction is
+    committed, so that a concurrent rendering can not cache the navigation
+    of uncommitted data.
+    """
+    def postcommit_event(self):
+        nav_cache = get_disk_cache(self.cnx.vreg.config, "navigation",
+                                   "nav-cache-size")
+        if nav_cache is not None:
+            nav_cache.clear()
+
+
+class InvalidateNavigationCache(hook.Hook):
+    """ Invalidate the rendered navigation boxes when the entities listed in
+    the navigation are created, modified or deleted.
+    """
+    __regid__ = "piws.invalidate_navigation_cache"
+    __select__ = hook.Hook.__select__ & is_instance(
+        "Study", "Scan", "QuestionnaireRun", "Questionnaire", "ProcessingRun",
+        "ScoreValue")
+    events = ("after_add_entity", "after_update_entity",
+              "after_delete_entity")
+
+    def __call__(self):
+        ClearNavigationCacheOp.get_instance(self._cw).add_data(
+            self.entity.eid)
+
+
+class InvalidateNavigationCacheOnRelation(hook.Hook):
+    """ Invalidate the rendered navigation boxes when the read permissions
+    or the study and assessment relations of the listed entities change:
+    the navigation depends on what the user groups can read.
+    """
+    __regid__ = "piws.invalidate_navigation_cache_on_relation"
+    __select__ = hook.Hook.__select__ & hook.match_rtype(
+        "can_read", "in_group", "in_assessment", "study")
+    events = ("after_add_relation", "after_delete_relation")
+
+    def __call__(self):
+        ClearNavigationCacheOp.get_instance(self._cw).add_data(self.eidfrom)
+
+
+# The entity types and relations the charts are computed from
+CHART_ETYPES = (
+    "Study", "Subject", "SubjectGroup", "Center", "Assessment", "Scan",
+    "QuestionnaireRun", "Questionnaire", "Question", "IntAnswer",
+    "FloatAnswer", "TextAnswer", "ProcessingRun", "GenomicMeasure",
+    "ScoreValue", "File", "RestrictedFile")
+CHART_RTYPES = (
+    "study", "subjects", "subject", "in_assessment", "assessments", "scans",
+    "questionnaire_runs", "genomic_measures", "processing_runs",
+    "subject_scans", "subject_questionnaire_runs", "subject_processing_runs",
+    "subject_genomic_measures", "questionnaire", "questions", "question",
+    "int_answers", "float_answers", "text_answers", "score_values", "file",
+    "external_files", "can_read")
+
+
+class ClearChartCacheOp(hook.DataOperationMixIn, hook.Operation):
+    """ Invalidate the cached chart data once the transaction is committed.
+    """
+    def postcommit_event(self):
+        get_memory_cache(
+            "charts", self.cnx.vreg.config["chart-cache-size"]).clear()
+
+
+class InvalidateChartCache(hook.Hook):
+    """ Invalidate the cached chart data when the charted entities are
+    created, modified or deleted.
+    """
+    __regid__ = "piws.invalidate_chart_cache"
+    __select__ = hook.Hook.__select__ & is_instance(*CHART_ETYPES)
+    events = ("after_add_entity", "after_update_entity",
+              "after_delete_entity")
+
+    def __call__(self):
+        ClearChartCacheOp.get_instance(self._cw).add_data(self.entity.eid)
+
+
+class InvalidateChartCacheOnRelation(hook.Hook):
+    """ Invalidate the cached chart data when the charted entities are
+    linked or unlinked, or when the read permissions change.
+    """
+    __regid__ = "piws.invalidate_chart_cache_on_relation"
+    __select__ = hook.Hook.__select__ & hook.match_rtype(*CHART_RTYPES)
+    events = ("after_add_relation", "after_delete_relation")
+
+    def __call__(self):
+        ClearChartCacheOp.get_instance(self._cw).add_data(self.eidfrom)
+
+
 class PiwsCWUsersWatcher(hook.Hook):
     """ Sends an email message on CWUser creation/deletion, using all-in-one
     parameters of the [MAIL] section.
@@ -0,0 +1,731 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2017
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# System import
+import os
+import json
+import base64
+import threading
+import multiprocessing
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+import nibabel
+import numpy
+import PIL
+
+# Package import
+from cubes.piws.cache.disk import DiskLRUCache
+from cubes.piws.cache.disk import get_disk_cache
+from cubes.piws.cache.memory import get_memory_cache
+
+
+# The image extensions that can be rendered by BrainBrowser
+IMAGE_EXTENSIONS = (".nii", ".nii.gz")
+
+# The volume data types: numpy little-endian type and maximum value
+VOLUME_DTYPES = {
+    "uint8": ("<u1", 255.),
+    "uint16": ("<u2", 65535.)
+}
+
+# The downsampling factors of the volume pyramid levels
+PYRAMID_FACTORS = (1, 2, 4)
+
+# The maximum number of voxels read at once from an image file and the
+# number of histogram bins used to estimate the intensity percentiles
+SLAB_SIZE = 4194304
+HISTOGRAM_BINS = 4096
+
+# Module level slice encoding thread pool, created on first use, and the
+# encoding buffers of the pool threads
+_ENCODING_POOL = None
+_ENCODING_POOL_LOCK = threading.Lock()
+_ENCODING_BUFFERS = threading.local()
+
+
+def is_brainbrowser_image(path):
+    """ Check if a file can be rendered by BrainBrowser.
+
+    Parameters
+    ----------
+    path: str
+        a file path.
+
+    Returns
+    -------
+    is_image: bool
+        True if the file has a supported image extension.
+    """
+    return path.endswith(IMAGE_EXTENSIONS)
+
+
+def build_brainbrowser_header(header):
+    """ Translate a Nifti header to the BrainBrowser header format.
+
+    Parameters
+    ----------
+    header: Nifti1Header
+        the image header.
+
+    Returns
+    -------
+    bb_header: dict
+        the BrainBrowser header.
+    """
+    dim = header["dim"]
+    order = ["time", "xspace", "yspace", "zspace"]
+    if dim[0] not in (3, 4):
+        raise Exception("Only 3D or 3D + t images are currently supported!")
+    bb_header = {"order": order[1:] if dim[0] == 3 else order}
+    for index, name in enumerate(["x", "y", "z"]):
+        bb_header[name + "space"] = {
+            "start": float(header["qoffset_" + name]),
+            "space_length": int(dim[index + 1]),
+            "step": float(header["pixdim"][index + 1]),
+            "direction_cosines": [
+                float(x) for x in header["srow_" + name][:3]]}
+    if dim[0] == 4:
+        bb_header["time"] = {
+            "start": 0,
+            "space_length": int(dim[4])}
+    return bb_header
+
+
+def get_encoding_pool(nb_threads=0):
+    """ Get the thread pool shared by the slice encoding requests: PIL
+    releases the GIL while encoding, so that the slices of an image are
+    encoded in parallel.
+
+    Parameters
+    ----------
+    nb_threads: int (optional, default 0)
+        the number of threads, used when the pool is created, 0 to use
+        the number of CPUs.
+
+    Returns
+    -------
+    pool: ThreadPool
+        the shared pool.
+    """
+    global _ENCODING_POOL
+    with _ENCODING_POOL_LOCK:
+        if _ENCODING_POOL is None:
+            _ENCODING_POOL = ThreadPool(
+                nb_threads or multiprocessing.cpu_count())
+    return _ENCODING_POOL
+
+
+def save_slice(slicedata, dtype="JPEG", quality=None):
+    """ Encode an image slice in an image format, the encoding buffer of the
+    current thread is reused.
+
+    Parameters
+    ----------
+    slicedata: array
+        the uint8 slice data.
+    dtype: str (optional, default 'JPEG')
+        the PIL image format.
+    quality: int (optional, default None)
+        the encoding quality, None for the PIL default.
+
+    Returns
+    -------
+    contents: str
+        the encoded slice.
+    """
+    openfile = getattr(_ENCODING_BUFFERS, "buffer", None)
+    if openfile is None:
+        openfile = StringIO()
+        _ENCODING_BUFFERS.buffer = openfile
+    openfile.seek(0)
+    openfile.truncate()
+    img = PIL.Image.fromarray(slicedata)
+    if quality is None:
+        img.save(openfile, format=dtype)
+    else:
+        img.save(openfile, format=dtype, quality=quality)
+    return openfile.getvalue()
+
+
+def encode_slice(slicedata, dtype="JPEG", quality=None):
+    """ Encode an image slice in base64.
+
+    Parameters
+    ----------
+    slicedata: array
+        the uint8 slice data.
+    dtype: str (optional, default 'JPEG')
+        the PIL image format.
+    quality: int (optional, default None)
+        the encoding quality, None for the PIL default.
+
+    Returns
+    -------
+    encoded: str
+        the base64 encoded slice.
+    """
+    return base64.b64encode(save_slice(slicedata, dtype, quality))
+
+
+def encode_image(imagefile, quality, dtype="JPEG", nb_threads=0,
+                 data_range=None):
+    """ Encode the slices of an image along its first axis, for each
+    timepoint of 4D images.
+
+    Parameters
+    ----------
+    imagefile: str
+        the Nifti image path.
+    quality: int
+        the encoding quality.
+    dtype: str (optional, default 'JPEG')
+        the PIL image format.
+    nb_threads: int (optional, default 0)
+        the size of the shared encoding thread pool, 0 to use the number of
+        CPUs.
+    data_range: 2-uplet (optional, default None)
+        the intensities mapped to the slice dynamic, None to use the image
+        minimum and maximum intensities.
+
+    Returns
+    -------
+    header: dict
+        the BrainBrowser header.
+    encoded_data: list of str
+        the base64 encoded slices.
+    """
+    # Load the image header
+    im = nibabel.load(imagefile)
+    header = build_brainbrowser_header(im.get_header())
+
+    # Change the dynamic of the image intensities slab by slab
+    if data_range is None:
+        data_range = get_intensity_range(None, imagefile)
+    data = rescale_image(imagefile, data_range, dtype="uint8")
+
+    # Encode the slice image data in parallel: for 4D images the slices are
+    # ordered by timepoint
+    if data.ndim == 3:
+        slices = (data[index] for index in range(data.shape[0]))
+    else:
+        slices = (data[timepoint, index]
+                  for timepoint in range(data.shape[0])
+                  for index in range(data.shape[1]))
+    pool = get_encoding_pool(nb_threads)
+    encoded_data = pool.map(
+        lambda slicedata: encode_slice(slicedata, dtype=dtype,
+                                       quality=quality),
+        list(slices))
+
+    return header, encoded_data
+
+
+def get_encoded_image(config, imagefile, quality):
+    """ Get the encoded slices of an image from the on-disk slice cache,
+    the slices are encoded along the first axis and cached on first access.
+
+    The cache key depends on the file path, size and modification time,
+    the quality and the intensity range: a modified image is encoded again.
+
+    Parameters
+    ----------
+    config: CubicWebConfiguration
+        the instance configuration: the 'slice-cache-size' option defines
+        the cache byte budget.
+    imagefile: str
+        the Nifti image path.
+    quality: int
+        the encoding quality.
+
+    Returns
+    -------
+    header: dict
+        the BrainBrowser header.
+    encoded_data: list of str
+        the base64 encoded slices.
+    """
+    nb_threads = config["image-encoding-threads"]
+    data_range = get_intensity_range(config, imagefile)
+    slice_cache = get_disk_cache(config, "slices", "slice-cache-size")
+    if slice_cache is None:
+        return encode_image(imagefile, quality, nb_threads=nb_threads,
+                            data_range=data_range)
+    slice_key = DiskLRUCache.make_key(
+        DiskLRUCache.file_identity(imagefile), quality, data_range)
+    data = slice_cache.get(slice_key)
+    if data is not None:
+        header, encoded_data = json.loads(data)
+    else:
+        header, encoded_data = encode_image(imagefile, quality,
+                                            nb_threads=nb_threads,
+                                            data_range=data_range)
+        slice_cache.set(slice_key, json.dumps([header, encoded_data]))
+    return header, encoded_data
+
+
+def iter_slabs(im, slab_size=SLAB_SIZE):
+    """ Read an image slab by slab through the nibabel array proxy, so that
+    the image is never loaded at once: the slabs are contiguous ranges of
+    the last spatial axis, for each timepoint of 4D images. Nifti data are
+    stored in Fortran order, so each slab is a contiguous read from the
+    file.
+
+    Parameters
+    ----------
+    im: Nifti1Image
+        the image.
+    slab_size: int (optional, default SLAB_SIZE)
+        the maximum number of voxels of a slab.
+
+    Returns
+    -------
+    slabs: generator of 2-uplet
+        the slab location in the (t, x, y, z) ordered image and the float32
+        slab data.
+    """
+    shape = im.shape
+    if len(shape) not in (3, 4):
+        raise Exception("Only 3D or 3D + t images are currently supported!")
+    step = max(1, slab_size // (shape[0] * shape[1]))
+    timepoints = range(shape[3]) if len(shape) == 4 else [None]
+    for timepoint in timepoints:
+        for start in range(0, shape[2], step):
+            zslice = slice(start, min(start + step, shape[2]))
+            if timepoint is None:
+                location = (Ellipsis, zslice)
+                slab = im.dataobj[:, :, zslice]
+            else:
+                location = (timepoint, Ellipsis, zslice)
+                slab = im.dataobj[:, :, zslice, timepoint]
+            yield location, numpy.asarray(slab, dtype=numpy.float32)
+
+
+def compute_intensity_statistics(imagefile, bins=HISTOGRAM_BINS):
+    """ Compute the intensity statistics of an image in two streaming
+    passes: the minimum and maximum intensities first, then an intensity
+    histogram from which the 1st and 99th percentiles are estimated.
+
+    Non finite intensities are ignored.
+
+    Parameters
+    ----------
+    imagefile: str
+        the Nifti image path.
+    bins: int (optional, default HISTOGRAM_BINS)
+        the number of histogram bins, that defines the percentile precision.
+
+    Returns
+    -------
+    statistics: dict
+        the 'min', 'max', 'p1' and 'p99' intensities.
+    """
+    # Get the intensity range
+    im = nibabel.load(imagefile)
+    data_min, data_max = None, None
+    for _, slab in iter_slabs(im):
+        slab = slab[numpy.isfinite(slab)]
+        if slab.size == 0:
+            continue
+        slab_min, slab_max = float(slab.min()), float(slab.max())
+        if data_min is None or slab_min < data_min:
+            data_min = slab_min
+        if data_max is None or slab_max > data_max:
+            data_max = slab_max
+    if data_min is None:
+        data_min, data_max = 0., 0.
+    statistics = {"min": data_min, "max": data_max,
+                  "p1": data_min, "p99": data_max}
+    if data_max <= data_min:
+        return statistics
+
+    # Estimate the percentiles from the cumulative histogram
+    histogram = numpy.zeros(bins, dtype=numpy.int64)
+    for _, slab in iter_slabs(im):
+        slab = slab[numpy.isfinite(slab)]
+        histogram += numpy.histogram(slab, bins=bins,
+                                     range=(data_min, data_max))[0]
+    cumulative = numpy.cumsum(histogram)
+    width = (data_max - data_min) / bins
+    for name, ratio in (("p1", 0.01), ("p99", 0.99)):
+        index = int(numpy.searchsorted(cumulative, ratio * cumulative[-1]))
+        statistics[name] = data_min + (index + 1) * width
+    statistics["p99"] = min(statistics["p99"], data_max)
+
+    return statistics
+
+
+def get_intensity_statistics(config, imagefile):
+    """ Get the intensity statistics of an image, computed on first access
+    and cached in memory and in the on-disk slice cache by file identity.
+
+    Parameters
+    ----------
+    config: CubicWebConfiguration
+        the instance configuration, None to use the memory cache only.
+    imagefile: str
+        the Nifti image path.
+
+    Returns
+    -------
+    statistics: dict
+        see 'compute_intensity_statistics'.
+    """
+    statistics_cache = get_memory_cache("image-statistics", 1000)
+    statistics_key = DiskLRUCache.make_key(
+        "statistics", DiskLRUCache.file_identity(imagefile))
+    statistics = statistics_cache.get(statistics_key)
+    if statistics is not None:
+        return statistics
+    slice_cache = None
+    if config is not None:
+        slice_cache = get_disk_cache(config, "slices", "slice-cache-size")
+    if slice_cache is not None:
+        data = slice_cache.get(statistics_key)
+        if data is not None:
+            statistics = json.loads(data)
+    if statistics is None:
+        statistics = compute_intensity_statistics(imagefile)
+        if slice_cache is not None:
+            slice_cache.set(statistics_key, json.dumps(statistics))
+    statistics_cache.set(statistics_key, statistics)
+    return statistics
+
+
+def get_intensity_range(config, imagefile):
+    """ Get the intensity range of an image mapped to the viewer dynamic.
+
+    Parameters
+    ----------
+    config: CubicWebConfiguration
+        the instance configuration: the 'image-normalization' option
+        selects the minimum and maximum intensities or the robust 1st and
+        99th percentiles. If None, the minimum and maximum intensities are
+        used.
+    imagefile: str
+        the Nifti image path.
+
+    Returns
+    -------
+    data_range: 2-uplet
+        the lower and upper intensities.
+    """
+    statistics = get_intensity_statistics(config, imagefile)
+    if config is not None and config["image-normalization"] == "percentile":
+        return statistics["p1"], statistics["p99"]
+    return statistics["min"], statistics["max"]
+
+
+def rescale_slab(slab, data_range, max_value):
+    """ Rescale a float32 slab in place, the intensities outside the range
+    are clipped.
+
+    Parameters
+    ----------
+    slab: array
+        the float32 slab.
+    data_range: 2-uplet
+        the intensities mapped to 0 and to the maximum value.
+    max_value: float
+        the maximum value of the output data type.
+
+    Returns
+    -------
+    slab: array
+        the rescaled slab.
+    """
+    data_min, data_max = data_range
+    scale = max_value / (data_max - data_min) if data_max > data_min else 0.
+    slab -= data_min
+    slab *= scale
+    numpy.clip(slab, 0., max_value, out=slab)
+    return slab
+
+
+def rescale_image(imagefile, data_range, dtype="uint16"):
+    """ Rescale the intensities of an image slab by slab into the output
+    data type: the peak memory is the output array plus one float32 slab.
+
+    Parameters
+    ----------
+    imagefile: str
+        the Nifti image path.
+    data_range: 2-uplet
+        the intensities mapped to the output data type range.
+    dtype: str (optional, default 'uint16')
+        the output data type, a 'VOLUME_DTYPES' key.
+
+    Returns
+    -------
+    data: array
+        the rescaled image, (t, x, y, z) ordered for 4D images.
+    """
+    im = nibabel.load(imagefile)
+    np_dtype, max_value = VOLUME_DTYPES[dtype]
+    shape = im.shape
+    if len(shape) == 4:
+        shape = (shape[3], ) + shape[:3]
+    data = numpy.empty(shape, dtype=np_dtype)
+    for location, slab in iter_slabs(im):
+        data[location] = rescale_slab(slab, data_range, max_value)
+    return data
+
+
+def read_slice(imagefile, axis=0, index=0, timepoint=0):
+    """ Read one slice of an image: only the requested slab is read from
+    the file through the nibabel array proxy.
+
+    Parameters
+    ----------
+    imagefile: str
+        the Nifti image path.
+    axis: int (optional, default 0)
+        the slicing axis, in [0, 1, 2].
+    index: int (optional, default 0)
+        the slice index along the axis.
+    timepoint: int (optional, default 0)
+        the volume index of 4D images.
+
+    Returns
+    -------
+    slicedata: array
+        the 2D slice.
+    """
+    im = nibabel.load(imagefile)
+    shape = im.shape
+    if len(shape) not in (3, 4):
+        raise Exception("Only 3D or 3D + t images are currently supported!")
+    if axis not in (0, 1, 2) or not 0 <= index < shape[axis]:
+        raise ValueError("Slice {0} along axis {1} is out of the image "
+                         "bounds {2}.".format(index, axis, shape))
+    slicer = [slice(None)] * len(shape)
+    slicer[axis] = index
+    if len(shape) == 4:
+        if not 0 <= timepoint < shape[3]:
+            raise ValueError("Timepoint {0} is out of the image bounds "
+                             "{1}.".format(timepoint, shape))
+        slicer[3] = timepoint
+    return numpy.asarray(im.dataobj[tuple(slicer)])
+
+
+def encode_image_slice(config, imagefile, axis, index, timepoint, quality,
+                       dtype="JPEG"):
+    """ Get one encoded slice of an image, the slices are encoded on demand
+    and cached in the on-disk slice cache.
+
+    The slice intensities are rescaled with the whole image intensity
+    range, so that the slices of an image share the same dynamic.
+
+    Parameters
+    ----------
+    config: CubicWebConfiguration
+        the instance configuration.
+    imagefile: str
+        the Nifti image path.
+    axis: int
+        the slicing axis, in [0, 1, 2].
+    index: int
+        the slice index along the axis.
+    timepoint: int
+        the volume index of 4D images.
+    quality: int
+        the encoding quality.
+    dtype: str (optional, default 'JPEG')
+        the PIL image format.
+
+    Returns
+    -------
+    contents: str
+        the encoded slice.
+    """
+    # Check the cache
+    data_range = get_intensity_range(config, imagefile)
+    slice_cache = get_disk_cache(config, "slices", "slice-cache-size")
+    if slice_cache is not None:
+        slice_key = DiskLRUCache.make_key(
+            DiskLRUCache.file_identity(imagefile), quality, axis, index,
+            timepoint, dtype, data_range)
+        contents = slice_cache.get(slice_key)
+        if contents is not None:
+            return contents
+
+    # Read and rescale the slice
+    slicedata = numpy.asarray(read_slice(imagefile, axis, index, timepoint),
+                              dtype=numpy.float32)
+    slicedata = rescale_slab(slicedata, data_range, 255.).astype(numpy.uint8)
+
+    # Encode the slice
+    contents = save_slice(slicedata, dtype=dtype, quality=quality)
+    if slice_cache is not None:
+        slice_cache.set(slice_key, contents)
+
+    return contents
+
+
+def downsample_volume(volume, factors):
+    """ Downsample a 3D volume by block averaging.
+
+    Parameters
+    ----------
+    volume: array
+        the 3D volume.
+    factors: list of int
+        the downsampling factor of each axis, the trailing voxels that do
+        not fill a block are dropped.
+
+    Returns
+    -------
+    downsampled: array
+        the float32 downsampled volume.
+    """
+    shape = [dim // factor for dim, factor in zip(volume.shape, factors)]
+    blocks = numpy.asarray(volume[:shape[0] * factors[0],
+                                  :shape[1] * factors[1],
+                                  :shape[2] * factors[2]], dtype=numpy.float32)
+    blocks = blocks.reshape(shape[0], factors[0], shape[1], factors[1],
+                            shape[2], factors[2])
+    return blocks.mean(axis=(1, 3, 5))
+
+
+def build_pyramid_level(imagefile, level, dtype="uint16", data_range=None):
+    """ Build a downsampled version of an image for BrainBrowser: the image
+    is read volume by volume through the nibabel array proxy and each
+    volume is downsampled by block averaging.
+
+    Parameters
+    ----------
+    imagefile: str
+        the Nifti image path.
+    level: int
+        the pyramid level, the index of the downsampling factor in
+        'PYRAMID_FACTORS'.
+    dtype: str (optional, default 'uint16')
+        the volume data type, a 'VOLUME_DTYPES' key.
+    data_range: 2-uplet (optional, default None)
+        the intensities mapped to the volume data type range, None to use
+        the image minimum and maximum intensities.
+
+    Returns
+    -------
+    header: dict
+        the BrainBrowser header of the downsampled volume.
+    data: array
+        the rescaled downsampled volume, (t, x, y, z) ordered for 4D images.
+    """
+    # Load the image
+    im = nibabel.load(imagefile)
+    header = build_brainbrowser_header(im.get_header())
+    factors = [min(PYRAMID_FACTORS[level], dim) for dim in im.shape[:3]]
+    if len(im.shape) == 4:
+        volumes = (im.dataobj[..., timepoint]
+                   for timepoint in range(im.shape[3]))
+    else:
+        volumes = [im.dataobj[...]]
+
+    # Downsample and rescale the volumes with the image intensity range
+    np_dtype, max_value = VOLUME_DTYPES[dtype]
+    if data_range is None:
+        data_range = get_intensity_range(None, imagefile)
+    data = numpy.array([
+        rescale_slab(downsample_volume(volume, factors), data_range,
+                     max_value).astype(np_dtype) for volume in volumes])
+    if len(im.shape) == 3:
+        data = data[0]
+
+    # Update the header: the voxels are larger and the first voxel center
+    # moves to the center of the first block
+    for name, factor, length in zip(["xspace", "yspace", "zspace"], factors,
+                                    data.shape[-3:]):
+        space = header[name]
+        space["start"] += (factor - 1) * space["step"] / 2.
+        space["step"] *= factor
+        space["space_length"] = int(length)
+
+    return header, data
+
+
+def get_pyramid_level(config, imagefile, level, dtype="uint16"):
+    """ Get a downsampled version of an image from the on-disk pyramid
+    cache, the levels are built and cached on first access.
+
+    Parameters
+    ----------
+    config: CubicWebConfiguration
+        the instance configuration: the 'pyramid-cache-size' option defines
+        the cache byte budget.
+    imagefile: str
+        the Nifti image path.
+    level: int
+        the pyramid level, the index of the downsampling factor in
+        'PYRAMID_FACTORS'.
+    dtype: str (optional, default 'uint16')
+        the volume data type, a 'VOLUME_DTYPES' key.
+
+    Returns
+    -------
+    header: dict
+        the BrainBrowser header of the downsampled volume.
+    data: array
+        the rescaled downsampled volume.
+    """
+    data_range = get_intensity_range(config, imagefile)
+    pyramid_cache = get_disk_cache(config, "pyramids", "pyramid-cache-size")
+    if pyramid_cache is None:
+        return build_pyramid_level(imagefile, level, dtype, data_range)
+    pyramid_key = DiskLRUCache.make_key(
+        DiskLRUCache.file_identity(imagefile), level, dtype, data_range)
+    cached = pyramid_cache.get(pyramid_key)
+    if cached is not None:
+        description, raw = cached.split("\n", 1)
+        header, shape = json.loads(description)
+        data = numpy.frombuffer(raw, dtype=VOLUME_DTYPES[dtype][0]).reshape(
+            shape)
+    else:
+        header, data = build_pyramid_level(imagefile, level, dtype,
+                                           data_range)
+        data = numpy.ascontiguousarray(data)
+        pyramid_cache.set(pyramid_key, json.dumps(
+            [header, list(data.shape)]) + "\n" + data.tostring())
+    return header, data
+
+
+def warm_slice_cache(config, imagefiles, quality=50, verbose=False):
+    """ Encode and cache the slices of images, so that the viewers open
+    instantly.
+
+    Parameters
+    ----------
+    config: CubicWebConfiguration
+        the instance configuration.
+    imagefiles: list of str
+        the image paths, the files that can not be rendered by BrainBrowser
+        are ignored.
+    quality: int (optional, default 50)
+        the encoding quality, the viewer default.
+    verbose: bool (optional, default False)
+        if True, print the files that can not be encoded.
+
+    Returns
+    -------
+    nb_images: int
+        the number of cached images.
+    """
+    if get_disk_cache(config, "slices", "slice-cache-size") is None:
+        return 0
+    nb_images = 0
+    for imagefile in imagefiles:
+        if not is_brainbrowser_image(imagefile) or not os.path.isfile(
+                imagefile):
+            continue
+        try:
+            get_encoded_image(config, imagefile, quality)
+        except Exception as e:
+            if verbose:
+                print("Can't encode '{0}': {1}".format(imagefile, e))
+            continue
+        nb_images += 1
+    return nb_images
@@ -17,6 +17,10 @@ from .base import Base
 # Brainomics2 import
 from cubes.brainomics2.schema.neuroimaging import SCAN_DATA
 
+# Package import
+from cubes.piws.imaging.brainbrowser import is_brainbrowser_image
+from cubes.piws.imaging.brainbrowser import warm_slice_cache
+
 
 class Scans(Base):
     """ This class enables us to load the scan data to CW.
@@ -46,7 +50,8 @@ class Scans(Base):
 
     def __init__(self, session, project_name, center_name, scans,
                  can_read=True, can_update=False, data_filepath=None,
-                 store_type="RQL", piws_security_model=True):
+                 store_type="RQL", piws_security_model=True,
+                 warm_slice_cache=False):
         """ Initialize the Scans class.
 
         Parameters
@@ -74,6 +79,10 @@ class Scans(Base):
             to use MassiveObjectStore.
         piws_security_model: bool (optional, default True)
             if True apply the PIWS security model.
+        warm_slice_cache: bool (optional, default False)
+            if True, encode the slices of the imported images in the image
+            viewer slice cache at the end of the import (see
+            'warm_slice_cache').
 
         Notes
         -----
@@ -148,8 +157,11 @@ class Scans(Base):
         self.project_name = project_name
         self.center_name = center_name
 
+        self.warm_slice_cache_after_import = warm_slice_cache
+
         # Speed up parameters
         self.inserted_scans = {}
+        self.imagefiles = []
 
     ###########################################################################
     #   Public Methods
@@ -323,6 +335,27 @@ class Scans(Base):
 
         print  # new line after last progress bar update
 
+        # Encode the imported images for the image viewer
+        if self.warm_slice_cache_after_import:
+            self.warm_slice_cache()
+
+    def warm_slice_cache(self, quality=50):
+        """ Encode the slices of the imported images in the image viewer
+        slice cache, so that the viewers open instantly.
+
+        Parameters
+        ----------
+        quality: int (optional, default 50)
+            the encoding quality, the viewer default.
+
+        Returns
+        -------
+        nb_images: int
+            the number of cached images.
+        """
+        return warm_slice_cache(self.session.vreg.config, self.imagefiles,
+                                quality=quality, verbose=True)
+
     def _create_scan(self, scan_struct, scantype_struct, fset_struct, extfiles,
                      scores, subject_eid, study_eid, assessment_eid):
         """ Create a scans and its associated relations.
@@ -358,6 +391,9 @@ class Scans(Base):
 
             # Add the file set attached to a scan entity
             self._import_file_set(fset_struct, extfiles, scan_eid, assessment_eid)
+            self.imagefiles.extend(
+                extfile_struct["filepath"] for extfile_struct in extfiles
+                if is_brainbrowser_image(extfile_struct["filepath"]))
 
             # Specialize the scan: set the data type
             if "type" in scantype_struct:
@@ -6,13 +6,27 @@
 # for details.
 ##########################################################################
 
+import os
+import io
+import json
+import math
 from collections import namedtuple
+from collections import OrderedDict
 
+import numpy
 from pysnptools.snpreader import Bed
+from pysnptools.snpreader import SnpData
 from cwbrowser.cw_connection import CWInstanceConnection
 
+from cubes.piws.cache.disk import DiskLRUCache
+
 
 DEFAULT_METAGEN_URL = "http://mart.intra.cea.fr/metagen_hg38_dbsnp149"
+GENOTYPE_CHUNK_AXES = ("subject", "snp")
+GENOTYPE_ENCODINGS = ("csv", "ndjson", "int8")
+GENOTYPE_SUMMARY_LABELS = ["rs_id", "group", "maf", "call_rate",
+                           "hwe_pvalue", "count_0", "count_1", "count_2",
+                           "count_missing"]
 
 
 def get_genes(metagen_connection=None,
@@ -228,6 +242,51 @@ def metagen_get_meta_of_snps(snp_ids,
     return meta_of_snp
 
 
+def open_plink_bed_bim_fam_dataset(path_dataset, snp_ids=None,
+                                   subject_ids=None, count_A1=True):
+    """
+    Open a Plink bed/bim/fam dataset without loading the genotypes.
+    Optionnally a specific list of snps or subjects can be selected.
+
+    Parameters
+    ----------
+    path_dataset: str
+        Path to the Plink bed/bim/fam dataset, with or without .bed extension.
+    snp_ids: list/set of str, default None
+        Snps that should be selected if available in the dataset.
+        By default None, all snps are selected.
+    subject_ids: list of str, default None
+        Subjects that should be selected if available in the dataset.
+        By default None, all subjects are selected.
+    count_A1: bool, default True
+        Genotypes are provided as allele counts, A1 if True else A2.
+
+    Return
+    ------
+    snp_reader: pysnptools object
+        PLINK reader restricted to the requested snps and subjects: only the
+        metadata are loaded.
+    """
+
+    # Load the metadata, without loading the genotypes
+    snp_reader = Bed(path_dataset, count_A1=count_A1)
+
+    # If requested, filter on snp ids
+    if snp_ids is not None:
+        snp_ids = set(snp_ids)
+        snp_bool_indexes = [(s in snp_ids) for s in snp_reader.sid]
+        snp_reader = snp_reader[:, snp_bool_indexes]
+
+    # If requested, filter on subject ids
+    if subject_ids is not None:
+        subject_ids = set(subject_ids)
+        subject_bool_indexes = [(s in subject_ids)
+                                for s in snp_reader.iid[:, 1]]
+        snp_reader = snp_reader[subject_bool_indexes, :]
+
+    return snp_reader
+
+
 def load_plink_bed_bim_fam_dataset(path_dataset, snp_ids=None,
                                    subject_ids=None, count_A1=True):
     """
@@ -254,36 +313,268 @@ def load_plink_bed_bim_fam_dataset(path_dataset, snp_ids=None,
         PLINK data loaded by the 'pysnptools' library.
     """
 
-    # Load the metadata, without loading the genotypes
-    snp_data = Bed(path_dataset, count_A1=count_A1)
-
-    # If requested, filter on snp ids
-    if snp_ids is not None:
-        snp_ids = set(snp_ids)
-        snp_bool_indexes = [(s in snp_ids) for s in snp_data.sid]
-        snp_data = snp_data[:, snp_bool_indexes]
-
-    # If requested, filter on subject ids
-    if subject_ids is not None:
-        subject_ids = set(subject_ids)
-        subject_bool_indexes = [(s in subject_ids) for s in snp_data.iid[:, 1]]
-        snp_data = snp_data[subject_bool_indexes, :]
+    # Select the requested snps and subjects
+    snp_reader = open_plink_bed_bim_fam_dataset(
+        path_dataset=path_dataset, snp_ids=snp_ids, subject_ids=subject_ids,
+        count_A1=count_A1)
 
     # Load the genotypes from the Plink dataset
-    snp_data = snp_data.read()
+    snp_data = snp_reader.read()
 
     return snp_data
 
 
+def iter_plink_genotype_chunks(snp_reader, chunk_size=1000, axis="subject"):
+    """
+    Read the genotypes of a Plink dataset chunk by chunk, so that only
+    'chunk_size' subjects (or snps) are in memory at a time.
+
+    Parameters
+    ----------
+    snp_reader: pysnptools object
+        PLINK reader as returned by 'open_plink_bed_bim_fam_dataset'.
+    chunk_size: int, default 1000
+        Number of subjects (or snps) read from the .bed file at a time.
+    axis: str, default 'subject'
+        Read the genotypes by chunks of 'subject' or 'snp'.
+
+    Return
+    ------
+    chunks: generator of pysnptools object
+        PLINK data chunks loaded by the 'pysnptools' library.
+    """
+    if axis not in GENOTYPE_CHUNK_AXES:
+        raise ValueError("'{0}' axis not supported, expect one of "
+                         "{1}.".format(axis, GENOTYPE_CHUNK_AXES))
+    if axis == "subject":
+        count = snp_reader.iid_count
+    else:
+        count = snp_reader.sid_count
+    for start in range(0, count, chunk_size):
+        if axis == "subject":
+            chunk = snp_reader[start: start + chunk_size, :]
+        else:
+            chunk = snp_reader[:, start: start + chunk_size]
+        yield chunk.read(dtype=numpy.float32)
+
+
+def encode_genotype_chunks(snp_reader, chunks, encoding="csv",
+                           axis="subject"):
+    """
+    Encode genotype chunks in a compact text or binary format.
+
+    The header is emitted first, then the genotype rows as they are read:
+    one row per subject if 'axis' is 'subject', one row per snp otherwise.
+
+    - 'csv': the header line contains the column names and each row contains
+      the row identifiers followed by the allele counts, missing values are
+      left empty.
+    - 'ndjson': the first line is a JSON header, then each line is a JSON
+      object with the row identifiers and the allele counts, missing values
+      are set to null.
+    - 'int8': the first line is a JSON header, then the allele counts are
+      written as raw int8 bytes, row by row, missing values are set to -1.
+
+    Parameters
+    ----------
+    snp_reader: pysnptools object
+        PLINK reader used to generate the chunks.
+    chunks: iterable of pysnptools object
+        PLINK data chunks as returned by 'iter_plink_genotype_chunks'.
+    encoding: str, default 'csv'
+        The output encoding: 'csv', 'ndjson' or 'int8'.
+    axis: str, default 'subject'
+        The axis used to generate the chunks: 'subject' or 'snp'.
+
+    Return
+    ------
+    encoded: generator of str
+        The encoded header and rows.
+    """
+    if encoding not in GENOTYPE_ENCODINGS:
+        raise ValueError("'{0}' encoding not supported, expect one of "
+                         "{1}.".format(encoding, GENOTYPE_ENCODINGS))
+
+    # Emit the header
+    if encoding == "csv":
+        if axis == "subject":
+            labels = ["family_id", "subject_id"] + snp_reader.sid.tolist()
+        else:
+            labels = ["rs_id"] + snp_reader.iid[:, 1].tolist()
+        yield ",".join(labels) + "\n"
+    else:
+        header = {
+            "axis": axis,
+            "shape": [int(snp_reader.iid_count), int(snp_reader.sid_count)]}
+        if axis == "subject":
+            header["sid"] = snp_reader.sid.tolist()
+        else:
+            header["iid"] = snp_reader.iid.tolist()
+        if encoding == "int8":
+            header["dtype"] = "int8"
+            header["missing"] = -1
+        yield json.dumps(header) + "\n"
+
+    # Emit the genotype rows
+    cells = numpy.array(["", "0", "1", "2"])
+    for snp_data in chunks:
+        values = int8_genotypes(snp_data.val)
+        if axis == "subject":
+            names = snp_data.iid.tolist()
+        else:
+            names = snp_data.sid.tolist()
+            values = values.T
+        if encoding == "int8":
+            yield numpy.ascontiguousarray(values).tostring()
+        elif encoding == "csv":
+            # Vectorized formatting: -1, 0, 1, 2 -> '', '0', '1', '2'
+            rows = cells[values.astype(numpy.intp) + 1]
+            yield "".join(
+                ",".join(([name] if axis == "snp" else name) + row.tolist()) +
+                "\n" for name, row in zip(names, rows))
+        else:
+            lines = []
+            for name, row in zip(names, values.tolist()):
+                record = {"genotypes": [None if v < 0 else v for v in row]}
+                if axis == "subject":
+                    record["family_id"], record["subject_id"] = name
+                else:
+                    record["rs_id"] = name
+                lines.append(json.dumps(record))
+            yield "\n".join(lines) + "\n"
+
+
+def int8_genotypes(values):
+    """
+    Convert float allele counts to a compact int8 matrix.
+
+    Parameters
+    ----------
+    values: array
+        Allele counts as returned by 'pysnptools', missing values are NaN.
+
+    Return
+    ------
+    values: array of int8
+        Allele counts, missing values are set to -1.
+    """
+    return numpy.where(numpy.isnan(values), -1, values).astype(numpy.int8)
+
+
+def genotype_summary_statistics(snp_reader, subject_groups=None,
+                                chunk_size=1000):
+    """
+    Compute per-snp summary statistics from a Plink dataset: minor allele
+    frequency, call rate, Hardy-Weinberg equilibrium p-value and genotype
+    counts. The genotypes are read by chunks of snps and the statistics are
+    computed in a vectorized way on each chunk, so that the subject x snp
+    matrix is never fully loaded.
+
+    Parameters
+    ----------
+    snp_reader: pysnptools object
+        PLINK reader as returned by 'open_plink_bed_bim_fam_dataset'.
+    subject_groups: dict, default None
+        Stratify the statistics: map a group name to a list of subject ids.
+        By default None, the statistics are computed on all subjects.
+    chunk_size: int, default 1000
+        Number of snps read from the .bed file at a time.
+
+    Return
+    ------
+    labels: list of str
+        The statistics names, see 'GENOTYPE_SUMMARY_LABELS'.
+    records: list of list
+        One record per snp and per group, undefined statistics are set to
+        None.
+    """
+    # Define the subject masks of each group
+    subject_ids = snp_reader.iid[:, 1]
+    if subject_groups is None:
+        subject_groups = OrderedDict([
+            ("all", subject_ids.tolist())])
+    masks = []
+    for name, members in subject_groups.items():
+        masks.append((name, numpy.in1d(subject_ids, list(members))))
+
+    # Compute the statistics chunk by chunk
+    records = []
+    for snp_data in iter_plink_genotype_chunks(snp_reader,
+                                               chunk_size=chunk_size,
+                                               axis="snp"):
+        rs_ids = snp_data.sid.tolist()
+        for name, mask in masks:
+            stats = genotype_statistics(snp_data.val[mask])
+            for rs_id, row in zip(rs_ids, stats):
+                records.append([rs_id, name] + row)
+
+    return GENOTYPE_SUMMARY_LABELS[:], records
+
+
+def genotype_statistics(values):
+    """
+    Compute per-snp genotype statistics.
+
+    The Hardy-Weinberg equilibrium p-value is computed from a chi-square
+    test with one degree of freedom. Allele frequencies are expressed for
+    the counted allele and folded to get the minor allele frequency.
+
+    Parameters
+    ----------
+    values: array (n_subjects, n_snps)
+        Allele counts as returned by 'pysnptools', missing values are NaN.
+
+    Return
+    ------
+    stats: list of list
+        For each snp: the minor allele frequency, the call rate, the HWE
+        p-value, the 0/1/2 genotype counts and the number of missing
+        genotypes. Undefined statistics are set to None.
+    """
+    nb_subjects = values.shape[0]
+    counts = numpy.array([(values == genotype).sum(axis=0)
+                          for genotype in (0, 1, 2)], dtype=numpy.float64)
+    nb_called = counts.sum(axis=0)
+    nb_missing = nb_subjects - nb_called
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        # Allele frequencies
+        freq = (counts[1] + 2 * counts[2]) / (2 * nb_called)
+        maf = numpy.minimum(freq, 1 - freq)
+        call_rate = nb_called / nb_subjects
+
+        # Hardy-Weinberg equilibrium
+        expected = numpy.array([
+            nb_called * (1 - freq) ** 2,
+            2 * nb_called * freq * (1 - freq),
+            nb_called * freq ** 2])
+        chi2 = ((counts - expected) ** 2 / expected).sum(axis=0)
+        chi2[(expected == 0).any(axis=0)] = numpy.nan
+        hwe_pvalue = numpy.vectorize(math.erfc, otypes=[numpy.float64])(
+            numpy.sqrt(chi2 / 2))
+
+    stats = []
+    for row in zip(maf, call_rate, hwe_pvalue, counts[0], counts[1],
+                   counts[2], nb_missing):
+        stats.append(
+            [None if numpy.isnan(val) else float(val) for val in row[:3]] +
+            [int(val) for val in row[3:]])
+    return stats
+
+
 def genotype_measure(path_dataset, snp_ids=None, gene_names=None,
                      subject_ids=None, count_A1=True, path_log=None,
-                     timeout=10, nb_tries=3, metagen_url=DEFAULT_METAGEN_URL):
+                     timeout=10, nb_tries=3, metagen_url=DEFAULT_METAGEN_URL,
+                     cache=None, resolver=None):
     """
     Request genotype data from a Plink bed/bim/fam dataset. It can be done
     using high level attributes like genes. In that case the function requests
     the Metagen server to translate these high level attributes to a list of
     snp ids.
 
+    If a cache is passed, the results are stored as compact int8 matrices
+    and served from the cache as long as the dataset files are not modified.
+
     Parameters
     ----------
     path_dataset: str
@@ -305,6 +596,11 @@ def genotype_measure(path_dataset, snp_ids=None, gene_names=None,
         Max time in seconds to wait for a response from Metagen.
     nb_tries: int, default 3
         If the server failed to answer, retry nb_tries-1 times.
+    cache: DiskLRUCache, default None
+        If set, the cache used to store the results.
+    resolver: MetagenResolver, default None
+        If set, the resolver used to translate the genes to snp ids instead
+        of the 'metagen_url' server.
 
     Return
     ------
@@ -318,24 +614,248 @@ def genotype_measure(path_dataset, snp_ids=None, gene_names=None,
         the dataframe, since the dataframe only contain snps available in the
         dataset.
     """
-    if gene_names is not None:
+    # Check the cache first
+    if cache is not None:
+        key = genotype_cache_key(path_dataset=path_dataset,
+                                 snp_ids=snp_ids,
+                                 gene_names=gene_names,
+                                 subject_ids=subject_ids,
+                                 count_A1=count_A1,
+                                 metagen_url=(resolver.identifier
+                                              if resolver is not None
+                                              else metagen_url))
+        data = cache.get(key)
+        if data is not None:
+            return loads_genotype_measure(data)
+
+    # Translate the genes to snp ids
+    snp_ids, metagen_snps_of_gene = resolve_snp_ids(
+        snp_ids=snp_ids,
+        gene_names=gene_names,
+        timeout=timeout,
+        nb_tries=nb_tries,
+        metagen_url=metagen_url,
+        resolver=resolver)
+
+    # Load the genotypes
+    dataframe = load_plink_bed_bim_fam_dataset(path_dataset=path_dataset,
+                                               snp_ids=snp_ids,
+                                               subject_ids=subject_ids,
+                                               count_A1=count_A1)
+
+    # Update the cache
+    if cache is not None:
+        cache.set(key, dumps_genotype_measure(dataframe,
+                                              metagen_snps_of_gene))
+
+    return dataframe, metagen_snps_of_gene
+
+
+def genotype_cache_key(path_dataset, snp_ids=None, gene_names=None,
+                       subject_ids=None, count_A1=True,
+                       metagen_url=DEFAULT_METAGEN_URL):
+    """
+    Build the cache key of a 'genotype_measure' request: the key depends on
+    the dataset files identity (path, size and modification time) and on
+    the normalized request parameters.
+
+    Parameters
+    ----------
+    path_dataset: str
+        Path to the Plink bed/bim/fam dataset, with or without .bed extension.
+    snp_ids, gene_names, subject_ids, count_A1: see 'genotype_measure'.
+    metagen_url: str, default module url
+        Identifies the Metagen reference: the Metagen server url or the
+        resolver identifier.
+
+    Return
+    ------
+    key: str
+        The cache key.
+    """
+    root = path_dataset
+    if root.endswith(".bed"):
+        root = root[:-len(".bed")]
+    identity = [DiskLRUCache.file_identity(root + ext)
+                for ext in (".bed", ".bim", ".fam")]
+
+    def normalize(items):
+        return sorted(set(items)) if items is not None else None
+
+    return DiskLRUCache.make_key(
+        identity, normalize(snp_ids), normalize(gene_names),
+        normalize(subject_ids), bool(count_A1), metagen_url)
+
+
+def dumps_genotype_measure(snp_data, metagen_snps_of_gene):
+    """
+    Serialize a 'genotype_measure' result: the allele counts are stored as
+    an int8 matrix.
+
+    Parameters
+    ----------
+    snp_data: pysnptools object
+        PLINK data loaded by the 'pysnptools' library.
+    metagen_snps_of_gene: dict or None
+        The Metagen results, see 'genotype_measure'.
+
+    Return
+    ------
+    data: str
+        The serialized result.
+    """
+    if metagen_snps_of_gene is not None:
+        metagen_snps_of_gene = dict(
+            (gname, [list(snp) for snp in snps])
+            for gname, snps in metagen_snps_of_gene.items())
+    buf = io.BytesIO()
+    numpy.savez_compressed(
+        buf,
+        val=int8_genotypes(snp_data.val),
+        iid=numpy.asarray(snp_data.iid, dtype=str),
+        sid=numpy.asarray(snp_data.sid, dtype=str),
+        pos=snp_data.pos,
+        metagen=numpy.asarray(json.dumps(metagen_snps_of_gene)))
+    return buf.getvalue()
+
+
+def loads_genotype_measure(data):
+    """
+    Deserialize a 'genotype_measure' result.
+
+    Parameters
+    ----------
+    data: str
+        A result serialized by 'dumps_genotype_measure'.
+
+    Return
+    ------
+    snp_data: pysnptools object
+        PLINK data, missing allele counts are set to NaN.
+    metagen_snps_of_gene: dict or None
+        The Metagen results, see 'genotype_measure'.
+    """
+    arrays = numpy.load(io.BytesIO(data))
+    val = arrays["val"].astype(numpy.float64)
+    val[val < 0] = numpy.nan
+    snp_data = SnpData(iid=arrays["iid"], sid=arrays["sid"], val=val,
+                       pos=arrays["pos"])
+    metagen_snps_of_gene = json.loads(str(arrays["metagen"]))
+    if metagen_snps_of_gene is not None:
+        Snp = namedtuple("Snp", ["rs_id", "chromosome", "bp_pos"])
+        metagen_snps_of_gene = dict(
+            (gname, [Snp(*snp) for snp in snps])
+            for gname, snps in metagen_snps_of_gene.items())
+    return snp_data, metagen_snps_of_gene
+
+
+def genotype_measure_chunks(path_dataset, snp_ids=None, gene_names=None,
+                            subject_ids=None, count_A1=True, chunk_size=1000,
+                            axis="subject", timeout=10, nb_tries=3,
+                            metagen_url=DEFAULT_METAGEN_URL, resolver=None):
+    """
+    Request genotype data from a Plink bed/bim/fam dataset chunk by chunk.
+    Same as 'genotype_measure' except that the genotypes are read lazily
+    from the .bed file, by chunks of subjects or snps.
+
+    Parameters
+    ----------
+    path_dataset: str
+        Path to the Plink bed/bim/fam dataset, with or without .bed extension.
+    snp_ids: list/set of str, default None
+        Snps that should be extracted if available in the dataset.
+        If both snp_ids and gene_names are None, all snps are loaded.
+    gene_names: list/set of str, default None
+        Names of genes for which the snps are requested.
+        If both snp_ids and gene_names are None, all snps are loaded.
+    subject_ids: list/set of str, default None
+        Subjects that should be extracted if available in the dataset.
+        By default None, all subjects are loaded.
+    count_A1: bool, default True
+        Genotypes are provided as allele counts, A1 if True else A2.
+    chunk_size: int, default 1000
+        Number of subjects (or snps) read from the .bed file at a time.
+    axis: str, default 'subject'
+        Read the genotypes by chunks of 'subject' or 'snp'.
+    timeout: int, default 10
+        Max time in seconds to wait for a response from Metagen.
+    nb_tries: int, default 3
+        If the server failed to answer, retry nb_tries-1 times.
+    resolver: MetagenResolver, default None
+        See 'genotype_measure'.
+
+    Return
+    ------
+    snp_reader: pysnptools object
+        PLINK reader restricted to the requested snps and subjects.
+    chunks: generator of pysnptools object
+        PLINK data chunks.
+    metagen_snps_of_gene: dict or None
+        See 'genotype_measure'.
+    """
+    # Translate the genes to snp ids
+    snp_ids, metagen_snps_of_gene = resolve_snp_ids(
+        snp_ids=snp_ids,
+        gene_names=gene_names,
+        timeout=timeout,
+        nb_tries=nb_tries,
+        metagen_url=metagen_url,
+        resolver=resolver)
+
+    # Select the genotypes without loading them
+    snp_reader = open_plink_bed_bim_fam_dataset(path_dataset=path_dataset,
+                                                snp_ids=snp_ids,
+                                                subject_ids=subject_ids,
+                                                count_A1=count_A1)
+    chunks = iter_plink_genotype_chunks(snp_reader, chunk_size=chunk_size,
+                                        axis=axis)
+    return snp_reader, chunks, metagen_snps_of_gene
+
+
+def resolve_snp_ids(snp_ids=None, gene_names=None, timeout=10, nb_tries=3,
+                    metagen_url=DEFAULT_METAGEN_URL, resolver=None):
+    """
+    Translate the requested genes to a list of snp ids by requesting the
+    Metagen server, or the Metagen resolver if passed.
+
+    Parameters
+    ----------
+    snp_ids: list/set of str, default None
+        Snps explicitly requested.
+    gene_names: list/set of str, default None
+        Names of genes for which the snps are requested.
+    timeout: int, default 10
+        Max time in seconds to wait for a response from Metagen.
+    nb_tries: int, default 3
+        If the server failed to answer, retry nb_tries-1 times.
+    resolver: MetagenResolver, default None
+        If set, the resolver used instead of the 'metagen_url' server.
+
+    Return
+    ------
+    snp_ids: list of str or None
+        The requested snps and the snps of the requested genes. None if
+        both 'snp_ids' and 'gene_names' are None.
+    metagen_snps_of_gene: dict or None
+        None if 'gene_names' was not passed. Otherwise returns a dict of the
+        Metagen results. It maps <gene HGNC name> -> list of snps.
+    """
+    if gene_names is not None and resolver is not None:
+        metagen_snps_of_gene = resolver.get_snps_of_genes(gene_names)
+    elif gene_names is not None:
         metagen_snps_of_gene = metagen_get_snps_of_genes(
             gene_names=gene_names,
             metagen_url=metagen_url,
             timeout=timeout,
             nb_tries=nb_tries)
+    if gene_names is not None:
         metagen_snp_ids = [snp.rs_id for snps in metagen_snps_of_gene.values()
                            for snp in snps]
         if len(metagen_snp_ids) == 0:
             raise ValueError("Metagen returned 0 snp for the requested genes.")
         else:
-            snp_ids = (snp_ids or []) + metagen_snp_ids
+            snp_ids = list(snp_ids or []) + metagen_snp_ids
     else:
         metagen_snps_of_gene = None
 
-    # Load the genotypes
-    dataframe = load_plink_bed_bim_fam_dataset(path_dataset=path_dataset,
-                                               snp_ids=snp_ids,
-                                               subject_ids=subject_ids,
-                                               count_A1=count_A1)
-    return dataframe, metagen_snps_of_gene
+    return snp_ids, metagen_snps_of_gene
@@ -0,0 +1,98 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2017
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+import bisect
+import threading
+
+
+# Module level registry of the gene prefix indexes, one per Metagen
+# reference
+_GENE_INDEXES = {}
+_GENE_INDEXES_LOCK = threading.Lock()
+
+
+class GenePrefixIndex(object):
+    """
+    An in-memory sorted index of the gene HGNC ids: a case insensitive
+    prefix search is a binary search in the sorted names.
+    """
+    def __init__(self, genes):
+        """
+        Parameters
+        ----------
+        genes: list of Gene
+            The (hgnc_id, chromosome) namedtuples returned by a Metagen
+            resolver.
+        """
+        genes = sorted(set((gene.hgnc_id.upper(), gene.hgnc_id,
+                            gene.chromosome) for gene in genes))
+        self._keys = [item[0] for item in genes]
+        self._genes = [item[1:] for item in genes]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def search(self, prefix, limit=20):
+        """
+        Get the genes whose HGNC id starts with a prefix.
+
+        Parameters
+        ----------
+        prefix: str
+            The HGNC id prefix, case insensitive.
+        limit: int, default 20
+            The maximum number of returned genes.
+
+        Return
+        ------
+        genes: list of 2-uplet
+            The first 'limit' matching (hgnc_id, chromosome) in alphabetical
+            order.
+        """
+        prefix = prefix.strip().upper()
+        start = bisect.bisect_left(self._keys, prefix)
+        end = min(start + limit, len(self._keys))
+        matches = []
+        for index in range(start, end):
+            if not self._keys[index].startswith(prefix):
+                break
+            matches.append(self._genes[index])
+        return matches
+
+
+def get_gene_prefix_index(resolver):
+    """
+    Get the gene prefix index of a Metagen reference: the index is built
+    once from the resolver genes and kept until 'clear_gene_prefix_indexes'
+    is called.
+
+    Parameters
+    ----------
+    resolver: MetagenResolver
+        The resolver used to list the genes.
+
+    Return
+    ------
+    index: GenePrefixIndex
+        The shared gene index.
+    """
+    key = resolver.identifier
+    index = _GENE_INDEXES.get(key)
+    if index is None:
+        genes = resolver.get_genes()
+        with _GENE_INDEXES_LOCK:
+            index = _GENE_INDEXES.setdefault(key, GenePrefixIndex(genes))
+    return index
+
+
+def clear_gene_prefix_indexes():
+    """
+    Invalidate the gene prefix indexes: they are rebuilt on next access.
+    """
+    with _GENE_INDEXES_LOCK:
+        _GENE_INDEXES.clear()
@@ -0,0 +1,289 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2017
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+import os
+import glob
+import json
+import threading
+from collections import namedtuple
+
+from cubes.piws.metagen.genotype import DEFAULT_METAGEN_URL
+from cubes.piws.metagen.genotype import get_genes
+from cubes.piws.metagen.genotype import metagen_get_snps_of_genes
+from cubes.piws.cache.memory import get_memory_cache
+
+
+METAGEN_RESOLVERS = ("remote", "local", "file")
+
+# Genes and snps are returned as namedtuples to simplify usage
+Gene = namedtuple("Gene", ["hgnc_id", "chromosome"])
+Snp = namedtuple("Snp", ["rs_id", "chromosome", "bp_pos"])
+
+# Module level registry of the file resolvers, the Metagen files are only
+# loaded once
+_FILE_RESOLVERS = {}
+_FILE_RESOLVERS_LOCK = threading.Lock()
+
+
+class MetagenResolver(object):
+    """
+    Translate genes to snps. The resolvers share the same interface and
+    return the same structures whatever the source of the Metagen reference.
+    """
+    name = None
+
+    @property
+    def identifier(self):
+        """ A string that identifies the Metagen reference, used in the
+        cache keys.
+        """
+        return self.name
+
+    def get_genes(self):
+        """
+        Get all the gene names.
+
+        Return
+        ------
+        genes: list of Gene
+            The (hgnc_id, chromosome) namedtuples.
+        """
+        raise NotImplementedError
+
+    def get_snps_of_genes(self, gene_names):
+        """
+        Get the snps associated to a list of genes.
+
+        Parameters
+        ----------
+        gene_names: list of str
+            Gene names are the HGNC names.
+
+        Return
+        ------
+        snps_of_gene; dict
+            Map <gene HGNC name> -> list of snps.
+            Each snp is given as a namedtuple: (<rs_id>, <chromosome>,
+            <bp_pos>)
+        """
+        raise NotImplementedError
+
+
+class RemoteMetagenResolver(MetagenResolver):
+    """
+    Request a remote Metagen server.
+    """
+    name = "remote"
+
+    def __init__(self, metagen_url=DEFAULT_METAGEN_URL, timeout=10,
+                 nb_tries=3):
+        """
+        Parameters
+        ----------
+        metagen_url: str, default module url
+            Url of the Metagen server.
+        timeout: int, default 10
+            Max time in seconds to wait for a response from Metagen.
+        nb_tries: int, default 3
+            If the server failed to answer, retry nb_tries-1 times.
+        """
+        self.metagen_url = metagen_url or DEFAULT_METAGEN_URL
+        self.timeout = timeout
+        self.nb_tries = nb_tries
+
+    @property
+    def identifier(self):
+        return self.metagen_url
+
+    def get_genes(self):
+        return get_genes(metagen_url=self.metagen_url, timeout=self.timeout,
+                         nb_tries=self.nb_tries)
+
+    def get_snps_of_genes(self, gene_names):
+        return metagen_get_snps_of_genes(
+            gene_names, metagen_url=self.metagen_url, timeout=self.timeout,
+            nb_tries=self.nb_tries)
+
+
+class LocalMetagenResolver(MetagenResolver):
+    """
+    Query the Gene, Snp and Chromosome entities stored in the current
+    repository by the 'piws.importer.metagen.MetaGen' importer.
+    """
+    name = "local"
+
+    # Number of genes requested at a time
+    batch_size = 1000
+
+    def __init__(self, cnx):
+        """
+        Parameters
+        ----------
+        cnx: Connection or Request
+            An object with an 'execute' method to query the repository.
+        """
+        self.cnx = cnx
+
+    @property
+    def identifier(self):
+        """ The identifier changes whenever Gene or Snp entities are
+        created, modified or deleted: it is built from their number, their
+        greatest eid and their last modification date.
+
+        The identifier is computed once per process and kept until
+        'clear_local_metagen_identifier' is called.
+        """
+        identifier_cache = get_memory_cache("metagen-identifiers", 1)
+        identifier = identifier_cache.get(self.name)
+        if identifier is None:
+            nb_entities, max_eid, last_modified = self.cnx.execute(
+                "Any COUNT(X), MAX(X), MAX(D) Where X is IN (Gene, Snp), "
+                "X modification_date D")[0]
+            identifier = "{0}:{1}:{2}:{3}".format(
+                self.name, nb_entities, max_eid, last_modified)
+            identifier_cache.set(self.name, identifier)
+        return identifier
+
+    def get_genes(self):
+        rql = ("Any GN, CN Where G is Gene, G hgnc_name GN, "
+               "G gene_chromosome C, C name CN")
+        return [Gene(name, chrom) for name, chrom in self.cnx.execute(rql)]
+
+    def get_snps_of_genes(self, gene_names):
+        gene_names = list(set(gene_names))
+        snps_of_gene = dict((gname, []) for gname in gene_names)
+        for i in range(0, len(gene_names), self.batch_size):
+            kwargs = {}
+            for index, gname in enumerate(
+                    gene_names[i: i + self.batch_size]):
+                kwargs["gene{0}".format(index)] = gname
+            rql = ("Any GN, SID, CN, POS Where G is Gene, G hgnc_name GN, "
+                   "G hgnc_name IN ({0}), G gene_snps S, S rs_id SID, "
+                   "S snp_chromosome C, C name CN, S position POS").format(
+                ", ".join(["%({0})s".format(key) for key in kwargs]))
+            for gname, rs_id, chrom, bp_pos in self.cnx.execute(rql, kwargs):
+                snps_of_gene[gname].append(Snp(rs_id, chrom, bp_pos))
+        return snps_of_gene
+
+
+class FileMetagenResolver(MetagenResolver):
+    """
+    Read the Metagen reference from JSON files organized as in the
+    'demo/metagen' folder: one 'genes_of_chr<name>.json' and one
+    'snps_of_chr<name>.json' file per chromosome.
+
+    - genes: [[gene_id, chromosome, start, end, hgnc_name, gene_type], ...]
+    - snps: [[rs_id, chromosome, position, ..., [gene_id, ...]], ...]
+    """
+    name = "file"
+
+    def __init__(self, root):
+        """
+        Parameters
+        ----------
+        root: str
+            The folder containing the Metagen JSON files.
+        """
+        self.root = root
+        self._genes = None
+        self._snps_of_gene = None
+        self._lock = threading.Lock()
+
+    @property
+    def identifier(self):
+        return "file://" + os.path.abspath(self.root)
+
+    def load(self):
+        """ Load the Metagen reference once.
+        """
+        with self._lock:
+            if self._genes is not None:
+                return
+            genes = []
+            hgnc_of_gene_id = {}
+            for path in sorted(glob.glob(
+                    os.path.join(self.root, "genes_of_chr*.json"))):
+                with open(path, "rt") as open_file:
+                    for row in json.load(open_file):
+                        gene_id, chrom, hgnc_name = row[0], row[1], row[4]
+                        hgnc_of_gene_id[gene_id] = hgnc_name
+                        genes.append(Gene(hgnc_name, chrom))
+            if len(genes) == 0:
+                raise ValueError(
+                    "No Metagen genes files found in '{0}'.".format(
+                        self.root))
+            snps_of_gene = {}
+            for path in sorted(glob.glob(
+                    os.path.join(self.root, "snps_of_chr*.json"))):
+                with open(path, "rt") as open_file:
+                    for row in json.load(open_file):
+                        snp = Snp(row[0], row[1], row[2])
+                        for gene_id in row[-1]:
+                            if gene_id in hgnc_of_gene_id:
+                                snps_of_gene.setdefault(
+                                    hgnc_of_gene_id[gene_id], []).append(snp)
+            self._snps_of_gene = snps_of_gene
+            self._genes = genes
+
+    def get_genes(self):
+        self.load()
+        return list(self._genes)
+
+    def get_snps_of_genes(self, gene_names):
+        self.load()
+        return dict((gname, list(self._snps_of_gene.get(gname, [])))
+                    for gname in set(gene_names))
+
+
+def get_metagen_resolver(config, cnx=None):
+    """
+    Get the Metagen resolver defined in the instance configuration.
+
+    Parameters
+    ----------
+    config: CubicWebConfiguration
+        The instance configuration: the 'metagen-resolver' option selects
+        the backend.
+    cnx: Connection or Request, default None
+        An object with an 'execute' method, mandatory with the 'local'
+        backend.
+
+    Return
+    ------
+    resolver: MetagenResolver
+        The configured resolver.
+    """
+    backend = config["metagen-resolver"]
+    if backend == "remote":
+        return RemoteMetagenResolver(metagen_url=config["metagen_url"])
+    elif backend == "local":
+        if cnx is None:
+            raise ValueError("A connection is required by the local "
+                             "Metagen resolver.")
+        return LocalMetagenResolver(cnx)
+    elif backend == "file":
+        root = config["metagen-folder"]
+        if root is None:
+            raise ValueError("The 'metagen-folder' option is required by "
+                             "the file Metagen resolver.")
+        with _FILE_RESOLVERS_LOCK:
+            resolver = _FILE_RESOLVERS.get(root)
+            if resolver is None:
+                resolver = FileMetagenResolver(root)
+                _FILE_RESOLVERS[root] = resolver
+        return resolver
+    raise ValueError("'{0}' Metagen resolver not supported, expect one of "
+                     "{1}.".format(backend, METAGEN_RESOLVERS))
+
+
+def clear_local_metagen_identifier():
+    """
+    Invalidate the identifier of the local Metagen reference: it is
+    computed again on next access.
+    """
+    get_memory_cache("metagen-identifiers", 1).clear()
@@ -98,6 +98,25 @@ options = (
         "group": "piws",
         "level": 1,
     }),
+    ("metagen-resolver", {
+        "type": "choice",
+        "choices": ("remote", "local", "file"),
+        "default": "remote",
+        "help": ("the source of the Metagen reference used to translate "
+                 "genes to snps: 'remote' requests the 'metagen_url' server, "
+                 "'local' queries the Gene/Snp entities of this instance and "
+                 "'file' reads the JSON files of the 'metagen-folder'."),
+        "group": "piws",
+        "level": 1,
+    }),
+    ("metagen-folder", {
+        "type": "string",
+        "default": None,
+        "help": ("the folder containing the Metagen 'genes_of_chr*.json' and "
+                 "'snps_of_chr*.json' files used by the 'file' resolver."),
+        "group": "piws",
+        "level": 1,
+    }),
     ("allow-inline-relations", {
         "type": "yn",
         "default": True,
@@ -106,4 +125,129 @@ options = (
         "group": "piws",
         "level": 1,
     }),
+    ("cache-folder", {
+        "type": "string",
+        "default": None,
+        "help": ("the folder where the PIWS on-disk caches are stored, "
+                 "default to the 'piws-cache' folder of the instance data "
+                 "directory."),
+        "group": "piws",
+        "level": 1,
+    }),
+    ("table-cache-size", {
+        "type": "int",
+        "default": 20,
+        "help": ("the number of tables kept in memory and served page by page "
+                 "to the DataTables views, the least recently used tables "
+                 "are evicted first: 0 disables the server-side paging."),
+        "group": "piws",
+        "level": 1,
+    }),
+    ("table-cache-memory", {
+        "type": "int",
+        "default": 256,
+        "help": ("the approximate memory size in MB of the tables kept in "
+                 "memory by each process, the least recently used tables "
+                 "are evicted first: 0 only bounds the number of tables."),
+        "group": "piws",
+        "level": 1,
+    }),
+    ("chart-cache-size", {
+        "type": "int",
+        "default": 50,
+        "help": ("the number of chart data kept in memory, the least recently "
+                 "used charts are evicted first: 0 disables the cache."),
+        "group": "piws",
+        "level": 1,
+    }),
+    ("pivot-cache-size", {
+        "type": "int",
+        "default": 512,
+        "help": ("the on-disk questionnaire pivot tables cache size in MB, "
+                 "the least recently used tables are evicted first: 0 "
+                 "disables the cache."),
+        "group": "piws",
+        "level": 1,
+    }),
+    ("nav-cache-size", {
+        "type": "int",
+        "default": 16,
+        "help": ("the on-disk navigation box cache size in MB, one rendered "
+                 "box is kept per set of user groups: 0 disables the cache."),
+        "group": "piws",
+        "level": 1,
+    }),
+    ("slice-cache-size", {
+        "type": "int",
+        "default": 2048,
+        "help": ("the on-disk cache size in MB of the encoded image slices "
+                 "displayed by the image viewer, the least recently used "
+                 "images are evicted first: 0 disables the cache."),
+        "group": "piws",
+        "level": 1,
+    }),
+    ("image-encoding-threads", {
+        "type": "int",
+        "default": 0,
+        "help": ("the number of threads shared by the image viewer to encode "
+                 "the image slices: 0 uses the number of CPUs."),
+        "group": "piws",
+        "level": 1,
+    }),
+    ("pyramid-cache-size", {
+        "type": "int",
+        "default": 2048,
+        "help": ("the on-disk cache size in MB of the downsampled volumes "
+                 "displayed first by the image viewer, the least recently "
+                 "used volumes are evicted first: 0 disables the cache."),
+        "group": "piws",
+        "level": 1,
+    }),
+    ("image-normalization", {
+        "type": "choice",
+        "choices": ("minmax", "percentile"),
+        "default": "minmax",
+        "help": ("the intensity range mapped to the image viewer dynamic: "
+                 "'minmax' uses the image minimum and maximum intensities "
+                 "and 'percentile' the robust 1st and 99th percentiles."),
+        "group": "piws",
+        "level": 1,
+    }),
+    ("genotype-cache-size", {
+        "type": "int",
+        "default": 1024,
+        "help": ("the on-disk genotype cache size in MB, the least recently "
+                 "used results are evicted first: 0 disables the cache."),
+        "group": "piws",
+        "level": 1,
+    }),
+    ("doc-cache-size", {
+        "type": "int",
+        "default": 64,
+        "help": ("the on-disk cache size in MB of the html documentation "
+                 "generated from the 'documentation_folder' rst files: 0 "
+                 "disables the cache."),
+        "group": "piws",
+        "level": 1,
+    }),
+    ("doc-prerender", {
+        "type": "yn",
+        "default": True,
+        "help": ("if True, generate the html documentation in a background "
+                 "thread on startup, otherwise each documentation page is "
+                 "generated on first access."),
+        "group": "piws",
+        "level": 1,
+    }),
+    ("http-cache-control", {
+        "type": "string",
+        "default": "private, max-age=0, must-revalidate",
+        "help": ("the 'Cache-Control' header of the responses that only "
+                 "depend on a file content (images and documentation): "
+                 "these responses also have 'ETag' and 'Last-Modified' "
+                 "headers and are revalidated with a '304 Not Modified' "
+                 "response."),
+        "group": "piws",
+        "level": 1,
+    }),
 )
@@ -0,0 +1,158 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2017
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# System import
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+# Package import
+from cubes.piws.cache.disk import DiskLRUCache
+from cubes.piws.cache.memory import MemoryLRUCache
+from cubes.piws.cache.memory import approximate_size
+
+
+class TestDiskLRUCache(unittest.TestCase):
+    """ Test the on-disk LRU cache.
+    """
+    def setUp(self):
+        """ Create an empty cache folder.
+        """
+        self.folder = tempfile.mkdtemp()
+        self.cache = DiskLRUCache(self.folder, 100)
+
+    def tearDown(self):
+        """ Remove the cache folder.
+        """
+        shutil.rmtree(self.folder)
+
+    def set_entry(self, key, data, age):
+        """ Cache an entry and make it 'age' seconds old.
+        """
+        self.cache.set(key, data)
+        atime = time.time() - age
+        os.utime(self.cache.path(key), (atime, atime))
+
+    def test_set_get(self):
+        """ The cached entries are sharded and read back.
+        """
+        key = DiskLRUCache.make_key("image", 1)
+        self.assertEqual(self.cache.get(key), None)
+        self.cache.set(key, "data")
+        self.assertTrue(key in self.cache)
+        self.assertEqual(self.cache.get(key), "data")
+        self.assertEqual(os.path.basename(os.path.dirname(
+            self.cache.path(key))), key[:DiskLRUCache.shard_length])
+
+    def test_make_key(self):
+        """ The keys only depend on the key parts.
+        """
+        self.assertEqual(DiskLRUCache.make_key("a", {"b": 1, "c": 2}),
+                         DiskLRUCache.make_key("a", {"c": 2, "b": 1}))
+        self.assertNotEqual(DiskLRUCache.make_key("a", 1),
+                            DiskLRUCache.make_key("a", 2))
+
+    def test_oversized_entry(self):
+        """ An entry larger than the byte budget is not cached.
+        """
+        self.cache.set("big", "x" * 101)
+        self.assertFalse("big" in self.cache)
+
+    def test_running_total(self):
+        """ The cache size is updated on write, overwrite and delete.
+        """
+        self.cache.set("a0", "x" * 10)
+        self.cache.set("b0", "x" * 20)
+        self.assertEqual(self.cache._total_bytes, 30)
+        self.cache.set("a0", "x" * 5)
+        self.assertEqual(self.cache._total_bytes, 25)
+        self.cache.delete("b0")
+        self.assertEqual(self.cache._total_bytes, 5)
+        self.cache.delete("b0")
+        self.assertEqual(self.cache._total_bytes, 5)
+
+    def test_evict(self):
+        """ The least recently used entries are evicted in batch until the
+        cache fits in its eviction ratio.
+        """
+        for index, key in enumerate(["a0", "b0", "c0"]):
+            self.set_entry(key, "x" * 30, 100 - index)
+        self.assertEqual(self.cache._total_bytes, 90)
+        self.assertEqual(self.cache.get("a0"), "x" * 30)
+        self.cache.set("d0", "x" * 30)
+        self.assertFalse("b0" in self.cache)
+        self.assertTrue("a0" in self.cache)
+        self.assertTrue("c0" in self.cache)
+        self.assertTrue("d0" in self.cache)
+        self.assertEqual(self.cache._total_bytes, 90)
+        self.assertEqual(
+            sum([size for _, size, _ in self.cache.entries()]), 90)
+
+    def test_clear(self):
+        """ The clear removes all the entries.
+        """
+        self.cache.set("a0", "x" * 10)
+        self.cache.set("b0", "x" * 10)
+        self.cache.clear()
+        self.assertEqual(self.cache.entries(), [])
+        self.assertEqual(self.cache._total_bytes, 0)
+
+    def test_disabled(self):
+        """ A cache without byte budget stores nothing.
+        """
+        cache = DiskLRUCache(self.folder, 0)
+        cache.set("a0", "data")
+        self.assertEqual(cache.get("a0"), None)
+
+
+class TestMemoryLRUCache(unittest.TestCase):
+    """ Test the in-process LRU cache.
+    """
+    def test_max_items(self):
+        """ The least recently used entries are evicted.
+        """
+        cache = MemoryLRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.assertEqual(len(cache), 2)
+        self.assertTrue("a" in cache)
+        self.assertFalse("b" in cache)
+        self.assertEqual(cache.get("b", "missing"), "missing")
+
+    def test_max_bytes(self):
+        """ The entries are evicted when the byte budget is exceeded.
+        """
+        size = approximate_size(("x" * 100, ))
+        cache = MemoryLRUCache(10, max_bytes=2 * size)
+        cache.set("a", ("x" * 100, ))
+        cache.set("b", ("y" * 100, ))
+        self.assertEqual(len(cache), 2)
+        cache.set("c", ("z" * 100, ))
+        self.assertEqual(len(cache), 2)
+        self.assertFalse("a" in cache)
+        cache.set("big", ("x" * (3 * size), ))
+        self.assertFalse("big" in cache)
+        cache.delete("b")
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache._total_bytes, 0)
+
+    def test_approximate_size(self):
+        """ The size accounts for the referenced items.
+        """
+        self.assertTrue(approximate_size({"a": "x" * 1000}) > 1000)
+        self.assertTrue(approximate_size([[1, 2], [3]]) >
+                        approximate_size([]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2017
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# System import
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from email.utils import formatdate
+
+# Package import
+from cubes.piws.views.httpcache import file_validators
+from cubes.piws.views.httpcache import is_not_modified
+from cubes.piws.views.httpcache import set_file_cache_headers
+
+
+class FakeRequest(object):
+    """ A request that only knows the HTTP headers.
+    """
+    def __init__(self, headers=None, cache_control="no-cache"):
+        self.headers_in = headers or {}
+        self.headers_out = {}
+        self.vreg = type("Vreg", (object, ), {
+            "config": {"http-cache-control": cache_control}})()
+
+    def get_header(self, name, default=None):
+        return self.headers_in.get(name, default)
+
+    def set_header(self, name, value, raw=True):
+        self.headers_out[name] = value
+
+
+class TestHTTPCache(unittest.TestCase):
+    """ Test the HTTP cache validators of the file based responses.
+    """
+    def setUp(self):
+        """ Create a file the responses depend on.
+        """
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "image.nii")
+        with open(self.path, "wb") as open_file:
+            open_file.write("data")
+        self.mtime = int(time.time()) - 3600
+        os.utime(self.path, (self.mtime, self.mtime))
+
+    def tearDown(self):
+        """ Remove the file.
+        """
+        shutil.rmtree(self.folder)
+
+    def test_file_validators(self):
+        """ The validators change with the file and the request parameters.
+        """
+        etag, last_modified = file_validators([self.path], "view", 1)
+        self.assertEqual(last_modified, self.mtime)
+        self.assertEqual(file_validators([self.path], "view", 1),
+                         (etag, last_modified))
+        self.assertNotEqual(file_validators([self.path], "view", 2)[0], etag)
+        os.utime(self.path, (self.mtime + 10, self.mtime + 10))
+        new_etag, new_last_modified = file_validators([self.path], "view", 1)
+        self.assertNotEqual(new_etag, etag)
+        self.assertEqual(new_last_modified, self.mtime + 10)
+
+    def test_set_file_cache_headers(self):
+        """ The validators and the cache policy are set in the response.
+        """
+        req = FakeRequest(cache_control="max-age=60")
+        etag, last_modified = set_file_cache_headers(req, [self.path], "view")
+        self.assertEqual(req.headers_out["ETag"], "\"{0}\"".format(etag))
+        self.assertEqual(req.headers_out["Last-Modified"], last_modified)
+        self.assertEqual(req.headers_out["Cache-Control"], "max-age=60")
+
+    def test_if_none_match(self):
+        """ The entity tags are compared quoted, in a comma separated list.
+        """
+        etag, last_modified = file_validators([self.path])
+        for header, expected in (
+                ("\"{0}\"".format(etag), True),
+                ("\"other\", \"{0}\"".format(etag), True),
+                ("*", True),
+                ("\"other\"", False),
+                (etag, False)):
+            req = FakeRequest({"If-None-Match": header})
+            self.assertEqual(is_not_modified(req, etag, last_modified),
+                             expected)
+
+    def test_if_modified_since(self):
+        """ The modification time is compared with the client date.
+        """
+        etag, last_modified = file_validators([self.path])
+        for since, expected in (
+                (last_modified, True),
+                (last_modified + 60, True),
+                (last_modified - 60, False)):
+            req = FakeRequest({
+                "If-Modified-Since": formatdate(since, usegmt=True)})
+            self.assertEqual(is_not_modified(req, etag, last_modified),
+                             expected)
+        req = FakeRequest({"If-Modified-Since": "not a date"})
+        self.assertFalse(is_not_modified(req, etag, last_modified))
+
+    def test_if_none_match_precedence(self):
+        """ The entity tag takes precedence over the modification time.
+        """
+        etag, last_modified = file_validators([self.path])
+        req = FakeRequest({
+            "If-None-Match": "\"other\"",
+            "If-Modified-Since": formatdate(last_modified, usegmt=True)})
+        self.assertFalse(is_not_modified(req, etag, last_modified))
+        self.assertFalse(is_not_modified(FakeRequest(), etag, last_modified))
+
+
+if __name__ == "__main__":
+    unittest.main()
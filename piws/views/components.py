@@ -40,6 +40,9 @@ from cubes.bootstrap.views.basecomponents import BSAuthenticatedUserStatus
 from cubicweb.web.views.boxes import EditBox
 from cubes.rql_upload.views.components import CWUploadBox
 from cubes.rql_upload.views.utils import load_forms
+from cubes.piws.cache.disk import DiskLRUCache
+from cubes.piws.cache.disk import get_disk_cache
+from cubes.piws.cache.statistics import get_summary_statistics
 
 
 
@@ -139,6 +142,34 @@ class PIWSNavigationtBox(component.CtxComponent):
 
     def render_body(self, w):
         """ Create the different item of the navigation box.
+
+        The rendered box only depends on the database content and on the
+        user permissions: it is cached on disk, shared by the instance
+        processes, for each set of user groups (see the 'nav-cache-size'
+        option and the 'InvalidateNavigationCache' hook).
+        """
+        nav_cache = get_disk_cache(self._cw.vreg.config, "navigation",
+                                   "nav-cache-size")
+        if nav_cache is None:
+            self.render_navigation(w)
+            return
+        nav_key = DiskLRUCache.make_key(
+            self.__class__.__module__, self.__class__.__name__,
+            self._cw.base_url(), sorted(self._cw.user.groups),
+            [self.display_assessment, self.display_metagen,
+             self.display_scan, self.display_genomic, self.display_study,
+             self.display_score, self.display_history,
+             self.auto_disable_qc])
+        data = nav_cache.get(nav_key)
+        if data is None:
+            chunks = []
+            self.render_navigation(chunks.append)
+            data = u"".join(chunks).encode("utf-8")
+            nav_cache.set(nav_key, data)
+        w(data.decode("utf-8"))
+
+    def render_navigation(self, w):
+        """ Create the different item of the navigation box without cache.
         """
         # Study
         studies = []
@@ -427,9 +458,11 @@ class PIWSSubjectStatistics(component.CtxComponent):
         """ Method to create the statistic box content.
         """
         # Create a view to see the subject gender repartition in the db
-        href = self._cw.build_url("view", vid="highcharts-basic-pie",
-                                  rql="Any G WHERE S is Subject, S gender G",
-                                  title="Subject genders")
+        href = self._cw.build_url(
+            "view", vid="highcharts-basic-pie",
+            chart_rql=("Any G, COUNT(S) GROUPBY G WHERE S is Subject, "
+                       "S gender G"),
+            title="Subject genders")
         w(u'<div class="btn-toolbar">')
         w(u'<div class="btn-group-vertical btn-block">')
         w(u'<a class="btn btn-primary" href="{0}">'.format(href))
@@ -439,7 +472,8 @@ class PIWSSubjectStatistics(component.CtxComponent):
         # Create a view to see the subject handedness repartition in the db
         href = self._cw.build_url(
             "view", vid="highcharts-basic-pie",
-            rql="Any H WHERE S is Subject, S handedness H",
+            chart_rql=("Any H, COUNT(S) GROUPBY H WHERE S is Subject, "
+                       "S handedness H"),
             title="Subject handednesses")
         w(u'<div class="btn-toolbar">')
         w(u'<div class="btn-group-vertical btn-block">')
@@ -487,7 +521,8 @@ class PIWSAssessmentStatistics(component.CtxComponent):
         # Create a view to see the db subject age distribution
         href = self._cw.build_url(
             "view", vid="highcharts-basic-plot",
-            rql="Any A WHERE X is Assessment, X age_of_subject A",
+            chart_rql=("Any A, COUNT(X) GROUPBY A WHERE X is Assessment, "
+                       "X age_of_subject A"),
             title="Age distribution", is_hist=True)
         w(u'<div class="btn-toolbar">')
         w(u'<div class="btn-group-vertical btn-block">')
@@ -512,78 +547,62 @@ class PIWSSummary(component.CtxComponent):
         "Scan": "Scans",
         "QuestionnaireRun": "Tables",
         "ProcessingRun": "Processed data"}
-    rql_subjects = "Any S WHERE S is Subject, S study ST, ST name '{0}'"
 
     def render_body(self, w):
         """ Method to create the summary table for each study.
+
+        The numbers are computed by a few aggregate requests and cached in
+        the process: the cache is invalidated when a counted entity is
+        created or deleted (see the 'InvalidateSummaryStatistics' hook).
         """
-        # Get an admin connection
-        with self._cw.session.repo.internal_cnx() as session:
+        statistics = get_summary_statistics(
+            self._cw.session.repo, self.categories)
 
-            # Go through each study
-            studies = [row[0] for row in session.execute(
-                "DISTINCT Any SN ORDERBY SN Where S is Study, S name SN")]
-            for study in studies:
+        # Go through each study
+        for study in sorted(statistics):
+            study_statistics = statistics[study]
+            nb_subjects = study_statistics["nb_subjects"]
 
-                # Display the study name
-                w(u"<strong>Study:</strong> {0}<br/><br/>".format(study))
+            # Display the study name
+            w(u"<strong>Study:</strong> {0}<br/><br/>".format(study))
 
-                # Get all the subjects attached to the current study
-                rql = self.rql_subjects.format(study)
-                nb_subjects = session.execute(rql).rowcount
+            # Create the table
+            w(u"<table class='table' style='font-size: 10px;'>")
+            w(u"<tr>")
+            for header in ["Timepoint"] + self.categories:
+                w(u"<th>{0}</th>".format(self.categories_mapping[header]))
+            w(u"</tr>")
 
-                # Create the table
-                w(u"<table class='table' style='font-size: 10px;'>")
+            # Go through each timepoint (one row per timepoint in the tab)
+            for timepoint in study_statistics["timepoints"]:
+
+                # Go through each category (one column per category in
+                # the tab)
                 w(u"<tr>")
-                for header in ["Timepoint"] + self.categories:
-                    w(u"<th>{0}</th>".format(self.categories_mapping[header]))
+                w(u"<td>{0}</td>".format(timepoint))
+                for category in self.categories:
+
+                    # Compute the fill ratio
+                    try:
+                        nb_types = self.nb_types[study][category]
+                    except:
+                        nb_types = study_statistics["nb_types"][category]
+                    nb_items = study_statistics["nb_items"][category].get(
+                        timepoint, 0)
+                    ratio = 0.
+                    if nb_types != 0 and nb_subjects != 0:
+                        ratio = (float(nb_items) /
+                                 float(nb_types * nb_subjects))
+
+                    # Display the fill ratio
+                    w(u"<td>")
+                    w(u"<progress value='{0}' max='100' style='width:100%;'>"
+                      "</progress>".format(ratio * 100.))
+                    w(u"</td>")
+
                 w(u"</tr>")
 
-                # Go through each timepoint (one row per timepoint in the tab)
-                timepoints = [row[0] for row in session.execute(
-                    ("DISTINCT Any T ORDERBY T WHERE A is Assessment, "
-                     "A timepoint T, A study ST, ST name '{0}'".format(study)))]
-                for timepoint in timepoints:
-
-                    # Go through each category (one column per category in
-                    # the tab)
-                    w(u"<tr>")
-                    w(u"<td>{0}</td>".format(timepoint))
-                    for category in self.categories:
-
-                        # Deal with questionnaire special case
-                        if category == "QuestionnaireRun":
-                            type_name = "label"
-                        else:
-                            type_name = "type"
-
-                        # Compute the fill ratio
-                        try:
-                            nb_types = self.nb_types[study][category]
-                        except:
-                            rql = ("DISTINCT Any T WHERE X is {0}, X {1} T, "
-                                   "X study ST, ST name '{2}'".format(
-                                        category, type_name, study))
-                            nb_types = session.execute(rql).rowcount
-                        rql = (
-                            "Any X WHERE X is {0}, X study ST, ST name "
-                            "'{1}', X in_assessment A, A timepoint "
-                            "'{2}'".format(category, study, timepoint))
-                        nb_items = session.execute(rql).rowcount
-                        ratio = 0.
-                        if nb_types != 0 and nb_subjects != 0:
-                            ratio = (float(nb_items)  /
-                                     float(nb_types * nb_subjects))
-
-                        # Display the fill ratio
-                        w(u"<td>")
-                        w(u"<progress value='{0}' max='100' style='width:100%;'>"
-                           "</progress>".format(ratio * 100.))
-                        w(u"</td>")
-
-                    w(u"</tr>")
-
-                w(u"</table>")
+            w(u"</table>")
 
 
 ###############################################################################
@@ -6,11 +6,17 @@
 # for details.
 ##########################################################################
 
+# System import
+import os
+
 # Cubicweb import
 from cubicweb.view import View
 from cubicweb.web.views.baseviews import NullView
 from cubicweb.predicates import authenticated_user
 
+# Package import
+from cubes.piws.views.httpcache import FileHTTPCacheManager
+
 
 class DisplayDocumentation(NullView):
     """ Create a view to display the documentation.
@@ -20,12 +26,34 @@ class DisplayDocumentation(NullView):
     templatable = False
     div_id = "piws-documentation"
     default_message = "Documentation has not been provided yet."
+    http_cache_manager = FileHTTPCacheManager
 
     def __init__(self, *args, **kwargs):
         """ Initialize the DisplayDocumentation class.
         """
         super(DisplayDocumentation, self).__init__(*args, **kwargs)
 
+    def cache_files(self):
+        """ Get the rst file the displayed documentation is generated from.
+
+        Returns
+        -------
+        paths: list of str
+            the documentation rst file, empty if the documentation is passed
+            in the request or is missing.
+        parts: list
+            the other items the view depends on.
+        """
+        tooltip_name = self._cw.form.get("tooltip_name", None)
+        doc_folder = self._cw.vreg.config["documentation_folder"]
+        if tooltip_name is None or not doc_folder:
+            return [], []
+        rstfile = os.path.join(doc_folder,
+                               os.path.basename(tooltip_name) + ".rst")
+        if not os.path.isfile(rstfile):
+            return [], []
+        return [rstfile], [self.__regid__, tooltip_name]
+
     def call(self, tooltip=None, tooltip_name=None, **kwargs):
         """ Create the documentation page.
 
@@ -18,6 +18,79 @@ if cw_version >= version.parse("3.21.0"):
 
 from cubicweb.view import View
 
+# Package import
+from cubes.piws.cache.memory import get_memory_cache
+from cubes.piws.views.table_views import table_cache_key
+
+
+###############################################################################
+# Chart cache
+###############################################################################
+
+def get_chart_cache(config):
+    """ Get the in-process cache where the chart data are stored.
+
+    Parameters
+    ----------
+    config: CubicWebConfiguration
+        the instance configuration.
+
+    Returns
+    -------
+    cache: MemoryLRUCache
+        the shared chart cache.
+    """
+    return get_memory_cache("charts", config["chart-cache-size"])
+
+
+def get_grouped_counts(req, rql):
+    """ Get the result of an aggregated request whose rows are
+    (value, count) pairs, for instance
+    'Any G, COUNT(S) GROUPBY G WHERE S is Subject, S gender G'.
+
+    The result is cached per request and user groups until the next data
+    modification.
+
+    Parameters
+    ----------
+    req: Request
+        the current request.
+    rql: str
+        the aggregated request.
+
+    Returns
+    -------
+    counts: list of 2-uplet
+        the (value, count) pairs.
+    """
+    chart_cache = get_chart_cache(req.vreg.config)
+    chart_key = table_cache_key(req, "grouped-counts", rql=rql)
+    counts = chart_cache.get(chart_key)
+    if counts is None:
+        counts = [(row[0], row[1]) for row in req.execute(rql)]
+        chart_cache.set(chart_key, counts)
+    return counts
+
+
+def check_attribute(eschema, attr):
+    """ Check that an entity type has an attribute.
+
+    Parameters
+    ----------
+    eschema: EntitySchema
+        the entity type schema.
+    attr: str
+        the attribute name.
+
+    Raises
+    ------
+    ValueError: if the attribute is not defined in the schema.
+    """
+    rschema = eschema.has_subject_relation(attr)
+    if rschema is None or not rschema.final:
+        raise ValueError("'{0}' has no '{1}' attribute.".format(
+            eschema.type, attr))
+
 
 ###############################################################################
 # Pie Charts
@@ -49,18 +122,31 @@ class HighChartsBasicPieView(View):
         """
         # Get the first element of each resultset row
         data = {}
-        nb_of_elements = 0.
         for element in rset.rows:
             title = element[0]
-            if title not in data:
-                data[title] = 1.
-            else:
-                data[title] += 1.
-            nb_of_elements += 1.
+            data[title] = data.get(title, 0) + 1
 
+        return self.counts_to_data(data.items())
+
+    def counts_to_data(self, counts):
+        """ Method that format aggregated counts for highcharts pie chart.
+
+        Parameters
+        ----------
+        counts: list of 2-uplet (mandatory)
+            the (value, count) pairs.
+
+        Returns
+        -------
+        sdata: string
+            the highcharts formated parameter
+        """
         # Transform/convert (expect percents) the data
-        data = [[key, value / nb_of_elements * 100.]
-                 for key, value in data.iteritems()]
+        nb_of_elements = float(sum(count for value, count in counts))
+        data = []
+        if nb_of_elements > 0:
+            data = [[key, value / nb_of_elements * 100.]
+                    for key, value in counts]
 
         # Create the highcharts string representation of the data
         sdata = '['
@@ -70,7 +156,7 @@ class HighChartsBasicPieView(View):
 
         return sdata
 
-    def call(self, rset=None, title="", **kwargs):
+    def call(self, rset=None, title="", chart_rql=None, **kwargs):
         """ Method that will create a basic pie chart from a cw resultset.
 
         If no resultset are passed to this method, the current resultset is
@@ -82,15 +168,22 @@ class HighChartsBasicPieView(View):
             a  cw resultset
         title: string (optional, default None)
             the name of the chart.
+        chart_rql: str (optional, default None)
+            an aggregated request whose rows are (value, count) pairs. If set,
+            the counts are computed by the database and the rset is ignored.
         """
         # Get the cw resultset
         rset = rset or self.cw_rset
 
         # Get the title
         title = title or self._cw.form.get("title", "")
+        chart_rql = chart_rql or self._cw.form.get("chart_rql", None)
 
         # Get the highcharts string representation of the data
-        data = self.rset_to_data(rset)
+        if chart_rql is not None:
+            data = self.counts_to_data(get_grouped_counts(self._cw, chart_rql))
+        else:
+            data = self.rset_to_data(rset)
 
         # Add some js resources
         self._cw.add_js(
@@ -155,6 +248,10 @@ class HighChartsRelationSummaryView(View):
         The columns correspond to the subject entity 'subject_attr' attributes.
         The lines corresspond to the object entity 'object_attr' attributes.
 
+        The table values are computed with one grouped count request per
+        relation and cached for the user groups until the next data
+        modification (see the 'InvalidateChartCache' hook).
+
         Parameters
         ----------
         rset: resultset (mandatory)
@@ -173,30 +270,19 @@ class HighChartsRelationSummaryView(View):
             'y' contains the y labels and 'grid' the table values and positions.
             If -1 is returned, this mean that no data can be displayed.
         """
-        # Get the first element of each resultset row
-        data = {}
-        for line_number in range(len(rset.rows)):
-
-            # Get the subject/object entities
-            subject_entity = rset.get_entity(line_number, 0)
-            object_entities = []
-            for relation in relations:
-                object_entities.extend(
-                    eval("subject_entity.{0}".format(relation)))
-
-            # Get the subject/object attributes
-            col_name = eval("subject_entity.{0}".format(subject_attr))
-            line_names = [eval("entity.{0}".format(object_attr))
-                          for entity in object_entities]
-
-            # Organize the data
-            if col_name not in data:
-                data[col_name] = {}
-            for line_name in line_names:
-                if line_name not in data[col_name]:
-                    data[col_name][line_name] = 1
-                else:
-                    data[col_name][line_name] += 1
+        # Check the cache
+        if rset is None or rset.rowcount == 0:
+            return -1
+        chart_cache = get_chart_cache(self._cw.vreg.config)
+        chart_key = table_cache_key(
+            self._cw, self.__regid__, rql=rset.printable_rql(),
+            relations=relations, subject_attr=subject_attr,
+            object_attr=object_attr)
+        data = chart_cache.get(chart_key)
+        if data is None:
+            data = self.count_related(rset, relations, subject_attr,
+                                      object_attr)
+            chart_cache.set(chart_key, data)
 
         # Create the highcharts string representation of the data
         sdata = {
@@ -208,10 +294,10 @@ class HighChartsRelationSummaryView(View):
         all_y_labels = []
         for x_label, item in data.iteritems():
             all_y_labels.extend(item.keys())
-        all_y_labels = set(all_y_labels)
+        all_y_labels = sorted(set(all_y_labels))
         # > create the x,y-labels and corresponding table item
         x_count = 0
-        for x_label, item in data.iteritems():
+        for x_label, item in sorted(data.items()):
             sdata["x"].append(x_label)
             y_count = 0
             for y_label in all_y_labels:
@@ -235,6 +321,68 @@ class HighChartsRelationSummaryView(View):
 
         return sdata
 
+    def count_related(self, rset, relations, subject_attr, object_attr):
+        """ Count the related entities per subject and object attributes.
+
+        The relations and attributes are checked against the schema before
+        being inserted in the requests.
+
+        Parameters
+        ----------
+        rset: resultset (mandatory)
+            a  cw resultset, the subject entities are in the first column.
+        relations: list of str (mandatory)
+            the relations to follow.
+        subject_attr: str (mandatory)
+            the subject attribute.
+        object_attr: str (mandatory)
+            the object attribute.
+
+        Returns
+        -------
+        data: dict
+            the number of related entities for each subject attribute and
+            object attribute: {subject_attr: {object_attr: count}}.
+        """
+        # Build the subquery that selects the subject entities: the rset may
+        # have several columns
+        schema = self._cw.vreg.schema
+        nb_columns = len(rset.description[0])
+        subquery_vars = ["X"] + ["X{0}".format(index)
+                                 for index in range(1, nb_columns)]
+        subquery = "WITH {0} BEING ({1})".format(
+            ", ".join(subquery_vars), rset.printable_rql())
+
+        # Go through each relation
+        data = {}
+        subject_etypes = set(row[0] for row in rset.description)
+        for relation in relations:
+            for subject_etype in subject_etypes:
+                eschema = schema.eschema(subject_etype)
+                check_attribute(eschema, subject_attr)
+                if eschema.has_subject_relation(relation):
+                    restriction = "X {0} O".format(relation)
+                    object_etypes = schema.rschema(relation).objects(
+                        subject_etype)
+                elif eschema.has_object_relation(relation):
+                    restriction = "O {0} X".format(relation)
+                    object_etypes = schema.rschema(relation).subjects(
+                        subject_etype)
+                else:
+                    raise ValueError("'{0}' has no '{1}' relation.".format(
+                        subject_etype, relation))
+                for object_eschema in object_etypes:
+                    check_attribute(object_eschema, object_attr)
+                rql = ("Any SA, OA, COUNT(O) GROUPBY SA, OA WHERE X is {0}, "
+                       "{1}, X {2} SA, O {3} OA {4}".format(
+                           subject_etype, restriction, subject_attr,
+                           object_attr, subquery))
+                for col_name, line_name, count in self._cw.execute(rql):
+                    counts = data.setdefault(col_name, {})
+                    counts[line_name] = counts.get(line_name, 0) + count
+
+        return data
+
     def call(self, relations=None, subject_attr=None, object_attr=None,
              rset=None, title="", **kwargs):
         """ Method that will create a table view from a cw resultset.
@@ -385,17 +533,36 @@ class HighChartsBasicPlotView(View):
         sdata: string
             the highcharts formated parameter
         """
-        # Get the first element of each resultset row and store it if it is
-        # a float
-        data = []
-        for element in rset.rows:
+        # Get the first element of each resultset row
+        return self.counts_to_hist([(element[0], 1) for element in rset.rows])
+
+    def counts_to_hist(self, counts):
+        """ Method that format aggregated counts for highcharts plot.
+
+        Parameters
+        ----------
+        counts: list of 2-uplet (mandatory)
+            the (value, count) pairs, the values that are not floats are
+            ignored.
+
+        Returns
+        -------
+        sdata: string
+            the highcharts formated parameter
+        """
+        # Store the values if they are floats
+        values = []
+        weights = []
+        for value, count in counts:
             try:
-                data.append(float(element[0]))
+                values.append(float(value))
             except:
-                pass
+                continue
+            weights.append(count)
 
-        # Create the histogram with numpy
-        hist, bin_edges = numpy.histogram(data, density=True, bins=10)
+        # Create the histogram with numpy: the counts are used as weights
+        hist, bin_edges = numpy.histogram(values, weights=weights,
+                                          density=True, bins=10)
         bin_center = ["%.1f" % ((bin_edges[i] + bin_edges[i+1]) / 2.)
                       for i in range(len(bin_edges) - 1)]
         hist = [str(value) for value in hist]
@@ -409,7 +576,8 @@ class HighChartsBasicPlotView(View):
         return sdata
 
     def call(self, rset=None, title="", value_suffix="", is_hist=False,
-             y_label="", data=None, tag="hc_container", **kwargs):
+             y_label="", data=None, tag="hc_container", chart_rql=None,
+             **kwargs):
         """ Method that will create a basic plot from a cw resultset.
 
         If no resultset are passed to this method, the current resultset is
@@ -433,6 +601,10 @@ class HighChartsBasicPlotView(View):
             effect.
         tag: str (optional, default 'hc_container')
             the html div identifier.
+        chart_rql: str (optional, default None)
+            an aggregated request whose rows are (value, count) pairs. If set
+            with the 'is_hist' option, the histogram is computed from the
+            counts and the rset is ignored.
         """
         # Get the cw resultset
         rset = rset or self.cw_rset
@@ -443,13 +615,18 @@ class HighChartsBasicPlotView(View):
         value_suffix = value_suffix or self._cw.form.get("value_suffix", "")
         is_hist = is_hist or self._cw.form.get("is_hist", False)
         data = data or self._cw.form.get("data", None)
+        chart_rql = chart_rql or self._cw.form.get("chart_rql", None)
 
         # Get the highcharts string representation of the data
         if data is None:
             if is_hist:
                 value_suffix = "Probability"
                 y_label = "Probability"
-                data = self.rset_to_hist(rset)
+                if chart_rql is not None:
+                    data = self.counts_to_hist(
+                        get_grouped_counts(self._cw, chart_rql))
+                else:
+                    data = self.rset_to_hist(rset)
             else:
                 raise NotImplementedError
                 #data = self.rset_to_data(rset)
@@ -0,0 +1,150 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2017
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# System import
+import os
+import json
+import hashlib
+from email.utils import parsedate_tz
+from email.utils import mktime_tz
+
+# Cubicweb import
+from cubicweb.web import DirectResponse
+from cubicweb.web.httpcache import EtagHTTPCacheManager
+from cubicweb.etwist.http import HTTPResponse
+
+
+def file_validators(paths, *parts):
+    """ Compute the HTTP cache validators of a response that only depends on
+    the content of some files: only the files are stat'ed.
+
+    Parameters
+    ----------
+    paths: list of str
+        the files the response is generated from.
+    parts: list
+        the other JSON serializable items the response depends on, ie. the
+        request parameters.
+
+    Returns
+    -------
+    etag: str
+        the entity tag built from the file paths, sizes and modification
+        times.
+    last_modified: int
+        the most recent file modification time, as a timestamp.
+    """
+    identities = []
+    last_modified = 0
+    for path in paths:
+        stat = os.stat(path)
+        identities.append([os.path.abspath(path), stat.st_size,
+                           int(stat.st_mtime)])
+        last_modified = max(last_modified, int(stat.st_mtime))
+    etag = hashlib.md5(json.dumps([identities, list(parts)])).hexdigest()
+    return etag, last_modified
+
+
+def set_file_cache_headers(req, paths, *parts):
+    """ Set the 'ETag', 'Last-Modified' and 'Cache-Control' headers of a
+    response that only depends on the content of some files.
+
+    The 'Cache-Control' value is defined by the 'http-cache-control'
+    option.
+
+    Parameters
+    ----------
+    req: Request
+        the current request.
+    paths: list of str
+        the files the response is generated from.
+    parts: list
+        the other JSON serializable items the response depends on.
+
+    Returns
+    -------
+    etag: str
+        the entity tag.
+    last_modified: int
+        the most recent file modification time, as a timestamp.
+    """
+    etag, last_modified = file_validators(paths, *parts)
+    req.set_header("ETag", "\"{0}\"".format(etag))
+    req.set_header("Last-Modified", last_modified, raw=False)
+    req.set_header("Cache-Control", req.vreg.config["http-cache-control"])
+    return etag, last_modified
+
+
+def is_not_modified(req, etag, last_modified):
+    """ Check the request conditional headers against the response
+    validators.
+
+    Parameters
+    ----------
+    req: Request
+        the current request.
+    etag: str
+        the response entity tag.
+    last_modified: int
+        the response modification time, as a timestamp.
+
+    Returns
+    -------
+    not_modified: bool
+        True if the client copy is still valid.
+    """
+    if_none_match = req.get_header("If-None-Match")
+    if if_none_match:
+        etags = [item.strip() for item in if_none_match.split(",")]
+        return "*" in etags or "\"{0}\"".format(etag) in etags
+    if_modified_since = req.get_header("If-Modified-Since")
+    if if_modified_since:
+        since = parsedate_tz(if_modified_since)
+        return since is not None and last_modified <= mktime_tz(since)
+    return False
+
+
+def validate_file_cache(req, paths, *parts):
+    """ Set the HTTP cache headers of a response that only depends on the
+    content of some files and answer '304 Not Modified' if the client copy
+    is still valid: the response is not generated at all.
+
+    This function is meant for the ajax callbacks, the views define the
+    'FileHTTPCacheManager' HTTP cache manager instead.
+
+    Parameters
+    ----------
+    req: Request
+        the current request.
+    paths: list of str
+        the files the response is generated from.
+    parts: list
+        the other JSON serializable items the response depends on.
+    """
+    etag, last_modified = set_file_cache_headers(req, paths, *parts)
+    if is_not_modified(req, etag, last_modified):
+        response = HTTPResponse(code=304,
+                                headers=req.headers_out,
+                                twisted_request=req._twreq)
+        raise DirectResponse(response)
+
+
+class FileHTTPCacheManager(EtagHTTPCacheManager):
+    """ HTTP cache manager of the views that only depend on the content of
+    some files: the view 'cache_files' method returns the files and the
+    other items the view depends on. The '304 Not Modified' response is
+    sent by the view controller when the validators match.
+
+    If the view returns no file, the view is not cached.
+    """
+    def set_headers(self):
+        paths, parts = self.view.cache_files()
+        if not paths:
+            self.req.set_header("Cache-Control", "no-cache")
+            return
+        set_file_cache_headers(self.req, paths, *parts)
@@ -11,9 +11,6 @@ import nibabel
 import os
 import numpy
 import json
-import base64
-import StringIO
-import PIL
 from packaging import version
 
 # Cubicweb import
@@ -26,6 +23,19 @@ from cubicweb.view import View
 from cubicweb.web.views.ajaxcontroller import ajaxfunc
 from cubicweb.predicates import authenticated_user
 
+# Package import
+from cubes.piws.views.streaming import direct_stream
+from cubes.piws.views.streaming import gzip_stream
+from cubes.piws.views.httpcache import validate_file_cache
+from cubes.piws.imaging.brainbrowser import build_brainbrowser_header
+from cubes.piws.imaging.brainbrowser import get_encoded_image
+from cubes.piws.imaging.brainbrowser import encode_image_slice
+from cubes.piws.imaging.brainbrowser import get_pyramid_level
+from cubes.piws.imaging.brainbrowser import get_intensity_range
+from cubes.piws.imaging.brainbrowser import rescale_image
+from cubes.piws.imaging.brainbrowser import PYRAMID_FACTORS
+from cubes.piws.imaging.brainbrowser import VOLUME_DTYPES
+
 
 ###############################################################################
 # BrainBrowser
@@ -39,6 +49,12 @@ class ImageViewer(View):
     title = _("Brainbrowser")
     paginable = False
     div_id = "brainbrowser-simple"
+    # Number of slices requested on each side of the displayed slices of
+    # the three planes by the lazy loader
+    slice_prefetch = 8
+    # Pyramid levels loaded successively by the binary loader, from the
+    # coarsest to the full resolution (level 0)
+    pyramid_levels = [2, 1, 0]
 
     def __init__(self, *args, **kwargs):
         """ Initialize the ImageViewer class.
@@ -111,6 +127,7 @@ class ImageViewer(View):
         self._cw.add_js("brainbrowser-2.3.0/src/brainbrowser/"
                         "volume-viewer/volume-loaders/minc.js")
         self._cw.add_js("image_viewer.js")
+        self._cw.add_js("brainbrowser_lazy_loader.js")
 
         # Set the brainbrowser viewer navigation tools
         html = self.build_brainbrowser_tools()
@@ -128,7 +145,7 @@ class ImageViewer(View):
         # Define global javascript variables
         html += "<script type='text/javascript'>"
         html += "var quality = 50;"
-        html += "var ajaxcallback = 'get_brainbrowser_image';"
+        html += "var ajaxcallback = 'get_brainbrowser_volume';"
         html += "</script>"
 
         # Set brainbrowser nifti image loader
@@ -175,14 +192,39 @@ class ImageViewer(View):
         # Display wait message
         html += "$('#loading').show();"
 
-        # Execute the ajax callback
+        # Lazy volume: only the displayed slices of the three planes and a
+        # prefetch window are requested
+        html += "if (ajaxcallback == 'get_brainbrowser_slice') {"
+        html += ("loadLazyBrainBrowserVolume('{0}', description, quality, "
+                 "{1}, function(volume) {{".format(
+                    self._cw.base_url(), self.slice_prefetch))
+        html += "$('#loading').hide();"
+        html += "callback(volume);"
+        html += "});"
+        html += "return;"
+        html += "}"
+
+        # Binary volume: the pyramid levels are received in ArrayBuffers,
+        # from the coarsest to the full resolution
+        html += "if (ajaxcallback == 'get_brainbrowser_volume') {"
+        html += ("loadPyramidBrainBrowserVolume('{0}', description, {1}, "
+                 "function(volume) {{".format(
+                    self._cw.base_url(), json.dumps(self.pyramid_levels)))
+        html += "$('#loading').hide();"
+        html += "callback(volume);"
+        html += "});"
+        html += "return;"
+        html += "}"
+
+        # Execute the ajax callback: a GET request, so that the browser
+        # revalidates its cached copy and gets a '304 Not Modified' answer
         html += "var postData = {};"
         html += "postData.imagefile = description.data_file;"
         html += "postData.dquality = quality;"
         html += "var post = $.ajax({"
         html += "url: '{0}ajax?fname=' + ajaxcallback,".format(
             self._cw.base_url())
-        html += "type: 'POST',"
+        html += "type: 'GET',"
         html += "data: postData"
         html += "});"
 
@@ -398,7 +440,7 @@ class ImageViewer(View):
 
         # Raw data are requested
         html += "if ($('#volume-quality').val() === 'RAW') {"
-        html += "ajaxcallback = 'get_brainbrowser_image';"
+        html += "ajaxcallback = 'get_brainbrowser_volume';"
         html += "}"
 
         # Low quality encoded data are requested
@@ -407,9 +449,15 @@ class ImageViewer(View):
         html += "quality = 50;"
         html += "}"
 
+        # Encoded slices are requested on demand
+        html += "else if ($('#volume-quality').val() === 'LAZY JPEG') {"
+        html += "ajaxcallback = 'get_brainbrowser_slice';"
+        html += "quality = 50;"
+        html += "}"
+
         # Add out of range event
         html += "else {"
-        html += "ajaxcallback = 'get_brainbrowser_image';"
+        html += "ajaxcallback = 'get_brainbrowser_volume';"
         html += "}"
 
         # Show the new image representation
@@ -717,6 +765,7 @@ class ImageViewer(View):
         # Define item to change the panle size
         html += "<select id='volume-quality'>"
         html += "<option value='RAW' SELECTED>RAW</option>"
+        html += "<option value='LAZY JPEG'>LAZY JPEG</option>"
         # html += "<option value='LOW JPEG' SELECTED>LOW JPEG</option>"
         html += "</select>"
 
@@ -764,91 +813,15 @@ def get_encoded_brainbrowser_image(self):
     # Get post parameters
     imagefile = self._cw.form["imagefile"]
     dquality = int(self._cw.form["dquality"])
-    dtype = "JPEG"
 
-    # Load the image
-    im = nibabel.load(imagefile)
-    header = im.get_header()
-    data = im.get_data()
-
-    # Change the dynamic of the image intensities
-    data = numpy.cast[numpy.uint8](
-        (data - data.min()) * 255. / (data.max() - data.min()))
-
-    # Build header and encode images
-    dim = header["dim"]
-    order = ["time", "xspace", "yspace", "zspace"]
-    encoded_data = []
-    if dim[0] == 3:
-
-        # Build header
-        header = {
-            "order": order[1:],
-            "xspace": {
-                "start": float(header["qoffset_x"]),
-                "space_length": int(dim[1]),
-                "step": float(header["pixdim"][1]),
-                "direction_cosines": [float(x) for x in header["srow_x"][:3]]},
-            "yspace": {
-                "start": float(header["qoffset_y"]),
-                "space_length": int(dim[2]),
-                "step": float(header["pixdim"][2]),
-                "direction_cosines": [float(x) for x in header["srow_y"][:3]]},
-            "zspace": {
-                "start": float(header["qoffset_z"]),
-                "space_length": int(dim[3]),
-                "step": float(header["pixdim"][3]),
-                "direction_cosines": [float(x) for x in header["srow_z"][:3]]},
-        }
-
-        # Encode the slice image data
-        for index in range(data.shape[0]):
-            slicedata = data[index]
-            openfile = StringIO.StringIO()
-            img = PIL.Image.fromarray(slicedata)
-            img.save(openfile, format=dtype, quality=dquality)
-            contents = openfile.getvalue()
-            openfile.close()
-            encoded_data.append(base64.b64encode(contents))
-
-    elif dim[0] == 4:
-
-        # Build header
-        header = {
-            "order": order,
-            "xspace": {
-                "start": float(header["qoffset_x"]),
-                "space_length": int(dim[1]),
-                "step": float(header["pixdim"][1]),
-                "direction_cosines": [float(x) for x in header["srow_x"][:3]]},
-            "yspace": {
-                "start": float(header["qoffset_y"]),
-                "space_length": int(dim[2]),
-                "step": float(header["pixdim"][2]),
-                "direction_cosines": [float(x) for x in header["srow_y"][:3]]},
-            "zspace": {
-                "start": float(header["qoffset_z"]),
-                "space_length": int(dim[3]),
-                "step": float(header["pixdim"][3]),
-                "direction_cosines": [float(x) for x in header["srow_z"][:3]]},
-            "time": {
-                "start": 0,
-                "space_length": int(dim[4])}
-        }
-
-        # Encode the slice image data
-        data = numpy.transpose(data, (3, 0, 1, 2))
-        for timepoint in range(data.shape[0]):
-            for index in range(data.shape[1]):
-                slicedata = data[timepoint, index]
-                openfile = StringIO.StringIO()
-                img = PIL.Image.fromarray(slicedata)
-                img.save(openfile, format=dtype)
-                contents = openfile.getvalue()
-                openfile.close()
-                encoded_data.append(base64.b64encode(contents))
-    else:
-        raise Exception("Only 3D or 3D + t images are currently supported!")
+    # Answer '304 Not Modified' if the client copy is still valid
+    validate_file_cache(
+        self._cw, [imagefile], "get_encoded_brainbrowser_image", dquality,
+        self._cw.vreg.config["image-normalization"])
+
+    # Get the encoded slices from the slice cache
+    header, encoded_data = get_encoded_image(
+        self._cw.vreg.config, imagefile, dquality)
 
     # Format the output
     im_info = {
@@ -871,69 +844,31 @@ def get_brainbrowser_image(self):
     # Get post parameters
     imagefile = self._cw.form["imagefile"]
 
-    # Load the image
+    # Answer '304 Not Modified' if the client copy is still valid
+    validate_file_cache(self._cw, [imagefile], "get_brainbrowser_image",
+                        self._cw.vreg.config["image-normalization"])
+
+    # Load the image and change the dynamic of the image intensities slab
+    # by slab
     im = nibabel.load(imagefile)
     header = im.get_header()
     try:
-        data = im.get_data()
+        data = rescale_image(
+            imagefile, get_intensity_range(self._cw.vreg.config, imagefile),
+            dtype="uint16")
     # Missing bytes intern specific error that can be overcome with
     # an old lib
     except:
         import nifti
         im = nifti.NiftiImage(imagefile)
         data = im.getDataArray().T
-
-    # Change the dynamic of the image intensities
-    data = numpy.cast[numpy.uint16](
-        (data - data.min()) * 65535. / (data.max() - data.min()))
+        data = numpy.cast[numpy.uint16](
+            (data - data.min()) * 65535. / (data.max() - data.min()))
+        if data.ndim == 4:
+            data = numpy.transpose(data, (3, 0, 1, 2))
 
     # Format the output
-    dim = header["dim"]
-    order = ["time", "xspace", "yspace", "zspace"]
-    if dim[0] == 3:
-        header = {
-            "order": order[1:],
-            "xspace": {
-                "start": float(header["qoffset_x"]),
-                "space_length": int(dim[1]),
-                "step": float(header["pixdim"][1]),
-                "direction_cosines": [float(x) for x in header["srow_x"][:3]]},
-            "yspace": {
-                "start": float(header["qoffset_y"]),
-                "space_length": int(dim[2]),
-                "step": float(header["pixdim"][2]),
-                "direction_cosines": [float(x) for x in header["srow_y"][:3]]},
-            "zspace": {
-                "start": float(header["qoffset_z"]),
-                "space_length": int(dim[3]),
-                "step": float(header["pixdim"][3]),
-                "direction_cosines": [float(x) for x in header["srow_z"][:3]]},
-        }
-    elif dim[0] == 4:
-        header = {
-            "order": order,
-            "xspace": {
-                "start": float(header["qoffset_x"]),
-                "space_length": int(dim[1]),
-                "step": float(header["pixdim"][1]),
-                "direction_cosines": [float(x) for x in header["srow_x"][:3]]},
-            "yspace": {
-                "start": float(header["qoffset_y"]),
-                "space_length": int(dim[2]),
-                "step": float(header["pixdim"][2]),
-                "direction_cosines": [float(x) for x in header["srow_y"][:3]]},
-            "zspace": {
-                "start": float(header["qoffset_z"]),
-                "space_length": int(dim[3]),
-                "step": float(header["pixdim"][3]),
-                "direction_cosines": [float(x) for x in header["srow_z"][:3]]},
-            "time": {
-                "start": 0,
-                "space_length": int(dim[4])}
-        }
-        data = numpy.transpose(data, (3, 0, 1, 2))
-    else:
-        raise Exception("Only 3D or 3D + t images are currently supported!")
+    header = build_brainbrowser_header(header)
 
     # Format the output
     im_info = {
@@ -944,11 +879,178 @@ def get_brainbrowser_image(self):
     return im_info
 
 
+def iter_buffer(array, chunk_size=1048576):
+    """ Iterate over the memory of a contiguous array without copy.
+
+    Parameters
+    ----------
+    array: array
+        a C contiguous array.
+    chunk_size: int (optional, default 1048576)
+        the size of the chunks in bytes.
+
+    Returns
+    -------
+    chunks: generator of buffer
+        read-only views on the array memory.
+    """
+    for offset in range(0, array.nbytes, chunk_size):
+        yield buffer(array, offset, chunk_size)
+
+
+@ajaxfunc
+def get_brainbrowser_volume(self):
+    """ Get an image buffer and information: formated for BrainBrowser.
+
+    The intensities are rescaled with the cached image intensity range
+    (see the 'image-normalization' option) and sent as a raw little-endian
+    buffer (optionally gzip compressed), the BrainBrowser header is sent as
+    JSON in the 'X-Volume-Header' HTTP header and the buffer shape in the
+    'X-Volume-Shape' HTTP header.
+
+    Attributes
+    ----------
+    imagefile: str
+        the image path.
+    dtype: str (optional, default 'uint16')
+        the buffer data type: 'uint8' or 'uint16'.
+    gzip: int (optional, default 1)
+        if 1, compress the buffer.
+    level: int (optional, default 0)
+        the pyramid level: 0 for the full resolution, 1 and 2 for the
+        volumes downsampled by 2 and 4 (see 'PYRAMID_FACTORS'), that are
+        cached on disk.
+    """
+    # Get post parameters
+    imagefile = self._cw.form["imagefile"]
+    dtype = self._cw.form.get("dtype", "uint16")
+    if dtype not in VOLUME_DTYPES:
+        raise ValueError("'{0}' data type not supported, expect one of "
+                         "{1}.".format(dtype, sorted(VOLUME_DTYPES)))
+    compress = self._cw.form.get("gzip", "1") == "1"
+    level = int(self._cw.form.get("level", 0))
+    if not 0 <= level < len(PYRAMID_FACTORS):
+        raise ValueError("Pyramid level {0} not supported, expect a value "
+                         "in [0, {1}[.".format(level, len(PYRAMID_FACTORS)))
+
+    # Answer '304 Not Modified' if the client copy is still valid
+    validate_file_cache(self._cw, [imagefile], "get_brainbrowser_volume",
+                        dtype, compress, level,
+                        self._cw.vreg.config["image-normalization"])
+
+    # Get a downsampled volume
+    if level > 0:
+        header, data = get_pyramid_level(self._cw.vreg.config, imagefile,
+                                         level, dtype)
+
+    # Load the image and change the dynamic of the image intensities slab
+    # by slab: the full resolution volume is never converted to float
+    else:
+        im = nibabel.load(imagefile)
+        header = build_brainbrowser_header(im.get_header())
+        try:
+            data = rescale_image(
+                imagefile,
+                get_intensity_range(self._cw.vreg.config, imagefile),
+                dtype=dtype)
+        # Missing bytes intern specific error that can be overcome with
+        # an old lib
+        except:
+            import nifti
+            im = nifti.NiftiImage(imagefile)
+            data = im.getDataArray().T
+            data = numpy.cast[dtype](
+                (data - data.min()) * float(numpy.iinfo(dtype).max) /
+                (data.max() - data.min()))
+            if data.ndim == 4:
+                data = numpy.transpose(data, (3, 0, 1, 2))
+    data = numpy.ascontiguousarray(data)
+
+    # Send the buffer
+    self._cw.set_header("X-Volume-Header", json.dumps(header))
+    self._cw.set_header("X-Volume-Shape", json.dumps(list(data.shape)))
+    self._cw.set_header("X-Volume-Dtype", dtype)
+    chunks = iter_buffer(data)
+    if compress:
+        self._cw.set_header("content-encoding", "gzip")
+        chunks = gzip_stream(chunks)
+    else:
+        chunks = (str(chunk) for chunk in chunks)
+    direct_stream(self._cw, chunks, "application/octet-stream")
+
+
+@ajaxfunc(output_type="json")
+def get_brainbrowser_header(self):
+    """ Get the image information: formated for BrainBrowser.
+
+    Attributes
+    ----------
+    imagefile: str
+        the image path.
+
+    Returns
+    -------
+    im_info: dict
+        the BrainBrowser header and the image shape.
+    """
+    # Get post parameters
+    imagefile = self._cw.form["imagefile"]
+
+    # Load the image header only
+    im = nibabel.load(imagefile)
+
+    # Format the output
+    im_info = {
+        "header": json.dumps(build_brainbrowser_header(im.get_header())),
+        "shape": [int(dim) for dim in im.shape]
+    }
+
+    return im_info
+
+
+@ajaxfunc
+def get_brainbrowser_slice(self):
+    """ Get one encoded slice of an image.
+
+    Attributes
+    ----------
+    imagefile: str
+        the image path.
+    axis: int (optional, default 0)
+        the slicing axis.
+    index: int
+        the slice index along the axis.
+    timepoint: int (optional, default 0)
+        the volume index of 4D images.
+    quality: int (optional, default 50)
+        the JPEG encoding quality.
+    """
+    # Get parameters
+    imagefile = self._cw.form["imagefile"]
+    axis = int(self._cw.form.get("axis", 0))
+    index = int(self._cw.form["index"])
+    timepoint = int(self._cw.form.get("timepoint", 0))
+    quality = int(self._cw.form.get("quality", 50))
+
+    # Answer '304 Not Modified' if the client copy is still valid
+    validate_file_cache(self._cw, [imagefile], "get_brainbrowser_slice",
+                        axis, index, timepoint, quality,
+                        self._cw.vreg.config["image-normalization"])
+
+    # Send the encoded slice
+    contents = encode_image_slice(self._cw.vreg.config, imagefile, axis,
+                                  index, timepoint, quality)
+    direct_stream(self._cw, [contents], "image/jpeg")
+
+
 ###############################################################################
 # Update CW registery
 ###############################################################################
 
 def registration_callback(vreg):
+    vreg.register(get_brainbrowser_volume)
+    vreg.register(get_brainbrowser_header)
+    vreg.register(get_brainbrowser_slice)
     vreg.register(get_brainbrowser_image)
     vreg.register(get_encoded_brainbrowser_image)
     vreg.register(ImageViewer)
@@ -17,6 +17,91 @@ if cw_version >= version.parse("3.21.0"):
     from cubicweb import _
 
 from cubicweb.view import View
+from cubicweb.web.views.ajaxcontroller import ajaxfunc
+from logilab.mtconverter import xml_escape
+
+# Package import
+from cubes.piws.views.highcharts_views import get_chart_cache
+from cubes.piws.views.table_views import table_cache_key
+
+
+# The answer types that are followed accross the timepoints
+NUMERIC_ANSWERS_RTYPE = ("int", "float")
+
+
+def get_longitudinal_measures(req, rql):
+    """ Get the digit answers of questionnaire runs organized by
+    questionnaire, question and timepoint.
+
+    The answers are fetched with a fixed number of requests whatever the
+    number of questionnaire runs, and cached per request and user groups
+    until the next data modification.
+
+    Parameters
+    ----------
+    req: Request
+        the current request.
+    rql: str
+        a request that returns the questionnaire runs in its first column.
+
+    Returns
+    -------
+    questionnaires: dict
+        the answers: {questionnaire: {question: {timepoint: value}}}.
+    """
+    # Check the cache
+    chart_cache = get_chart_cache(req.vreg.config)
+    chart_key = table_cache_key(req, "questionnaire-longitudinal-measures",
+                                rql=rql)
+    questionnaires = chart_cache.get(chart_key)
+    if questionnaires is not None:
+        return questionnaires
+
+    # Get the questionnaire runs
+    questionnaires = {}
+    eids = ", ".join(set(str(row[0]) for row in req.execute(rql)))
+    if eids == "":
+        chart_cache.set(chart_key, questionnaires)
+        return questionnaires
+
+    # Case 1: the answers are inserted in the database (open answers)
+    for rtype in NUMERIC_ANSWERS_RTYPE:
+        rset = req.execute(
+            "Any QN, QT, T, V WHERE QR eid IN ({0}), QR questionnaire Q, "
+            "Q name QN, QR in_assessment A, A timepoint T, "
+            "QR {1}_answers O, O question QU, QU text QT, "
+            "O value V".format(eids, rtype))
+        for qname, question, timepoint, value in rset:
+            questionnaires.setdefault(qname, {}).setdefault(
+                question, {})[timepoint] = value
+
+    # Case 2: one line of answers inserted per subject (File), only the
+    # answers to the questionnaire questions are considered
+    rset = req.execute(
+        "Any QN, T, D WHERE QR eid IN ({0}), QR questionnaire Q, Q name QN, "
+        "QR in_assessment A, A timepoint T, QR file F, "
+        "F data D".format(eids))
+    if rset.rowcount > 0:
+        questions = {}
+        for qname, question in req.execute(
+                "DISTINCT Any QN, QT WHERE QR eid IN ({0}), "
+                "QR questionnaire Q, Q name QN, Q questions QU, "
+                "QU text QT".format(eids)):
+            questions.setdefault(qname, set()).add(unicode(question))
+        for qname, timepoint, data in rset:
+            answers = json.loads(data.getvalue())
+            for question, answer in answers.items():
+                if question not in questions.get(qname, ()):
+                    continue
+                try:
+                    value = float(answer)
+                except Exception:
+                    continue
+                questionnaires.setdefault(qname, {}).setdefault(
+                    question, {})[timepoint] = value
+
+    chart_cache.set(chart_key, questionnaires)
+    return questionnaires
 
 
 class QuestionnaireLongitudinalView(View):
@@ -33,7 +118,9 @@ class QuestionnaireLongitudinalView(View):
         If no resultset are passed to this method, the current resultset is
         used.
 
-        Only digits answers are considered.
+        Only digits answers are considered. Only the measure selector is
+        generated: the selected measure is requested with the
+        'get_longitudinal_measure' ajax callback.
 
         Parameters
         ----------
@@ -56,62 +143,24 @@ class QuestionnaireLongitudinalView(View):
         )
 
         # Get the data from the result set
-        questionnaires = {}
-        for line_number in range(rset.rowcount):
-
-            # Get the questionnaire run entity
-            qr_entity = rset.get_entity(line_number, 0)
-
-            # Get the questionnaire run timepoint
-            timepoint = qr_entity.in_assessment[0].timepoint
-
-            # Get the associated questionnaire/questions
-            q_entity = qr_entity.questionnaire[0]
-            if q_entity.name not in questionnaires:
-                questionnaires[q_entity.name] = dict(
-                    (unicode(entity.text), {})
-                    for entity in q_entity.questions)
-
-            # Get the questionnaire run associated answers and fill the
-            # 'questionnaires' structure
-            # > case 1: one line of answers inserted per subject (File)
-            # > case 2: the answers are inserted in the database (open answers)
-            if len(qr_entity.file) > 0:
-                answers = json.loads(qr_entity.file[0].data.getvalue())
-                for qname, answer in answers.items():
-                    try:
-                        questionnaires[q_entity.name][qname][
-                            timepoint] = float(answer)
-                    except Exception:
-                        continue
-            else:
-                answer_entities = (list(qr_entity.int_answers) +
-                                   list(qr_entity.float_answers))
-                for entity in answer_entities:
-                    questionnaires[q_entity.name][entity.question[0].text][
-                        timepoint] = entity.value
+        rql = rset.printable_rql()
+        questionnaires = get_longitudinal_measures(self._cw, rql)
 
         # Create a selector
         html = "<h1>Longitudinal scores follow up</h1>"
         html += "<hr>"
         html += ("<h2>Please select a measure to follow accross the "
                  "timepoints in this list:</h2>")
-        html += "<select class='selectpicker' data-live-search='true'>"
+        html += ("<select id='longitudinal-selector' class='selectpicker' "
+                 "data-live-search='true'>")
         html += "<option></option>"
-        for questionnaire_name, questions in questionnaires.iteritems():
+        for questionnaire_name, questions in sorted(questionnaires.items()):
             html += "<optgroup label='{0}' data-icon='glyphicon-heart'>".format(
                 questionnaire_name)
-            for question_name, question_item in questions.iteritems():
-
-                # Get the plot data
-                data = sorted(question_item.items())
-                values = [p[1] for p in data]
-                if len(values) == 0:
-                    continue
-
-                # Check if we are dealing with numbers
-                html += u"<option value='{0}'>{0}</option>".format(
-                    question_name)
+            for question_name in sorted(questions):
+                html += u"<option value='{0}' data-questionnaire='{1}'>{0}" \
+                         "</option>".format(xml_escape(question_name),
+                                            xml_escape(questionnaire_name))
             html += "</optgroup>"
         html += "</select>"
 
@@ -119,45 +168,32 @@ class QuestionnaireLongitudinalView(View):
         html += ("<div id='longitudinal-plot' style='min-width: 310px; "
                  "height: 400px; max-width: 600px; margin: 0 auto'></div>")
 
-        # Convert the input data
+        # Add an event when the selection change: request the selected
+        # measure
         html += "<script type='text/javascript'>"
-        html += "var jdata = {};"
-        for q_name, q_item in questionnaires.iteritems():
-            for question_name, question_item in q_item.iteritems():
-
-                # Get the plot data
-                data = sorted(question_item.items())
-                values = [p[1] for p in data]
-                if len(values) == 0:
-                    continue
-
-                # Check if we are dealing with numbers
-                html += u"var sdata = {};"
-                print u"sdata['related_question'] = '{0}';".format(question_name)
-                html += u"sdata['x'] = [];"
-                html += u"sdata['grid'] = [];"
-                html += u"sdata['related_question'] = '{0}';".format(question_name)
-                html += u"sdata['related_questionnaire'] = '{0}';".format(q_name)
-                for p in data:
-                    html += u"sdata['x'].push('{0}');".format(p[0])
-                    html += u"sdata['grid'].push({0});".format(p[1])
-                html += u"jdata['{0}'] = sdata;".format(question_name)
-
-        # Add an event when the selection change
         html += "$(function() {"
-        html += "$('.selectpicker').on('change', function(){"
-        html += "var selected = $(this).find('option:selected').val();"
-        html += "if (selected != ''){"
+        html += "$('#longitudinal-selector').on('change', function(){"
+        html += "var selected = $(this).find('option:selected');"
+        html += "if (selected.val() != ''){"
+        html += "$.ajax({"
+        html += "url: 'ajax?fname=get_longitudinal_measure',"
+        html += "method: 'POST',"
+        html += "data: {{'rql': {0}, ".format(json.dumps(rql))
+        html += "'questionnaire': selected.attr('data-questionnaire'), "
+        html += "'question': selected.val()},"
+        html += "dataType: 'json'"
+        html += "}).done(function(sdata){"
         html += "$('#longitudinal-plot').highcharts({"
         html += "credits : {enabled : false}, "
-        html += ("title: {{text: jdata[selected]['related_questionnaire'] + "
-                 "'-' + jdata[selected]['related_question'] + "
+        html += ("title: {{text: sdata['related_questionnaire'] + "
+                 "'-' + sdata['related_question'] + "
                  "': {0}'}},".format(patient_id))
-        html += "xAxis: {categories: jdata[selected]['x']},"
+        html += "xAxis: {categories: sdata['x']},"
         html += "yAxis: {title: {text: ''}},"
         html += "legend: {layout: 'vertical', align: 'right', verticalAlign:"
         html += "'middle', borderWidth: 0},"
-        html += "series: [{name: 'longitudinal', data: jdata[selected]['grid']}]"
+        html += "series: [{name: 'longitudinal', data: sdata['grid']}]"
+        html += "});"
         html += "});"
         html += "}"
         html += "});"
@@ -166,3 +202,39 @@ class QuestionnaireLongitudinalView(View):
 
         # Display the page content
         self.w(unicode(html))
+
+
+@ajaxfunc(output_type="json")
+def get_longitudinal_measure(self):
+    """ Get the values of a questionnaire question accross the timepoints.
+
+    Attributes
+    ----------
+    rql: str
+        a request that returns the questionnaire runs in its first column.
+    questionnaire: str
+        the questionnaire name.
+    question: str
+        the question text.
+
+    Returns
+    -------
+    sdata: dict
+        the highcharts formated data: the sorted timepoints 'x' and the
+        associated values 'grid'.
+    """
+    # Get parameters
+    rql = self._cw.form["rql"]
+    questionnaire = self._cw.form["questionnaire"]
+    question = self._cw.form["question"]
+
+    # Get the measure
+    questionnaires = get_longitudinal_measures(self._cw, rql)
+    data = sorted(questionnaires.get(questionnaire, {}).get(
+        question, {}).items())
+
+    return {
+        "related_questionnaire": questionnaire,
+        "related_question": question,
+        "x": [item[0] for item in data],
+        "grid": [item[1] for item in data]}
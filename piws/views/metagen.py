@@ -29,7 +29,31 @@ from cubicweb.predicates import authenticated_user
 
 # Package import
 from cubes.piws.metagen.genotype import genotype_measure
-from cubes.piws.metagen.genotype import get_genes
+from cubes.piws.metagen.genotype import genotype_measure_chunks
+from cubes.piws.metagen.genotype import encode_genotype_chunks
+from cubes.piws.metagen.genotype import resolve_snp_ids
+from cubes.piws.metagen.genotype import open_plink_bed_bim_fam_dataset
+from cubes.piws.metagen.genotype import genotype_summary_statistics
+from cubes.piws.metagen.genotype import GENOTYPE_CHUNK_AXES
+from cubes.piws.metagen.genotype import GENOTYPE_ENCODINGS
+from cubes.piws.metagen.resolvers import get_metagen_resolver
+from cubes.piws.metagen.index import get_gene_prefix_index
+from cubes.piws.views.streaming import direct_stream
+from cubes.piws.views.table_views import table_cache_key
+from cubes.piws.views.table_views import get_cached_table
+from cubes.piws.cache.disk import get_disk_cache
+
+
+# Number of genes returned by the gene autocomplete
+GENE_AUTOCOMPLETE_LIMIT = 20
+GENE_AUTOCOMPLETE_MAX_LIMIT = 200
+
+# Map the genotype stream encodings to the response content types
+STREAM_CONTENT_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "int8": "application/octet-stream"
+}
 
 
 class MetaGenSearchView(View):
@@ -49,6 +73,15 @@ class MetaGenSearchView(View):
       'metagen' will export the genomic metadata reference from the selected
       genes only, 'ref'  will export the genomic metadata reference from the
       selected filtering options: ...&export=ref&...
+
+    In the JSON view, the measured genomic data can also be streamed with
+    three extra parameters:
+    - stream (optional, default None): the stream encoding, 'csv', 'ndjson'
+      or 'int8' (raw int8 bytes after a JSON header line): ...&stream=csv&...
+    - chunk_axis (optional, default 'subject'): the genotypes are read and
+      emitted by chunks of 'subject' or 'snp': ...&chunk_axis=snp&...
+    - chunk_size (optional, default 1000): the number of subjects or snps
+      read from the .bed file at a time: ...&chunk_size=500&...
     """
     __regid__ = "metagen-search"
     __select__ = authenticated_user()
@@ -103,43 +136,45 @@ class MetaGenSearchView(View):
             self.w(u"<b>Export Type</b>: {0}<br/>".format(export_type))     
         
         # Get the genomic measure associated plink files
-        rset = self._cw.execute(
-            "Any G Where G is GenomicMeasure, G label '{0}'".format(measure))
-        if rset.rowcount != 1:
-            msg = u"'{0}' genomic measure(s) detected, one expected.".format(
-                rset.rowcount)
+        try:
+            root, plinkfiles = self.get_plink_dataset(measure)
+        except ValueError as e:
+            msg = unicode(e)
             if self._display:
                 self.error(msg)
             else:
                 self.w(unicode(json.dumps({"error": msg})))
             return
-        egmeasure = rset.get_entity(0, 0)
-        plinkfiles = []
-        for efset in egmeasure.filesets:
-            for efile in efset.external_files:
-                plinkfiles.append(efile.filepath)
         if self._display:
             self.w(u"<b>Plink Files</b>: {0}<br/>".format(
                 "; ".join(plinkfiles)))
             self.w(u"<br/>")
-        roots = []
-        for path in plinkfiles:
-            root, ext = os.path.splitext(path)
-            if ext not in [".bed", ".bim", ".fam"]:
-                msg = u"'{0}' plink extension not supported.".format(ext)
-                if self._display:
-                    self.error(msg)
-                else:
-                    self.w(unicode(json.dumps({"error": msg})))
-                return
-            roots.append(root)
-        if len(roots) != 3 or len(set(roots)) != 1:
-            msg = u"Three plink bed/bim/fam files expected in the same folder."
-            if self._display:
-                self.error(msg)
-            else:
-                self.w(unicode(json.dumps({"error": msg})))
-            return 
+
+        # Stream the measured genomic data
+        stream = self._cw.form.get("stream", None)
+        if export_type == "data" and not self._display and stream is not None:
+            self.stream_genotypes(root, genes, subjects, stream)
+            return
+
+        # Check the table cache first: the table pages are served from the
+        # table cache
+        table_key = table_cache_key(
+            self._cw, self.__regid__, measure=measure, genes=sorted(genes),
+            subjects=subjects, export_type=export_type)
+        table = None
+        if self._display:
+            table = get_cached_table(self._cw, table_key)
+        if table is not None:
+            index, elts_to_sort = {
+                "data": (0, ["ID", "family_id"]),
+                "ref": (1, []),
+                "metagen": (2, ["ID", "rs_id", "chromosome"])}[export_type]
+            self.wview("jtable-hugetable-clientside", None, "null",
+                       labels=table["labels"], records=None, csv_export=True,
+                       title="Genotypes", timepoint="",
+                       elts_to_sort=elts_to_sort, tooltip_name=None,
+                       use_scroller=False, index=index, table_key=table_key)
+            return
 
         # Load the plink and the
         try:
@@ -152,7 +187,10 @@ class MetaGenSearchView(View):
                 path_log=None,
                 timeout=10,
                 nb_tries=3,
-                metagen_url=self._cw.vreg.config["metagen_url"])
+                metagen_url=self._cw.vreg.config["metagen_url"],
+                resolver=get_metagen_resolver(self._cw.vreg.config, self._cw),
+                cache=get_disk_cache(self._cw.vreg.config, "genotypes",
+                                     "genotype-cache-size"))
         except Exception as e:
             msg = u"Can't acces the required genotype measure: {0}".format(
                 e)
@@ -163,7 +201,6 @@ class MetaGenSearchView(View):
             return
 
         # Display result in a table view
-
         # > export the measured genomic data from the selected filtering
         # options
         if export_type == "data":
@@ -175,7 +212,8 @@ class MetaGenSearchView(View):
                            labels=labels, records=records, csv_export=True,
                            title="Genotypes", timepoint="",
                            elts_to_sort=["ID", "family_id"],
-                           tooltip_name=None, use_scroller=False, index=0)
+                           tooltip_name=None, use_scroller=False, index=0,
+                           table_key=table_key)
             else:
                 labels = ["subject_id"] + labels
                 self.w(unicode(json.dumps({"labels": labels,
@@ -192,7 +230,8 @@ class MetaGenSearchView(View):
                 self.wview("jtable-hugetable-clientside", None, "null",
                            labels=labels, records=records, csv_export=True,
                            title="Genotypes", timepoint="", elts_to_sort=[],
-                           tooltip_name=None, use_scroller=False, index=1)
+                           tooltip_name=None, use_scroller=False, index=1,
+                           table_key=table_key)
             else:
                 labels = ["rs_id"] + labels
                 self.w(unicode(json.dumps({"labels": labels,
@@ -213,7 +252,8 @@ class MetaGenSearchView(View):
                                labels=labels, records=records, csv_export=True,
                                title="Genotypes", timepoint="",
                                elts_to_sort=["ID", "rs_id", "chromosome"],
-                               tooltip_name=None, use_scroller=False, index=2)
+                               tooltip_name=None, use_scroller=False, index=2,
+                               table_key=table_key)
                 else:
                     labels = ["hgnc_id"] + labels
                     self.w(unicode(json.dumps({"labels": labels,
@@ -227,6 +267,112 @@ class MetaGenSearchView(View):
                     self.w(unicode(json.dumps({"error": msg})))
                 return
 
+    def get_plink_dataset(self, measure):
+        """ Get the PLINK dataset associated to a genomic measure.
+
+        Parameters
+        ----------
+        measure: str
+            the GenomicMeasure entity label.
+
+        Returns
+        -------
+        root: str
+            path to the Plink bed/bim/fam dataset without extension.
+        plinkfiles: list of str
+            the Plink bed/bim/fam files.
+
+        Raises
+        ------
+        ValueError: if the genomic measure does not reference a valid PLINK
+        dataset.
+        """
+        rset = self._cw.execute(
+            "Any G Where G is GenomicMeasure, G label %(label)s",
+            {"label": measure})
+        if rset.rowcount != 1:
+            raise ValueError(
+                u"'{0}' genomic measure(s) detected, one expected.".format(
+                    rset.rowcount))
+        egmeasure = rset.get_entity(0, 0)
+        plinkfiles = []
+        for efset in egmeasure.filesets:
+            for efile in efset.external_files:
+                plinkfiles.append(efile.filepath)
+        roots = []
+        for path in plinkfiles:
+            root, ext = os.path.splitext(path)
+            if ext not in [".bed", ".bim", ".fam"]:
+                raise ValueError(
+                    u"'{0}' plink extension not supported.".format(ext))
+            roots.append(root)
+        if len(roots) != 3 or len(set(roots)) != 1:
+            raise ValueError(
+                u"Three plink bed/bim/fam files expected in the same folder.")
+        return roots[0], plinkfiles
+
+    def stream_genotypes(self, root, genes, subjects, encoding):
+        """ Stream the genomic dataset of interest: the header is emitted
+        first, then the genotypes as they are read from the .bed file.
+
+        Parameters
+        ----------
+        root: str
+            path to the Plink bed/bim/fam dataset without extension.
+        genes: list of str
+            the requested gene names.
+        subjects: list of str
+            the requested subject identifiers, None for all subjects.
+        encoding: str
+            the stream encoding: 'csv', 'ndjson' or 'int8'.
+        """
+        # Check the stream parameters
+        axis = self._cw.form.get("chunk_axis", "subject")
+        try:
+            chunk_size = int(self._cw.form.get("chunk_size", 1000))
+        except ValueError:
+            chunk_size = 0
+        if encoding not in GENOTYPE_ENCODINGS:
+            msg = ("'{0}' stream encoding not recognize. Supported encodings "
+                   "are {1}.".format(encoding, GENOTYPE_ENCODINGS))
+            self.w(unicode(json.dumps({"error": msg})))
+            return
+        if axis not in GENOTYPE_CHUNK_AXES or chunk_size <= 0:
+            msg = ("Chunks are defined by a positive size and an axis in "
+                   "{0}.".format(GENOTYPE_CHUNK_AXES))
+            self.w(unicode(json.dumps({"error": msg})))
+            return
+
+        # Select the genotypes without loading them
+        try:
+            snp_reader, chunks, _ = genotype_measure_chunks(
+                path_dataset=root,
+                snp_ids=None,
+                gene_names=genes,
+                subject_ids=subjects,
+                count_A1=True,
+                chunk_size=chunk_size,
+                axis=axis,
+                timeout=10,
+                nb_tries=3,
+                metagen_url=self._cw.vreg.config["metagen_url"],
+                resolver=get_metagen_resolver(self._cw.vreg.config, self._cw))
+        except Exception as e:
+            msg = u"Can't acces the required genotype measure: {0}".format(
+                e)
+            self.w(unicode(json.dumps({"error": msg})))
+            return
+
+        # Send the encoded genotypes chunk by chunk
+        filename = "genotypes.{0}".format(
+            "bin" if encoding == "int8" else encoding)
+        direct_stream(
+            self._cw,
+            encode_genotype_chunks(snp_reader, chunks, encoding=encoding,
+                                   axis=axis),
+            content_type=STREAM_CONTENT_TYPES[encoding],
+            filename=filename)
+
     def error(self, msg):
         """ Display an error message.
         """
@@ -255,6 +401,187 @@ class MetaGenSearchJson(MetaGenSearchView):
 
 
 
+class MetaGenSummaryView(MetaGenSearchView):
+    """ View to display per-snp summary statistics of the genomic measures
+    store in PLINK format: bef/bim/fam files.
+
+    Instead of the subject x snp genotype matrix, a small table is returned
+    with, for each snp, the minor allele frequency, the call rate, the
+    Hardy-Weinberg equilibrium p-value and the genotype counts.
+
+    The view id is 'metagen-summary': .../view?vid=metagen-summary&... . This
+    view accpets five parameters:
+    - measure (mandatory): specify the GenomicMeasure entity 'label' that
+      contains the PLINK file to be analysed: ...&measure=Chip1&...
+    - gene (manadatory): in order to filter the genomic dataset specify at
+      least one gene 'hgnc_id': ...&gene=CAMTA1&gene=EVI5...
+    - subject (optional, default all subjects): used to acces the data of
+      specific subjects only: ....&subject=iid1&subject=iid2...
+    - group (optional, default None): stratify the statistics by
+      SubjectGroup entities 'name', 'all' to use all the groups:
+      ...&group=controls&group=patients...
+    - chunk_size (optional, default 1000): the number of snps read from the
+      .bed file at a time: ...&chunk_size=500&...
+    """
+    __regid__ = "metagen-summary"
+    title = _("MetaGen Summary")
+    div_id = "metagen-summary"
+    _display = True
+
+    def call(self, gene=None, measure=None, subjects=None, groups=None):
+        """ Generate/display the genomic dataset summary statistics.
+        """
+        # Display header
+        if self._display:
+            self.w(u"<h1>MetaGen Summary</h1>")
+            self.w(u"<hr>")
+
+        # Retrieve form parameters from the url
+        genes = gene or self._cw.form.get("gene", None)
+        if genes is not None and not isinstance(genes, list):
+            genes = [genes]
+        measure = measure or self._cw.form.get("measure", None)
+        subjects = subjects or self._cw.form.get("subject", None)
+        if subjects == "all":
+            subjects = None
+        if subjects is not None and not isinstance(subjects, list):
+            subjects = [subjects]
+        groups = groups or self._cw.form.get("group", None)
+        if groups is not None and not isinstance(groups, list):
+            groups = [groups]
+        try:
+            chunk_size = int(self._cw.form.get("chunk_size", 1000))
+        except ValueError:
+            chunk_size = 0
+
+        # Check input parameters
+        if genes is None or measure is None or chunk_size <= 0:
+            msg = ("Need a gene name to perform a search, a valid "
+                   "genomic measure name and a positive chunk size.")
+            if self._display:
+                self.error(msg)
+            else:
+                self.w(unicode(json.dumps({"error": msg})))
+            return
+
+        # Display search parameters
+        if self._display:
+            self.w(u"<b>Gene Names</b>: {0}<br/>".format("; ".join(genes)))
+            self.w(u"<b>Genomic Measure</b>: {0}<br/>".format(measure))
+            self.w(u"<b>Subject</b>: {0}<br/>".format(
+                "; ".join(subjects) if subjects is not None else "all"))
+            self.w(u"<b>Subject Groups</b>: {0}<br/>".format(
+                "; ".join(groups) if groups is not None else "none"))
+
+        # Get the genomic measure associated plink files and the subject
+        # groups
+        try:
+            root, plinkfiles = self.get_plink_dataset(measure)
+            subject_groups = self.get_subject_groups(groups)
+        except ValueError as e:
+            msg = unicode(e)
+            if self._display:
+                self.error(msg)
+            else:
+                self.w(unicode(json.dumps({"error": msg})))
+            return
+        if self._display:
+            self.w(u"<b>Plink Files</b>: {0}<br/>".format(
+                "; ".join(plinkfiles)))
+            self.w(u"<br/>")
+
+        # Compute the statistics without loading the whole genotype matrix
+        try:
+            snp_ids, metagen_snps_of_gene = resolve_snp_ids(
+                snp_ids=None,
+                gene_names=genes,
+                timeout=10,
+                nb_tries=3,
+                metagen_url=self._cw.vreg.config["metagen_url"],
+                resolver=get_metagen_resolver(self._cw.vreg.config, self._cw))
+            snp_reader = open_plink_bed_bim_fam_dataset(
+                path_dataset=root,
+                snp_ids=snp_ids,
+                subject_ids=subjects,
+                count_A1=True)
+            labels, records = genotype_summary_statistics(
+                snp_reader, subject_groups=subject_groups,
+                chunk_size=chunk_size)
+        except Exception as e:
+            msg = u"Can't acces the required genotype measure: {0}".format(
+                e)
+            if self._display:
+                self.error(msg)
+            else:
+                self.w(unicode(json.dumps({"error": msg})))
+            return
+
+        # Display result in a table view
+        if self._display:
+            self.wview("jtable-hugetable-clientside", None, "null",
+                       labels=labels[1:], records=records, csv_export=True,
+                       title="Genotype Summary", timepoint="",
+                       elts_to_sort=["ID", "group"], tooltip_name=None,
+                       use_scroller=False, index=0)
+        else:
+            self.w(unicode(json.dumps({"labels": labels,
+                                       "records": records})))
+
+    def get_subject_groups(self, groups):
+        """ Get the subjects of each requested SubjectGroup.
+
+        Parameters
+        ----------
+        groups: list of str
+            the SubjectGroup entities names, ['all'] to use all the groups,
+            None for no stratification.
+
+        Returns
+        -------
+        subject_groups: OrderedDict or None
+            map each group name to its subject identifiers.
+
+        Raises
+        ------
+        ValueError: if a requested group does not exist or is empty.
+        """
+        if groups is None:
+            return None
+        rql = ("Any GN, ID Where G is SubjectGroup, G name GN, "
+               "G subjects S, S code_in_study ID")
+        kwargs = {}
+        if groups != ["all"]:
+            names = []
+            for index, name in enumerate(groups):
+                names.append("%(group{0})s".format(index))
+                kwargs["group{0}".format(index)] = name
+            rql += ", G name IN ({0})".format(", ".join(names))
+        subject_groups = OrderedDict()
+        for name, subject_id in sorted(self._cw.execute(rql, kwargs)):
+            subject_groups.setdefault(name, []).append(subject_id)
+        missing = (set(groups) - set(subject_groups)
+                   if groups != ["all"] else set())
+        if len(subject_groups) == 0 or len(missing) > 0:
+            raise ValueError(
+                u"No subjects found in the requested group(s): {0}.".format(
+                    "; ".join(sorted(missing or groups))))
+        return subject_groups
+
+
+class MetaGenSummaryJson(MetaGenSummaryView):
+    """ JSON view to display per-snp summary statistics of the genomic
+    measures store in PLINK format: bef/bim/fam files.
+
+    See the 'MetaGenSummaryView' documentation for a description of the view
+    parameters.
+    """
+    __regid__ = "metagen-summary-json"
+    title = _("MetaGen Summary")
+    div_id = "metagen-summary"
+    templatable = False
+    _display = False
+
+
 class MetaGenSearchAutoView(View):
     """ Create a view to filter the PLINK genomic data from a metagen
     reference.
@@ -300,45 +627,57 @@ class MetaGenSearchAutoView(View):
                         "dataTables.fixedColumns.js")
         self._cw.add_js("DataTables-1.10.10/extensions/fnSetFilteringDelay.js")
 
-        # Create a gene picker
-        genes = get_genes(metagen_url=self._cw.vreg.config["metagen_url"])
-        genes_struct = {}
-        for gene in genes:
-            genes_struct.setdefault(gene.chromosome, []).append(gene.hgnc_id)
+        # Create a gene picker: the genes matching the typed prefix are
+        # requested on each keystroke
         html = "<h1>PLINK Genomic Measures Search</h1>"
         html += "<hr>"
         html += ("<h2>Please select a gene of interest:</h2>")
-        html += "<select class='selectpicker' data-live-search='true'>"
-        html += "<option></option>"
-        for chromosome in sorted(genes_struct.keys()):
-            html += "<optgroup label='{0}' data-icon='glyphicon-heart'>".format(
-                chromosome)
-            for name in sorted(genes_struct[chromosome]):
-                html += "<option value='{0}'>{0}</option>".format(name)
-            html += "</optgroup>"
-        html += "</select>"
+        html += ("<input id='metagen-gene' class='form-control' type='text' "
+                 "list='metagen-genes' autocomplete='off' "
+                 "placeholder='HGNC gene name'/>")
+        html += "<datalist id='metagen-genes'></datalist>"
 
         # Ceate a div to display the plots
         html += "<div id='metagen-search-disp'></div>"
 
-        # Add an event when the selection change
-        search_url = self._cw.build_url(vid="metagen-search", measure=measure)
         html += "<script type='text/javascript'>"
         html += "$(function() {"
-        html += "$('.selectpicker').on('change', function(){"
-        html += "var selected = $(this).find('option:selected').val();"
-        html += "if (selected != ''){"
 
-        # > execute the ajax callback
+        # > complete the gene names
+        html += "var lastPrefix = null;"
+        html += "$('#metagen-gene').on('input', function(){"
+        html += "var prefix = $(this).val();"
+        html += "if (prefix == '' || prefix == lastPrefix){return;}"
+        html += "lastPrefix = prefix;"
+        html += "$.ajax({"
+        html += "url: 'ajax?fname=get_metagen_genes',"
+        html += "method: 'POST',"
+        html += "data: {{'prefix': prefix, 'limit': {0}}},".format(
+            GENE_AUTOCOMPLETE_LIMIT)
+        html += "dataType: 'json'"
+        html += "}).done(function(genes){"
+        html += "if (prefix != lastPrefix){return;}"
+        html += "var options = $('#metagen-genes').empty();"
+        html += "$.each(genes, function(index, gene){"
+        html += "options.append($('<option>').attr('value', gene[0])"
+        html += ".text('chr' + gene[1]));"
+        html += "});"
+        html += "});"
+        html += "});"
+
+        # > execute the ajax callback when a gene is selected
+        html += "$('#metagen-gene').on('change', function(){"
+        html += "var selected = $(this).val();"
+        html += "if (selected != ''){"
         html += "var request = $.ajax({"
         html += "url: 'ajax?fname=get_metagen_search_body',"
         html += "method: 'POST',"
         html += "data: {{'measure': '{0}', 'gene': selected}},".format(measure)
         html += "dataType: 'html'"
         html += "}).done(function(html){$('#metagen-search-disp').html(html)});"
-
         html += "}"
         html += "});"
+
         html += "});"
         html += "</script>"
 
@@ -346,6 +685,37 @@ class MetaGenSearchAutoView(View):
         self.w(unicode(html))
 
 
+@ajaxfunc(output_type="json")
+def get_metagen_genes(self):
+    """ Get the genes whose HGNC id starts with a prefix.
+
+    Attributes
+    ----------
+    prefix: str
+        the typed gene name prefix.
+    limit: int (optional, default GENE_AUTOCOMPLETE_LIMIT)
+        the maximum number of returned genes.
+
+    Returns
+    -------
+    genes: list of 2-uplet
+        the matching (hgnc_id, chromosome).
+    """
+    # Get parameters
+    prefix = self._cw.form.get("prefix", "")
+    try:
+        limit = int(self._cw.form.get("limit", GENE_AUTOCOMPLETE_LIMIT))
+    except ValueError:
+        limit = GENE_AUTOCOMPLETE_LIMIT
+    limit = max(0, min(limit, GENE_AUTOCOMPLETE_MAX_LIMIT))
+
+    # Search the genes in the shared index
+    resolver = get_metagen_resolver(self._cw.vreg.config, self._cw)
+    index = get_gene_prefix_index(resolver)
+
+    return index.search(prefix, limit=limit)
+
+
 @ajaxfunc(output_type="xhtml")
 def get_metagen_search_body(self):
     """ Get the MetaGenSearchView view body.
@@ -378,6 +748,9 @@ def get_metagen_search_body(self):
 def registration_callback(vreg):
     vreg.register(MetaGenSearchView)
     vreg.register(MetaGenSearchJson)
+    vreg.register(MetaGenSummaryView)
+    vreg.register(MetaGenSummaryJson)
     vreg.register(MetaGenSearchAutoView)
+    vreg.register(get_metagen_genes)
     vreg.register(get_metagen_search_body)
 
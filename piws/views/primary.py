@@ -50,6 +50,16 @@ class PIWSPrimaryView(PrimaryView):
     relations_in_subject_history = [
         "subject_scans", "subject_processing_runs",
         "subject_questionnaire_runs"]
+    # The column and restriction selecting the item that completes the
+    # title of the related entities of each subject history relation, so
+    # that the titles match the entities 'dc_title' without fetching them
+    subject_history_titles = {
+        "subject_scans": ("F", "X format F"),
+        "subject_questionnaire_runs": ("QN", "X questionnaire Q, Q name QN"),
+        "subject_processing_runs": ("COUNT(XS)", "X subjects XS")}
+    # The number of related entities above which the side box count is
+    # displayed as a lower bound
+    sidebox_count_limit = 1000
 
     def render_entity_attributes(self, entity):
         """ Renders all attributes and relations in the 'attributes' section.
@@ -116,32 +126,19 @@ class PIWSPrimaryView(PrimaryView):
         self._cw.add_js("tree/script.js")
 
         # Get tree entities
-        related_entities = {}
-        for relation in self.relations_in_subject_history: 
-            if not hasattr(entity, relation):
-                continue
-            related_entities[relation] = getattr(entity, relation)
+        history = self._get_subject_history(entity)
 
         # Create tree
         self.w(u"<div class='tree well'>")
         self.w(u"<ul>")
-        for timepoint in sorted(set([e.timepoint for e in entity.assessments])):
+        for timepoint in sorted(history):
             self.w(u"<li>")
             self.w(u"<span><i class='glyphicon glyphicon-folder-open'>"
                     "</i> {0}</span>".format(
                         timepoint))
-            for relation in related_entities:
-                sorted_entities = {}
-                for _entity in related_entities[relation]:
-                    if _entity.in_assessment[0].timepoint != timepoint:
-                        continue
-                    if _entity.cw_etype not in sorted_entities:
-                        sorted_entities[_entity.cw_etype] = {}
-
-                    sorted_entities[_entity.cw_etype].setdefault(
-                        _entity.label, []).append(_entity)
+            for relation, sorted_entities in history[timepoint]:
                 self.w(u"<ul>")
-                for dtype in sorted_entities:
+                for dtype in sorted(sorted_entities):
                     url = self._cw.build_url(
                         rql="Any X Where X is QuestionnaireRun, X subject S, "
                             "S code_in_study '{0}', X in_assessment A, "
@@ -154,20 +151,20 @@ class PIWSPrimaryView(PrimaryView):
                             "href='{1}'>&#9735;</a>".format(
                                 dtype, url))
                     self.w(u"<ul>")
-                    for label in sorted_entities[dtype]:
+                    for label in sorted(sorted_entities[dtype]):
                         self.w(u"<li>")
                         self.w(u"<span class='alert-warning'><i "
                                 "class='glyphicon-plus'></i> {0}</span>".format(
                                     label))
                         self.w(u"<ul>")
-                        for _entity in sorted_entities[dtype][label]:
+                        for eid, title in sorted_entities[dtype][label]:
                             self.w(u"<li>")
                             url = self._cw.build_url(
-                                rql="Any X Where X eid '{0}'".format(_entity.eid))
+                                rql="Any X Where X eid '{0}'".format(eid))
                             self.w(u"<span><i class='glyphicon glyphicon-transfer'>"
                                     "</i> {0}</span><a style='margin-left: 0.5em' "
                                     "class='btn btn-primary' href='{1}'>&#9735;</a>".format(
-                                        _entity.dc_title(), url))
+                                        title, url))
                             self.w(u"</li>")
                         self.w(u"</ul>")
                         self.w(u"</li>")
@@ -177,6 +174,95 @@ class PIWSPrimaryView(PrimaryView):
             self.w(u"</li>")
         self.w(u"</ul></div>")
 
+    def _get_subject_history(self, entity):
+        """ Get the subject related entities displayed in the navigation
+        menu, organized by timepoint, relation, entity type and label.
+
+        The related entities and the columns of their titles are fetched
+        with one request per relation, and the subject timepoints with
+        another one, whatever the length of the subject history.
+
+        Parameters
+        ----------
+        entity: Subject
+            the subject entity.
+
+        Returns
+        -------
+        history: dict
+            the related entities: {timepoint: [(relation, {etype: {label:
+            [(eid, title)]}})]}, the relations being ordered as in
+            'relations_in_subject_history'.
+        """
+        # Get the relations of the subject
+        relations = [
+            relation for relation in self.relations_in_subject_history
+            if entity.e_schema.has_subject_relation(relation)]
+
+        # Get the subject timepoints
+        history = {}
+        for timepoint, in self._cw.execute(
+                "DISTINCT Any T WHERE S eid %(eid)s, S assessments A, "
+                "A timepoint T", {"eid": entity.eid}):
+            history[timepoint] = [(name, {}) for name in relations]
+
+        # Get the related entities of each relation and their title columns
+        # in one request
+        for index, relation in enumerate(relations):
+            column, restriction = self.subject_history_titles.get(
+                relation, ("L", None))
+            groupby = ["X", "L", "T", "C"]
+            if "(" not in column and column not in groupby:
+                groupby.append(column)
+            rql = ("Any X, L, T, C, {0} GROUPBY {1} ORDERBY X "
+                   "WHERE S eid %(eid)s, S code_in_study C, S {2} X, "
+                   "X label L, X in_assessment A, A timepoint T".format(
+                       column, ", ".join(groupby), relation))
+            if restriction is not None:
+                rql += ", " + restriction
+            rset = self._cw.execute(rql, {"eid": entity.eid})
+            for row, (eid, label, timepoint, code, item) in enumerate(rset):
+                etype = rset.description[row][0]
+                title = self._get_subject_history_title(
+                    relation, label, timepoint, code, item)
+                history.setdefault(
+                    timepoint, [(name, {}) for name in relations])
+                history[timepoint][index][1].setdefault(
+                    etype, {}).setdefault(label, []).append((eid, title))
+
+        return history
+
+    def _get_subject_history_title(self, relation, label, timepoint, code,
+                                   item):
+        """ Build the title of a subject history entity as its 'dc_title'.
+
+        Parameters
+        ----------
+        relation: str
+            the subject history relation.
+        label: unicode
+            the entity label.
+        timepoint: unicode
+            the entity assessment timepoint.
+        code: unicode
+            the subject code in study.
+        item: object
+            the item selected with 'subject_history_titles'.
+
+        Returns
+        -------
+        title: unicode
+            the entity title.
+        """
+        if relation == "subject_scans":
+            return u"{0} ({1}-{2}): {3}".format(label, timepoint, item, code)
+        elif relation == "subject_questionnaire_runs":
+            return u"{0} ({1}): {2}".format(item, timepoint, code)
+        elif relation == "subject_processing_runs":
+            return u"{0} ({1}): {2} {3}".format(
+                label, timepoint, code, "..." if item > 1 else "")
+        return u"{0} ({1}): {2}".format(label, timepoint, code)
+
     def _prepare_subject_questionnaire(self, entity):
         """ Display the QunestionnaireRun assocciated data as a table.
         """
@@ -230,19 +316,18 @@ class PIWSPrimaryView(PrimaryView):
             if not rset:
                 continue
 
-            # Construct the box label
+            # Construct the box label: the entity types are derived from the
+            # schema, or from the limited rset description if the relation
+            # has several possible target types
             if role == "subject":
                 source_etype = entity.cw_etype
-                target_etypes = set()
-                entities = getattr(entity, rschema.type)
-                for e in entities:
-                    target_etypes.add(e.cw_etype)
-                if len(target_etypes) == 1:
-                    target_etype = target_etypes.pop()
-                else:
-                    target_etype = " - ".join(list(target_etypes))
+                target_etypes = set(tschema.type for tschema in tschemas)
+                if len(target_etypes) > 1:
+                    target_etypes = set(
+                        description[0] for description in rset.description)
+                target_etype = " - ".join(sorted(target_etypes))
             else:
-                source_etype = getattr(entity, "reverse_" + rschema.type)[0].cw_etype
+                source_etype = rset.description[0][0]
                 target_etype = entity.cw_etype
             label = (u"{0} <a class='btn btn-info active' href='#' "
                      "data-toggle='tooltip' title='{2}'>&#8594;</a> "
@@ -255,11 +340,15 @@ class PIWSPrimaryView(PrimaryView):
                 rql = "Any X WHERE E eid '{1}', X {2} E".format(
                     target_etype, entity.eid, rschema.type)
 
-            # FileSet special case
-            if target_etype == "FileSet" and entity.cw_etype != "ExternalFile":
-                entities = [e for e in rset.entities()]
-                nb_fsets = len(entities)
-                if nb_fsets == 1:
+            # FileSet special case: only the external files of the fileset
+            # are fetched, in the limit of the box size
+            if (target_etype == "FileSet" and
+                    entity.cw_etype != "ExternalFile" and rset.rowcount == 1):
+                inner_rset = self._cw.execute(
+                    "Any F LIMIT {0} WHERE X eid %(eid)s, "
+                    "X external_files F".format(defaultlimit),
+                    {"eid": rset[0][0]})
+                if inner_rset:
                     rql += ", X external_files F"
                     pos = rql.find("X")
                     rql = rql[:pos] + "F" + rql[pos + 1:]
@@ -267,11 +356,18 @@ class PIWSPrimaryView(PrimaryView):
                         u"<a class='btn btn-info active' href='#' "
                         "data-toggle='tooltip' "
                         "title='external_files'>&#8594;</a> ExternalFile")
-                    inner_rset = []
-                    for fs_entity in entities:
-                        inner_rset.extend(fs_entity.external_files)
                     rset = inner_rset
 
+            # Count the related entities, in the limit of
+            # 'sidebox_count_limit'
+            limited_rql = rql.replace(
+                " WHERE ", " LIMIT {0} WHERE ".format(
+                    self.sidebox_count_limit), 1)
+            count = self._cw.execute(
+                "Any COUNT(X) WITH X BEING ({0})".format(limited_rql))[0][0]
+            label += u" <span class='badge'>{0}{1}</span>".format(
+                count, "+" if count >= self.sidebox_count_limit else "")
+
             # Construct the relation box
             box = boxesreg.select("relationbox", self._cw, rset=rset, rql=rql,
                                   title=label, dispctrl=dispctrl,
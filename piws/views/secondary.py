@@ -21,12 +21,86 @@ from cubicweb.view import EntityView
 
 # PIWS import
 from components import AUTHORIZED_IMAGE_EXT
+from cubes.piws.entities import SCAN_DATA_SYMBOLS
 
 
 ###############################################################################
 # Base
 ###############################################################################
 
+def prefetch_outofcontext_relations(req, rset, col):
+    """ Fetch the related information displayed by the out of context views
+    for all the entities of a result set column: a fixed number of
+    requests is executed whatever the number of rows.
+
+    Parameters
+    ----------
+    req: Request
+        the current request.
+    rset: ResultSet
+        the rendered result set.
+    col: int
+        the column of the rendered entities.
+
+    Returns
+    -------
+    prefetched: dict
+        the image files 'imagefiles', the number of subjects 'nbsubjects',
+        the first study name 'study' and the scan data type symbol 'symbol'
+        of each entity eid, only defined for the entity types having the
+        corresponding relations.
+    """
+    # Group the entities by type
+    eids_by_etype = {}
+    for row, description in zip(rset.rows, rset.description):
+        if row[col] is not None:
+            eids_by_etype.setdefault(description[col], set()).add(row[col])
+
+    # Fetch the relations of each entity type
+    prefetched = {}
+    schema = req.vreg.schema
+    for etype, eids in eids_by_etype.items():
+        eschema = schema.eschema(etype)
+        defaults = {}
+        if etype == "Scan" and eschema.has_subject_relation("filesets"):
+            defaults["imagefiles"] = list
+        if eschema.has_subject_relation("subjects"):
+            defaults["nbsubjects"] = int
+        if eschema.has_subject_relation("study"):
+            defaults["study"] = lambda: None
+        if etype == "Scan" and eschema.has_subject_relation("has_data"):
+            defaults["symbol"] = lambda: None
+        for eid in eids:
+            prefetched[eid] = dict(
+                (name, factory()) for name, factory in defaults.items())
+        eids = ", ".join(str(eid) for eid in sorted(eids))
+        if "imagefiles" in defaults:
+            for eid, filepath in req.execute(
+                    "Any X, FP WHERE X eid IN ({0}), X filesets F, "
+                    "F external_files E, E filepath FP".format(eids)):
+                if filepath.endswith(tuple(AUTHORIZED_IMAGE_EXT)):
+                    prefetched[eid]["imagefiles"].append(filepath)
+        if "nbsubjects" in defaults:
+            for eid, nbsubjects in req.execute(
+                    "Any X, COUNT(S) GROUPBY X WHERE X eid IN ({0}), "
+                    "X subjects S".format(eids)):
+                prefetched[eid]["nbsubjects"] = nbsubjects
+        if "study" in defaults:
+            for eid, study in req.execute(
+                    "Any X, SN ORDERBY S WHERE X eid IN ({0}), X study S, "
+                    "S name SN".format(eids)):
+                if prefetched[eid]["study"] is None:
+                    prefetched[eid]["study"] = study
+        if "symbol" in defaults:
+            for eid, dtype in req.execute(
+                    "Any X, ETN ORDERBY D WHERE X eid IN ({0}), "
+                    "X has_data D, D is ET, ET name ETN".format(eids)):
+                if prefetched[eid]["symbol"] is None:
+                    prefetched[eid]["symbol"] = SCAN_DATA_SYMBOLS.get(dtype)
+
+    return prefetched
+
+
 class BaseOutOfContextView(EntityView):
     """ Default secondary view rendering.
     """
@@ -39,20 +113,40 @@ class BaseOutOfContextView(EntityView):
         """
         return {}
 
+    def prefetched_relations(self, col):
+        """ Get the related information of the rendered result set column
+        entities.
+
+        The list views render each row with a new view instance: the
+        information is fetched once per result set and column, and stored
+        in the request data.
+
+        Parameters
+        ----------
+        col: int
+            the column of the rendered entities.
+
+        Returns
+        -------
+        prefetched: dict
+            see 'prefetch_outofcontext_relations'.
+        """
+        cache = self._cw.data.setdefault("piws-outofcontext-prefetch", {})
+        key = (self.cw_rset.printable_rql(), self.cw_rset.rowcount, col)
+        if key not in cache:
+            cache[key] = prefetch_outofcontext_relations(
+                self._cw, self.cw_rset, col)
+        return cache[key]
+
     def cell_call(self, row, col):
         """ Create the out of context view template
         """
-        # Get the entity
+        # Get the entity and its prefetched related information
         entity = self.cw_rset.get_entity(row, col)
+        prefetched = self.prefetched_relations(col).get(entity.eid, {})
 
         # Get the associated images
-        imagefiles = []
-        if entity.cw_etype == "Scan":
-            if hasattr(entity, "filesets"):
-                for efentries in entity.filesets:
-                    imagefiles.extend(
-                        [e.filepath for e in efentries.external_files
-                         if e.filepath.endswith(tuple(AUTHORIZED_IMAGE_EXT))])
+        imagefiles = prefetched.get("imagefiles", [])
 
         # Create a viewer if some images has been detected
         limagefiles = len(imagefiles)
@@ -70,22 +164,24 @@ class BaseOutOfContextView(EntityView):
             tooltip = None
 
         # Get the subjects/study/center related entities
-        if hasattr(entity, "subjects"):
-            nbsubjects = len(entity.subjects)
+        if "nbsubjects" in prefetched:
+            nbsubjects = prefetched["nbsubjects"]
         elif entity.__class__.__name__ == "Subject":
             nbsubjects = 1
         else:
             nbsubjects = "nc"
-        study = None
-        if hasattr(entity, "study") and len(entity.study) > 0:
-            study = entity.study[0]
+        study = prefetched.get("study")
 
         # Get the entity symbol
+        if "symbol" in prefetched:
+            symbol = prefetched["symbol"]
+        else:
+            symbol = entity.symbol
         if hasattr(entity, "__bootstap_glyph__") and entity.__bootstap_glyph__:
-            image = unicode(entity.symbol)
+            image = unicode(symbol)
         else:
             image = u"<img alt='' src='{0}'>".format(
-                self._cw.data_url(entity.symbol))
+                self._cw.data_url(symbol))
 
         # Create the div that will contain the list item
         self.w(u"<div class='ooview'><div class='well'>")
@@ -100,7 +196,7 @@ class BaseOutOfContextView(EntityView):
             entity.view("incontext")))
         entity_desc = u""
         if study is not None:
-            entity_desc += u"Study <em>{0}</em>".format(study.name)
+            entity_desc += u"Study <em>{0}</em>".format(study)
         if nbsubjects not in [1, 'nc']:
             entity_desc += u" - Number of subjects <em>{0}</em>".format(
                 nbsubjects)
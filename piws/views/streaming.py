@@ -0,0 +1,137 @@
+##########################################################################
+# NSAp - Copyright (C) CEA, 2017
+# Distributed under the terms of the CeCILL-B license, as published by
+# the CEA-CNRS-INRIA. Refer to the LICENSE file or to
+# http://www.cecill.info/licences/Licence_CeCILL-B_V1-en.html
+# for details.
+##########################################################################
+
+# System import
+import csv
+import zlib
+from cStringIO import StringIO
+
+# Cubicweb import
+from cubicweb.web import DirectResponse
+from cubicweb.etwist.http import HTTPResponse
+
+
+def direct_stream(req, chunks, content_type, filename=None):
+    """ Send a response whose content is produced chunk by chunk.
+
+    The view rendering is interrupted and the chunks are written to the
+    client as they are generated (see the 'HTTPResponse._finalize'
+    monkeypatch), so that the whole content is never kept in memory.
+
+    Parameters
+    ----------
+    req: Request (mandatory)
+        the current request.
+    chunks: generator of str (mandatory)
+        the response content.
+    content_type: str (mandatory)
+        the response content type.
+    filename: str (optional, default None)
+        if set, the content is sent as an attachment with this name.
+    """
+    req.set_header("content-type", content_type)
+    if filename is not None:
+        req.set_header("content-disposition",
+                       "attachment; filename=\"{0}\"".format(filename))
+    response = HTTPResponse(code=req.status_out,
+                            headers=req.headers_out,
+                            stream=_encode_chunks(chunks),
+                            twisted_request=req._twreq)
+    raise DirectResponse(response)
+
+
+def _encode_chunks(chunks):
+    """ Make sure the streamed chunks are byte strings.
+    """
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode("utf-8")
+        if chunk:
+            yield chunk
+
+
+def csv_stream(rows, csv_params, encoding="utf-8", flush_size=65536):
+    """ Encode table rows in CSV, chunk by chunk.
+
+    Parameters
+    ----------
+    rows: iterable of list (mandatory)
+        the table rows.
+    csv_params: dict (mandatory)
+        the 'csv.writer' parameters.
+    encoding: str (optional, default 'utf-8')
+        the encoding of the unicode cells.
+    flush_size: int (optional, default 65536)
+        the approximate size of the generated chunks in bytes.
+
+    Returns
+    -------
+    chunks: generator of str
+        the CSV content.
+    """
+    buf = StringIO()
+    writer = csv.writer(buf, **csv_params)
+    for row in rows:
+        writer.writerow([
+            cell.encode(encoding) if isinstance(cell, unicode) else cell
+            for cell in row])
+        if buf.tell() >= flush_size:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def gzip_stream(chunks, level=6):
+    """ Compress a stream in the gzip format, chunk by chunk.
+
+    Parameters
+    ----------
+    chunks: iterable of str (mandatory)
+        the stream to be compressed.
+    level: int (optional, default 6)
+        the compression level.
+
+    Returns
+    -------
+    chunks: generator of str
+        the compressed stream.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode("utf-8")
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def direct_csv_stream(req, rows, csv_params, filename, gzip=False):
+    """ Send table rows in CSV as they are generated.
+
+    Parameters
+    ----------
+    req: Request (mandatory)
+        the current request.
+    rows: generator of list (mandatory)
+        the table rows.
+    csv_params: dict (mandatory)
+        the 'csv.writer' parameters.
+    filename: str (mandatory)
+        the CSV file name, without extension.
+    gzip: bool (optional, default False)
+        if True, send a gzip compressed CSV file.
+    """
+    chunks = csv_stream(rows, csv_params, encoding=req.encoding)
+    if gzip:
+        direct_stream(req, gzip_stream(chunks), "application/gzip",
+                      filename="{0}.csv.gz".format(filename))
+    else:
+        direct_stream(req, chunks, "text/csv",
+                      filename="{0}.csv".format(filename))
@@ -12,6 +12,8 @@ from collections import OrderedDict, defaultdict
 import json
 import re
 import time
+import zlib
+import itertools
 from packaging import version
 
 # Cubicweb import
@@ -26,6 +28,129 @@ from cubicweb.web.views.csvexport import CSVMixIn
 from logilab.common.registry import yes
 from cubes.brainomics2.schema.questionnaire import ANSWERS_RTYPE
 
+# Package import
+from cubes.piws.cache.disk import DiskLRUCache
+from cubes.piws.cache.disk import get_disk_cache
+from cubes.piws.cache.memory import get_memory_cache
+from cubes.piws.views.streaming import direct_csv_stream
+
+
+###############################################################################
+# Table cache
+###############################################################################
+
+def get_table_cache(config):
+    """ Get the in-process cache where the DataTables tables are stored.
+
+    Parameters
+    ----------
+    config: CubicWebConfiguration
+        the instance configuration.
+
+    Returns
+    -------
+    cache: MemoryLRUCache
+        the shared table cache.
+    """
+    return get_memory_cache("tables", config["table-cache-size"],
+                            config["table-cache-memory"] * 1024 * 1024)
+
+
+def table_cache_key(req, vid, **params):
+    """ Build the cache key of a table: the key depends on the view
+    parameters and on the user groups, since the table content depends on
+    the user permissions.
+
+    Parameters
+    ----------
+    req: Request
+        the current request.
+    vid: str
+        the id of the view that generates the table.
+    params: dict
+        the view parameters.
+
+    Returns
+    -------
+    table_key: str
+        the table cache key.
+    """
+    return DiskLRUCache.make_key(vid, sorted(req.user.groups), params)
+
+
+def get_cached_table(req, table_key):
+    """ Get a cached table if the current user is allowed to access it.
+
+    Parameters
+    ----------
+    req: Request
+        the current request.
+    table_key: str
+        the table cache key.
+
+    Returns
+    -------
+    table: dict or None
+        the cached table with 'labels' and 'records' keys, None if the table
+        is not cached.
+    """
+    table = get_table_cache(req.vreg.config).get(table_key)
+    if table is None or table["groups"] != sorted(req.user.groups):
+        return None
+    return table
+
+
+def get_label_tooltips(qmap, labels):
+    """ Get the documentation tooltip of each table label.
+
+    Parameters
+    ----------
+    qmap: dict
+        the instance documentation map.
+    labels: list of str
+        the columns labels.
+
+    Returns
+    -------
+    tooltips: list of str
+        the labels tooltips, an empty string if not documented.
+    """
+    tooltips = []
+    for label_text in labels:
+        if label_text in qmap:
+            matches = re.findall("<!--.*tooltip:.*-->", qmap[label_text])
+            if len(matches) == 1:
+                match = matches[0][matches[0].index("tooltip:") + 8:-3]
+                tooltips.append(match)
+            else:
+                tooltips.append("")
+        else:
+            tooltips.append("")
+    return tooltips
+
+
+def cache_table(req, table_key, labels, records):
+    """ Store a table in the cache.
+
+    Parameters
+    ----------
+    req: Request
+        the current request.
+    table_key: str
+        the table cache key.
+    labels: list of str
+        the columns labels.
+    records: list of list
+        the table data, the first column contains the row 'ID'.
+    """
+    table = {
+        "groups": sorted(req.user.groups),
+        "labels": labels,
+        "records": records,
+        "ids": [unicode(row[0]).lower() for row in records],
+        "orders": {}}
+    get_table_cache(req.vreg.config).set(table_key, table)
+
 
 ###############################################################################
 # ScoreValue
@@ -121,6 +246,21 @@ class ScoreValueTableViewPrimary(View):
         elts_to_sort = self._cw.form["elts_to_sort"]
         tooltip_name = self._cw.form["tooltip_name"]
 
+        # Check the table cache first
+        table_key = table_cache_key(
+            self._cw, self.__regid__, study=study, rsubject=rsubject,
+            rtype=rtype, etype=etype, pname=pname, timepoint=timepoint,
+            pvalue=pvalue, label=label)
+        table = get_cached_table(self._cw, table_key)
+        if table is not None:
+            self.wview("jtable-hugetable-clientside", None, "null",
+                       labels=table["labels"], records=None,
+                       csv_export=csv_export, title=title,
+                       timepoint=timepoint, elts_to_sort=elts_to_sort,
+                       use_scroller=False, tooltip_name=tooltip_name,
+                       table_key=table_key)
+            return
+
         # Get the score value
         if study == "":
             rql = ("Any SID, SCT, SCV Where X is {0}, X type '{1}', "
@@ -166,7 +306,8 @@ class ScoreValueTableViewPrimary(View):
         self.wview("jtable-hugetable-clientside", None, "null", labels=headers,
                    records=records, csv_export=csv_export, title=title,
                    timepoint=timepoint, elts_to_sort=elts_to_sort,
-                   use_scroller=False, tooltip_name=tooltip_name)
+                   use_scroller=False, tooltip_name=tooltip_name,
+                   table_key=table_key)
 
 
 ###############################################################################
@@ -193,6 +334,61 @@ class FileAnswerTableView(View):
         tooltip_name = self._cw.form['tooltip_name']
         elts_to_sort = self._cw.form['elts_to_sort']
 
+        # Check the table cache first
+        table_key = table_cache_key(self._cw, self.__regid__, qname=qname,
+                                    timepoint=timepoint)
+        table = get_cached_table(self._cw, table_key)
+        if table is not None:
+            self.wview('jtable-hugetable-clientside', None, 'null',
+                       labels=table["labels"], records=None,
+                       csv_export=csv_export, title=title,
+                       timepoint=timepoint, elts_to_sort=elts_to_sort,
+                       tooltip_name=tooltip_name, use_scroller=False,
+                       table_key=table_key)
+            return
+
+        # Check the materialized pivot tables, otherwise build the pivot
+        # table from the questionnaire run files
+        pivot_cache = get_disk_cache(self._cw.vreg.config, "pivots",
+                                     "pivot-cache-size")
+        pivot_key = DiskLRUCache.make_key(qname, timepoint,
+                                          sorted(self._cw.user.groups))
+        data = None
+        if pivot_cache is not None:
+            data = pivot_cache.get(pivot_key)
+        if data is not None:
+            labels, records = json.loads(zlib.decompress(data))
+        else:
+            labels, records = self.build_pivot_table(qname, timepoint)
+            if pivot_cache is not None:
+                pivot_cache.set(pivot_key, zlib.compress(
+                    json.dumps([labels, records])))
+
+        # Call JhugetableView for html generation of the table
+        self.wview('jtable-hugetable-clientside', None, 'null', labels=labels,
+                   records=records, csv_export=csv_export, title=title,
+                   timepoint=timepoint, elts_to_sort=elts_to_sort,
+                   tooltip_name=tooltip_name, use_scroller=False,
+                   table_key=table_key)
+
+    def build_pivot_table(self, qname, timepoint):
+        """ Build the subject x question table of a questionnaire.
+
+        Parameters
+        ----------
+        qname: str
+            the questionnaire name.
+        timepoint: str
+            the questionnaire runs timepoint.
+
+        Returns
+        -------
+        labels: list of str
+            the questions sorted by position.
+        records: list of list
+            the subject answers, the first column contains the subject
+            identifiers.
+        """
         # Execute the rql to get all subjects QuestionnaireRuns
         rql = ("Any ID, D ORDERBY ID ASC WHERE QR is QuestionnaireRun, "
                "QR questionnaire Q, Q name '{0}', QR in_assessment A, "
@@ -231,11 +427,7 @@ class FileAnswerTableView(View):
                     record.append(u"")
             records.append(record)
 
-        # Call JhugetableView for html generation of the table
-        self.wview('jtable-hugetable-clientside', None, 'null', labels=labels,
-                   records=records, csv_export=csv_export, title=title,
-                   timepoint=timepoint, elts_to_sort=elts_to_sort,
-                   tooltip_name=tooltip_name, use_scroller=False)
+        return labels, records
 
 
 ###############################################################################
@@ -252,13 +444,18 @@ class JHugetableView(View):
 
     def call(self, labels, records, csv_export=True, title="", timepoint="",
              elts_to_sort=None, tooltip_name=None, use_scroller=False,
-             index=0):
+             index=0, table_key=None):
         """ Method that will create a table with client-side processing only.
          It is useful for huge datasets (million of entries).
 
         An Ajax call is emulated within the JavaScript so this function is
         client side only.
 
+        If a 'table_key' is specified and the table cache is enabled, the
+        records are stored in the table cache instead and the pages are
+        served by the 'get_hugetable_data' ajax callback: the page weight
+        no longer depends on the table size.
+
         A special 'ID' label will be added to the given labels to provide the
         row string description. Thus the first column of the records array must
         contain the corresponding 'ID' values.
@@ -284,11 +481,25 @@ class JHugetableView(View):
         index: int (optional, default 0)
             increment this parameter to insert multiple tables in the same
             page.
+        table_key: str (optional, default None)
+            the table cache key, see 'table_cache_key'. If set and records
+            is None, the table must be already cached.
         """
 
         if elts_to_sort is None:
             elts_to_sort = []
 
+        # Server-side processing: store the records in the table cache
+        server_side = (
+            table_key is not None and
+            self._cw.vreg.config["table-cache-size"] > 0)
+        if server_side and records is not None:
+            cache_table(self._cw, table_key, labels, records)
+        elif server_side and get_cached_table(self._cw, table_key) is None:
+            self.w(u"<h3>The table has expired, please reload the page."
+                   u"</h3>")
+            return
+
         # Add css resources
         self._cw.add_css(
             "DataTables-1.10.10/media/css/jquery.dataTables.min.css")
@@ -315,17 +526,7 @@ class JHugetableView(View):
         qmap = self._cw.vreg.docmap
 
         # Associate a tooltip to each label
-        tooltips = [""]
-        for label_text in labels:
-            if label_text in qmap:
-                matches = re.findall("<!--.*tooltip:.*-->", qmap[label_text])
-                if len(matches) == 1:
-                    match = matches[0][matches[0].index("tooltip:") + 8:-3]
-                    tooltips.append(match)
-                else:
-                    tooltips.append("")
-            else:
-                tooltips.append("")
+        tooltips = [""] + get_label_tooltips(qmap, labels)
 
         # Generate the script
         # > table column headers and sort option
@@ -354,77 +555,98 @@ class JHugetableView(View):
         html += "$(document).ready(function() {"
 
         # > dumps the answers rset into javascript
-        html += "var all_data = {0};".format(json.dumps(records))
-        html += "var nbrecordstotal = {0};".format(len(records))
-        # > create a cache for search patterns filtering
-        html += "var filtered_indices = ['', undefined];"
-        # > set the default sorting direction
-        html += "var sort_dir = 'asc';"
+        if not server_side:
+            html += "var all_data = {0};".format(json.dumps(records))
+            html += "var nbrecordstotal = {0};".format(len(records))
+            # > create a cache for search patterns filtering
+            html += "var filtered_indices = ['', undefined];"
+            # > set the default sorting direction
+            html += "var sort_dir = 'asc';"
 
         # > create the table
         html += "var table = $('#the_table_{0}').dataTable( {{ ".format(index)
         html += "serverSide: true,"
 
-        # > set the ajax callback to fill dynamically the table
-        html += "ajax: function ( data, callback, settings ) {"
-        # > get the table sorting direction
-        html += "var current_sort_dir = data.order[0].dir.toLowerCase();"
-        html += "if ( current_sort_dir != sort_dir) {"
-        html += "all_data = all_data.reverse();"
-        html += "sort_dir = current_sort_dir;"
-        html += "}"
-        # > create the records array for the page being displayed
-        html += "var out = [];"
-        # > get the ID search field
-        html += "var search_pattern = data.search.value.toLowerCase().trim();"
-        html += "var nbrecordsfiltered = nbrecordstotal;"
-        # > if the search field is not empty
-        html += "if (search_pattern != '') {"
-        # check the filtered indicies cache
-        html += "if (filtered_indices[0] != search_pattern) {"
-        html += "filtered_indices[0] = search_pattern;"
-        html += "filtered_indices[1] = [];"
-        # fill the filtered indicies cache
-        html += "for ( var i=0; i<nbrecordstotal ; i++ ) {"
-        html += ("if (all_data[i][0].toLowerCase()"
-                 ".indexOf(search_pattern) >= 0) {")
-        html += "filtered_indices[1].push(i);"
-        # close the 'if some occurence of the search pattern is found' loop
-        html += "}"
-        # close the for loop
-        html += "}"
-        # > close the filtered indices cache verification
-        html += "}"
-        html += "nbrecordsfiltered = filtered_indices[1].length;"
-        # fill the records array based on the filtered indicies
-        html += ("for (var i=data.start, ien=Math.min(data.start+data.length, "
-                 "nbrecordsfiltered) ; i<ien ; i++) {")
-        html += "out.push( all_data[ filtered_indices[1][i] ] );"
-        html += "}"
-        # > close the 'if the search field is not empty' condition
-        html += "}"
-        # > if the search field is empty
-        html += "else {"
-        # fill the records array without filtering
-        html += ("for ( var i=data.start, ien=Math.min(data.start+data.length,"
-                 " nbrecordstotal) ; i<ien ; i++ ) {")
-        html += "out.push( all_data[i] );"
-        # > close the for loop
-        html += "}"
-        # > close the 'else if the search field is empty' condition
-        html += "}"
-        # register the ajax callback
-        html += "setTimeout( function () {"
-        html += "callback( {"
-        html += "draw: data.draw,"
-        html += "data: out,"
-        html += "recordsTotal: nbrecordstotal,"
-        html += "recordsFiltered: nbrecordsfiltered"
-        html += "} );"
-        # > close the ajax callback registration
-        html += "}, 50 );"
-        # > close the ajax callback
-        html += "},"
+        # > request the table pages to the server
+        if server_side:
+            html += "ajax: {"
+            html += "url: 'ajax?fname=get_hugetable_data',"
+            html += "type: 'POST',"
+            html += "data: function ( data ) {"
+            html += "return {"
+            html += "table_key: '{0}',".format(table_key)
+            html += "draw: data.draw,"
+            html += "start: data.start,"
+            html += "length: data.length,"
+            html += "search: data.search.value,"
+            html += "order_column: data.order[0].column,"
+            html += "order_dir: data.order[0].dir"
+            html += "};"
+            html += "}"
+            html += "},"
+
+        # > emulate the ajax paging
+        else:
+            # > set the ajax callback to fill dynamically the table
+            html += "ajax: function ( data, callback, settings ) {"
+            # > get the table sorting direction
+            html += "var current_sort_dir = data.order[0].dir.toLowerCase();"
+            html += "if ( current_sort_dir != sort_dir) {"
+            html += "all_data = all_data.reverse();"
+            html += "sort_dir = current_sort_dir;"
+            html += "}"
+            # > create the records array for the page being displayed
+            html += "var out = [];"
+            # > get the ID search field
+            html += "var search_pattern = data.search.value.toLowerCase().trim();"
+            html += "var nbrecordsfiltered = nbrecordstotal;"
+            # > if the search field is not empty
+            html += "if (search_pattern != '') {"
+            # check the filtered indicies cache
+            html += "if (filtered_indices[0] != search_pattern) {"
+            html += "filtered_indices[0] = search_pattern;"
+            html += "filtered_indices[1] = [];"
+            # fill the filtered indicies cache
+            html += "for ( var i=0; i<nbrecordstotal ; i++ ) {"
+            html += ("if (all_data[i][0].toLowerCase()"
+                     ".indexOf(search_pattern) >= 0) {")
+            html += "filtered_indices[1].push(i);"
+            # close the 'if some occurence of the search pattern is found' loop
+            html += "}"
+            # close the for loop
+            html += "}"
+            # > close the filtered indices cache verification
+            html += "}"
+            html += "nbrecordsfiltered = filtered_indices[1].length;"
+            # fill the records array based on the filtered indicies
+            html += ("for (var i=data.start, ien=Math.min(data.start+data.length, "
+                     "nbrecordsfiltered) ; i<ien ; i++) {")
+            html += "out.push( all_data[ filtered_indices[1][i] ] );"
+            html += "}"
+            # > close the 'if the search field is not empty' condition
+            html += "}"
+            # > if the search field is empty
+            html += "else {"
+            # fill the records array without filtering
+            html += ("for ( var i=data.start, ien=Math.min(data.start+data.length,"
+                     " nbrecordstotal) ; i<ien ; i++ ) {")
+            html += "out.push( all_data[i] );"
+            # > close the for loop
+            html += "}"
+            # > close the 'else if the search field is empty' condition
+            html += "}"
+            # register the ajax callback
+            html += "setTimeout( function () {"
+            html += "callback( {"
+            html += "draw: data.draw,"
+            html += "data: out,"
+            html += "recordsTotal: nbrecordstotal,"
+            html += "recordsFiltered: nbrecordsfiltered"
+            html += "} );"
+            # > close the ajax callback registration
+            html += "}, 50 );"
+            # > close the ajax callback
+            html += "},"
 
         # > set table display options
         html += '"sScrollX": "100%",'
@@ -497,26 +719,34 @@ class JHugetableView(View):
             # > assign ajax callback to csv button : start function click
             html += "$('#csv_button').click(function() {"
 
-            # > create the csv string
-            html += "var csv_headers = {0};".format(
-                    json.dumps([u"ID"] + labels))
-            html += "var csv_tooltips = {0};".format(
-                json.dumps([tooltip.replace(";", "") for tooltip in tooltips]))
-            html += ("var csv_rows = [csv_headers.join(';'), "
-                     "csv_tooltips.join(';')];")
-            html += "for(var i=0, l=all_data.length; i<l; ++i){"
-            html += "csv_rows.push(all_data[i].join(';'));"
-            html += "}"
-            html += """var csv_string = '"sep=;"\\n' + csv_rows.join('\\r\\n');"""
+            # > download the cached table
+            if server_side:
+                csv_url = self._cw.build_url(
+                    "view", vid="jtable-hugetable-csv-export",
+                    table_key=table_key, filename=filename)
+                html += "window.location.href = '{0}';".format(csv_url)
 
-            # > create a web-browser download object
-            html += "var a = window.document.createElement('a');"
-            html += ("a.href = window.URL.createObjectURL("
-                     "new Blob([csv_string], {type: 'text/csv'}));")
-            html += "a.download = '{0}.csv';".format(filename)
-            html += "document.body.appendChild(a);"
-            html += "a.click();"
-            html += "document.body.removeChild(a);"
+            # > create the csv string
+            else:
+                html += "var csv_headers = {0};".format(
+                        json.dumps([u"ID"] + labels))
+                html += "var csv_tooltips = {0};".format(
+                    json.dumps([tooltip.replace(";", "") for tooltip in tooltips]))
+                html += ("var csv_rows = [csv_headers.join(';'), "
+                         "csv_tooltips.join(';')];")
+                html += "for(var i=0, l=all_data.length; i<l; ++i){"
+                html += "csv_rows.push(all_data[i].join(';'));"
+                html += "}"
+                html += """var csv_string = '"sep=;"\\n' + csv_rows.join('\\r\\n');"""
+
+                # > create a web-browser download object
+                html += "var a = window.document.createElement('a');"
+                html += ("a.href = window.URL.createObjectURL("
+                         "new Blob([csv_string], {type: 'text/csv'}));")
+                html += "a.download = '{0}.csv';".format(filename)
+                html += "document.body.appendChild(a);"
+                html += "a.click();"
+                html += "document.body.removeChild(a);"
 
             # > end fct click
             html += "});"
@@ -663,17 +893,7 @@ class JtableView(View):
         qmap = self._cw.vreg.docmap
 
         # Associate a tooltip to each label
-        tooltips = [""]
-        for label_text in labels:
-            if label_text in qmap:
-                matches = re.findall("<!--.*tooltip:.*-->", qmap[label_text])
-                if len(matches) == 1:
-                    match = matches[0][matches[0].index("tooltip:") + 8:-3]
-                    tooltips.append(match)
-                else:
-                    tooltips.append("")
-            else:
-                tooltips.append("")
+        tooltips = [""] + get_label_tooltips(qmap, labels)
 
         # Generate the script
         # > table column headers and sort option
@@ -873,45 +1093,197 @@ class JtableView(View):
 
 class PIWSCSVView(CSVMixIn, View):
     """ Dumps table data in CSV: used by 'jtable-table' view.
+
+    The rows are sent as they are generated: the subjects are requested
+    by chunks, in the 'ID' order, and their answers are pivoted chunk by
+    chunk. Set the 'gzip' form parameter to get a compressed file.
     """
     __regid__ = "jtable-table-csv-export"
     __select__ = yes()
     title = _("piws csv export")
+    chunk_size = 500
 
     def call(self):
-        """ Display the CSV formated table data.
+        """ Stream the CSV formated table data.
         """
 
         qname = self._cw.form["qname"]
         timepoint = self._cw.form["timepoint"]
         labels = json.loads(self._cw.form["labels"])
+        gzip = self._cw.form.get("gzip", "") in ("1", "true", "yes")
 
-        rset = []
-        for rtype in ANSWERS_RTYPE:     
-            rql = ("Any ID, QT, OV Where S is Subject, S code_in_study ID, "
-                   "S subject_questionnaire_runs QR, QR questionnaire QU, "
-                   "QU name '{0}', QR {1}_answers O, O value OV, "
-                   "O in_assessment A, A timepoint '{2}', O question Q, "
-                   "Q text QT".format(qname, rtype, timepoint))
-            rset.extend(self._cw.execute(rql))
+        rows = itertools.chain(
+            [["sep=;"], labels],
+            self.iter_rows(qname, timepoint, labels))
+        direct_csv_stream(self._cw, rows, self.csv_params,
+                          filename="{0}_{1}".format(qname, timepoint),
+                          gzip=gzip)
+
+    def iter_rows(self, qname, timepoint, labels):
+        """ Generate the table rows, subject chunk by subject chunk.
 
-        table = defaultdict(lambda: OrderedDict.fromkeys(labels, ""))
-        for item in rset:
-            table[item[0]][item[1]] = item[2]
-        for key in table:
-            table[key]["ID"] = key
+        Parameters
+        ----------
+        qname: str
+            the questionnaire name.
+        timepoint: str
+            the answers timepoint.
+        labels: list of str
+            the table column names.
+
+        Returns
+        -------
+        rows: generator of list
+            the subject answers sorted by subject identifier.
+        """
+        kwargs = {"qname": qname, "timepoint": timepoint}
+        offset = 0
+        while True:
+
+            # Get the next chunk of subjects
+            rql = ("DISTINCT Any S, ID ORDERBY ID, S LIMIT {0} OFFSET {1} "
+                   "Where S is Subject, S code_in_study ID, "
+                   "S subject_questionnaire_runs QR, QR questionnaire QU, "
+                   "QU name %(qname)s, QR in_assessment A, "
+                   "A timepoint %(timepoint)s".format(self.chunk_size,
+                                                      offset))
+            rset = self._cw.execute(rql, kwargs)
+            table = OrderedDict()
+            for subject_eid, subject_id in rset:
+                table[subject_eid] = OrderedDict.fromkeys(labels, "")
+                table[subject_eid]["ID"] = subject_id
+
+            # Pivot the chunk answers
+            answered = set()
+            if len(table) > 0:
+                eids = ", ".join([str(eid) for eid in table])
+                for rtype in ANSWERS_RTYPE:
+                    rql = ("Any S, QT, OV Where S eid IN ({0}), "
+                           "S subject_questionnaire_runs QR, "
+                           "QR questionnaire QU, QU name %(qname)s, "
+                           "QR {1}_answers O, O value OV, O in_assessment A, "
+                           "A timepoint %(timepoint)s, O question Q, "
+                           "Q text QT".format(eids, rtype))
+                    for subject_eid, question, value in self._cw.execute(
+                            rql, kwargs):
+                        table[subject_eid][question] = value
+                        answered.add(subject_eid)
+            for subject_eid, data in table.items():
+                if subject_eid in answered:
+                    yield data.values()
+
+            # Stop after the last chunk
+            if rset.rowcount < self.chunk_size:
+                break
+            offset += self.chunk_size
+
+
+class HugetableCSVView(CSVMixIn, View):
+    """ Dumps a cached table in CSV: used by 'jtable-hugetable-clientside'
+    view in server-side mode.
+    """
+    __regid__ = "jtable-hugetable-csv-export"
+    __select__ = yes()
+    title = _("piws csv export")
 
-        writer = self.csvwriter()
-        writer.writerow(["sep=;"])
-        writer.writerow(labels)
-        for psc2, data in iter(sorted(table.iteritems())):
-            writer.writerow(data.values())
+    def call(self):
+        """ Stream the CSV formated table data.
+        """
+        table = get_cached_table(self._cw, self._cw.form["table_key"])
+        if table is None:
+            raise ValueError("The table has expired, please reload the page.")
+        labels = table["labels"]
+        tooltips = get_label_tooltips(self._cw.vreg.docmap, labels)
+        gzip = self._cw.form.get("gzip", "") in ("1", "true", "yes")
+
+        rows = itertools.chain(
+            [["sep=;"], [u"ID"] + labels,
+             [u""] + [tooltip.replace(";", "") for tooltip in tooltips]],
+            table["records"])
+        direct_csv_stream(self._cw, rows, self.csv_params,
+                          filename=self._cw.form.get("filename", "table"),
+                          gzip=gzip)
 
 
 ###############################################################################
 # Interact with jtable js
 ###############################################################################
 
+@ajaxfunc(output_type="json")
+def get_hugetable_data(self):
+    """ Get a page of a cached table.
+
+    Attributes
+    ----------
+    table_key: str
+        the table cache key.
+    draw: int
+        the DataTables draw counter.
+    start: int
+        the first row index.
+    length: int
+        the number of rows per page, -1 for all the rows.
+    search: str
+        pattern to search in the ID column.
+    order_column: int
+        the index of the sorted column.
+    order_dir: str
+        the sorting direction, 'asc' or 'desc'.
+
+    Returns
+    -------
+    data: dict
+        the table page.
+    """
+    # Get parameters
+    draw = int(self._cw.form.get("draw", 0))
+    start = max(int(self._cw.form.get("start", 0)), 0)
+    length = int(self._cw.form.get("length", 10))
+    search = self._cw.form.get("search", "").lower().strip()
+    order_column = int(self._cw.form.get("order_column", 0))
+    order_dir = self._cw.form.get("order_dir", "asc")
+
+    # Get the cached table
+    table = get_cached_table(self._cw, self._cw.form["table_key"])
+    if table is None:
+        return {"draw": draw, "recordsTotal": 0, "recordsFiltered": 0,
+                "data": [],
+                "error": "The table has expired, please reload the page."}
+    records = table["records"]
+
+    # Sort the rows: the rows are kept in their original order when the ID
+    # column is sorted, other orders are computed once
+    if order_column == 0:
+        order = range(len(records))
+    else:
+        order = table["orders"].get(order_column)
+        if order is None:
+            order = sorted(range(len(records)),
+                           key=lambda index: records[index][order_column])
+            table["orders"][order_column] = order
+    if order_dir == "desc":
+        order = order[::-1]
+
+    # Filter the rows with the ID pattern
+    if search != "":
+        ids = table["ids"]
+        order = [index for index in order if search in ids[index]]
+
+    # Select the page rows
+    if length == -1:
+        page = order[start:]
+    else:
+        page = order[start: start + length]
+
+    # Table formatting
+    data = {"draw": draw,
+            "recordsTotal": len(records),
+            "recordsFiltered": len(order),
+            "data": [records[index] for index in page]}
+
+    return data
+
+
 @ajaxfunc(output_type="json")
 def get_open_answers_data(self):
     """ Get the subject answer data.
@@ -936,7 +1308,8 @@ def get_open_answers_data(self):
     Returns
     -------
     data: dict
-        the table content.
+        the table content, 'bCountsExact' specifies if the table sizes are
+        exact or estimated.
     """
     # Get parameters
     jtsort = self._cw.form['sSortDir_0']
@@ -947,54 +1320,61 @@ def get_open_answers_data(self):
     qname = self._cw.form['qname']
     timepoint = self._cw.form['timepoint']
 
-    # Deal with sort options
-    jtsort = "ORDERBY ID {0}".format(jtsort)
-
-    # Get all the questionnaire runs and associated subjects
-    rql = ("Any ID, QR {0} "
-           "Where QR is QuestionnaireRun, QR questionnaire Q, Q name '{1}', "
-           "QR subject S, S code_in_study ID, QR in_assessment A, "
-           "A timepoint '{2}'".format(jtsort, qname, timepoint))
-    rset = self._cw.execute(rql)
-
-    # Filter the rset with the ID pattern
-    filtered_rset = []
-    for item in rset:
-        if id_pattern == "" or id_pattern in item[0]:
-            filtered_rset.append([item[0], item[1]])
-
-    # Set the appropriate range to access the data
-    # > if the user want to show all the results
-    if jtpagesize == -1 or jtpagesize > len(filtered_rset):
-        rset_range = range(len(filtered_rset))
-    # > otherwise
+    # Deal with sort and paging options
+    if jtsort.upper() not in ("ASC", "DESC"):
+        jtsort = "ASC"
+    jtsort = "ORDERBY ID {0}".format(jtsort.upper())
+    if jtpagesize == -1:
+        jtlimit = ""
     else:
-        rset_range = range(jtstartindex,
-                           min(jtstartindex + jtpagesize, len(filtered_rset)))
-
-    # Get the answers of the desired subset of subjects
-    records = []
-    for row_nb in rset_range:
-        user_data = OrderedDict.fromkeys(labels, '')
-        user_data["ID"] = filtered_rset[row_nb][0]
-
-        # Execute an rql to get the subject answers
-        questionnaire_run_eid = filtered_rset[row_nb][1]
-        for rtype in ANSWERS_RTYPE:     
-            rql = ("Any QN, V Where QR eid '{0}', QR {1}_answers A, A question Q,"
-                   "Q text QN, A value V".format(questionnaire_run_eid, rtype))
-            answer_rset = self._cw.execute(rql)
-
-            # Go through all answers
-            for qname, answer in answer_rset:
-                user_data[qname] = answer
-
-        # Store the tabel formated row
-        records.append(user_data.values())
-
-    # Table formatting
-    data = {"iTotalRecords": rset.rowcount,
-            "iTotalDisplayRecords": len(filtered_rset),
+        jtlimit = "LIMIT {0} OFFSET {1}".format(max(jtpagesize, 0),
+                                                max(jtstartindex, 0))
+
+    # Count the questionnaire runs, with and without the ID filter
+    restrictions = ("QR is QuestionnaireRun, QR questionnaire Q, "
+                    "Q name %(qname)s, QR subject S, S code_in_study ID, "
+                    "QR in_assessment A, A timepoint %(timepoint)s")
+    kwargs = {"qname": qname, "timepoint": timepoint}
+    total = self._cw.execute(
+        "Any COUNT(QR) Where {0}".format(restrictions), kwargs)[0][0]
+    if id_pattern != "":
+        # Escape the LIKE wildcards of the user input: backslash is the
+        # default escape character
+        id_pattern = id_pattern.replace("\\", "\\\\").replace(
+            "%", "\\%").replace("_", "\\_")
+        restrictions += ", ID LIKE %(id_pattern)s"
+        kwargs["id_pattern"] = u"%{0}%".format(id_pattern)
+        nb_filtered = self._cw.execute(
+            "Any COUNT(QR) Where {0}".format(restrictions), kwargs)[0][0]
+    else:
+        nb_filtered = total
+
+    # Get the questionnaire runs of the page
+    rql = "Any ID, QR {0} {1} Where {2}".format(jtsort, jtlimit, restrictions)
+    rset = self._cw.execute(rql, kwargs)
+
+    # Get the answers of the page runs: one request per answer type, the
+    # answers are pivoted in memory
+    table = OrderedDict()
+    for subject_id, questionnaire_run_eid in rset:
+        table[questionnaire_run_eid] = OrderedDict.fromkeys(labels, '')
+        table[questionnaire_run_eid]["ID"] = subject_id
+    if len(table) > 0:
+        eids = ", ".join([str(eid) for eid in table])
+        for rtype in ANSWERS_RTYPE:
+            rql = ("Any QR, QN, V Where QR eid IN ({0}), QR {1}_answers A, "
+                   "A question Q, Q text QN, A value V".format(eids, rtype))
+            for questionnaire_run_eid, question, answer in self._cw.execute(
+                    rql):
+                table[questionnaire_run_eid][question] = answer
+
+    # Store the tabel formated rows
+    records = [user_data.values() for user_data in table.values()]
+
+    # Table formatting: the counts are computed by the database
+    data = {"iTotalRecords": total,
+            "iTotalDisplayRecords": nb_filtered,
+            "bCountsExact": True,
             "aaData": records}
 
     return data
@@ -1138,9 +1518,10 @@ def get_questionnaires_data(self):
 def registration_callback(vreg):
 
     for tclass in [JtableView, JHugetableView, FileAnswerTableView,
-                   PIWSCSVView, ScoreValueTableViewSecondary,
+                   PIWSCSVView, HugetableCSVView, ScoreValueTableViewSecondary,
                    ScoreValueTableViewPrimary]:
         vreg.register(tclass)
 
-    for ajax in [get_questionnaires_data, get_open_answers_data]:
+    for ajax in [get_questionnaires_data, get_open_answers_data,
+                 get_hugetable_data]:
         vreg.register(ajax)
@@ -7,6 +7,7 @@
 ##########################################################################
 
 # System import
+import itertools
 from packaging import version
 
 # Cubicweb import
@@ -16,10 +17,15 @@ if cw_version >= version.parse("3.21.0"):
     from cubicweb import _
 
 from cubicweb.predicates import any_rset
+from cubicweb.predicates import match_form_params
 from cubicweb.web.views import tableview
 from logilab.common.decorators import monkeypatch
 from cubicweb.view import AnyRsetView
 from cubicweb.web.views.csvexport import CSVMixIn
+from rql.nodes import VariableRef
+
+# Package import
+from cubes.piws.views.streaming import direct_csv_stream
 
 
 @monkeypatch(tableview.TableLayout)
@@ -32,7 +38,7 @@ def render_table_headers(self, w, colrenderers):
         labels.append(colrenderer.header)
     # > all labels must be different than None:
     if self.cw_rset is not None and None not in labels:
-        href = self._cw.build_url(rql=self.cw_rset.printable_rql(),
+        href = self._cw.build_url(export_rql=self.cw_rset.printable_rql(),
                                   vid="tablecsvexport", labels=labels)
         w(u'<a class="btn btn-default" role="button" id="table_csv_button" '
           u'href="{0}">CSV Export &#187</a>'.format(href))
@@ -51,22 +57,96 @@ def render_table_headers(self, w, colrenderers):
 
 class CSVRsetView(CSVMixIn, AnyRsetView):
     """ Dumps table rset in CSV.
+
+    The RQL can be passed in the 'export_rql' form parameter instead of the
+    'rql' one: the request is then executed page by page (if ordered) and
+    the rows are sent as they are generated. Set the 'gzip' form parameter
+    to get a compressed file.
     """
     __regid__ = "tablecsvexport"
-    __select__ = any_rset()
+    __select__ = any_rset() | match_form_params("export_rql")
     title = _("CSV export")
+    chunk_size = 1000
 
     def call(self):
         """ This method expect a 'labels' form attribute that will be dumped
         as the first row of the CSV file.
         """
-        writer = self.csvwriter()
         labels = self._cw.form["labels"]
         if not isinstance(labels, list):
             labels = [labels]
-        writer.writerow(["sep=;"])
-        writer.writerow(labels)
-        rset, descr = self.cw_rset, self.cw_rset.description
+        gzip = self._cw.form.get("gzip", "") in ("1", "true", "yes")
+        if self.cw_rset is not None:
+            rsets = [self.cw_rset]
+        else:
+            rsets = self.iter_rsets(self._cw.form["export_rql"])
+        rows = itertools.chain(
+            [["sep=;"], labels],
+            (row for rset in rsets for row in self.iter_rows(rset)))
+        direct_csv_stream(self._cw, rows, self.csv_params,
+                          filename="cubicwebexport", gzip=gzip)
+
+    def iter_rsets(self, rql):
+        """ Execute a request page by page with LIMIT/OFFSET clauses: only
+        ordered requests that select variables can be paginated, other
+        requests are executed at once.
+
+        The selected variables that are not sorted are appended to the
+        ORDERBY clause, so that the rows order is the same for all the
+        pages: no row is duplicated or skipped.
+
+        Parameters
+        ----------
+        rql: str
+            the request to be executed.
+
+        Returns
+        -------
+        rsets: generator of ResultSet
+            the request result pages.
+        """
+        rqlst = self._cw.vreg.parse(self._cw, rql)
+        if len(rqlst.children) != 1:
+            yield self._cw.execute(rql)
+            return
+        select = rqlst.children[0]
+        if (not select.orderby or select.limit is not None or
+                select.offset or
+                not all(isinstance(term, VariableRef)
+                        for term in select.selection)):
+            yield self._cw.execute(rql)
+            return
+        sorted_names = set(
+            sortterm.term.name for sortterm in select.orderby
+            if isinstance(sortterm.term, VariableRef))
+        for term in select.selection:
+            if term.name not in sorted_names:
+                select.add_sort_var(term.variable)
+                sorted_names.add(term.name)
+        offset = 0
+        while True:
+            select.set_limit(self.chunk_size)
+            select.set_offset(offset)
+            rset = self._cw.execute(rqlst.as_string())
+            yield rset
+            if rset.rowcount < self.chunk_size:
+                break
+            offset += self.chunk_size
+
+    def iter_rows(self, rset):
+        """ Format the rows of a result set.
+
+        Parameters
+        ----------
+        rset: ResultSet
+            the result set to be exported.
+
+        Returns
+        -------
+        rows: generator of list
+            the text representation of each cell.
+        """
+        descr = rset.description
         eschema = self._cw.vreg.schema.eschema
         for rowindex, row in enumerate(rset):
             csvrow = []
@@ -81,5 +161,4 @@ class CSVRsetView(CSVMixIn, AnyRsetView):
                                             format='text/plain',
                                             row=rowindex, col=colindex)
                 csvrow.append(content)
-            writer.writerow(csvrow)
-
+            yield csvrow